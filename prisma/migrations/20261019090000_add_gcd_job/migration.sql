@@ -0,0 +1,30 @@
+-- CreateEnum
+CREATE TYPE "GcdJobStatus" AS ENUM ('pending', 'running', 'done', 'failed');
+
+-- CreateTable
+CREATE TABLE "GcdJob" (
+    "id" SERIAL NOT NULL,
+    "emailSignatureA_id" INTEGER NOT NULL,
+    "emailSignatureB_id" INTEGER NOT NULL,
+    "status" "GcdJobStatus" NOT NULL DEFAULT 'pending',
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "leaseOwner" TEXT,
+    "leaseExpiresAt" TIMESTAMP(3),
+    "lastError" TEXT,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "finishedAt" TIMESTAMP(3),
+
+    CONSTRAINT "GcdJob_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "GcdJob_status_leaseExpiresAt_idx" ON "GcdJob"("status", "leaseExpiresAt");
+
+-- CreateIndex
+CREATE UNIQUE INDEX "GcdJob_emailSignatureA_id_emailSignatureB_id_key" ON "GcdJob"("emailSignatureA_id", "emailSignatureB_id");
+
+-- AddForeignKey
+ALTER TABLE "GcdJob" ADD CONSTRAINT "GcdJob_emailSignatureA_id_fkey" FOREIGN KEY ("emailSignatureA_id") REFERENCES "EmailSignature"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
+
+-- AddForeignKey
+ALTER TABLE "GcdJob" ADD CONSTRAINT "GcdJob_emailSignatureB_id_fkey" FOREIGN KEY ("emailSignatureB_id") REFERENCES "EmailSignature"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
@@ -0,0 +1,53 @@
+-- Merge duplicate domain/selector pairs into the pair with the lowest id
+CREATE TEMP TABLE dsp_merge AS
+SELECT id, min(id) OVER (PARTITION BY domain, selector) AS keep_id FROM "DomainSelectorPair";
+
+UPDATE "DkimRecord" r SET "domainSelectorPairId" = m.keep_id
+FROM dsp_merge m
+WHERE r."domainSelectorPairId" = m.id AND m.id <> m.keep_id;
+
+UPDATE "DomainSelectorPair" p SET "lastRecordUpdate" = d.last_record_update
+FROM (
+    SELECT m.keep_id, max(p2."lastRecordUpdate") AS last_record_update
+    FROM dsp_merge m JOIN "DomainSelectorPair" p2 ON p2.id = m.id
+    GROUP BY m.keep_id
+    HAVING count(*) > 1
+) d
+WHERE p.id = d.keep_id;
+
+DELETE FROM "DomainSelectorPair" p
+USING dsp_merge m
+WHERE p.id = m.id AND m.id <> m.keep_id;
+
+-- Merge the records with the same value and key data under the merged pairs into the record with the lowest id
+CREATE TEMP TABLE dkim_record_merge AS
+SELECT id, min(id) OVER (PARTITION BY "domainSelectorPairId", value, "keyData") AS keep_id
+FROM "DkimRecord"
+WHERE "domainSelectorPairId" IN (SELECT keep_id FROM dsp_merge WHERE id <> keep_id);
+
+UPDATE "DkimRecord" r
+SET "firstSeenAt" = d.first_seen_at, "lastSeenAt" = d.last_seen_at, "provenanceVerified" = d.provenance_verified
+FROM (
+    SELECT m.keep_id, min(r2."firstSeenAt") AS first_seen_at, max(r2."lastSeenAt") AS last_seen_at, bool_or(r2."provenanceVerified") AS provenance_verified
+    FROM dkim_record_merge m JOIN "DkimRecord" r2 ON r2.id = m.id
+    GROUP BY m.keep_id
+    HAVING count(*) > 1
+) d
+WHERE r.id = d.keep_id;
+
+UPDATE "EmailPairGcdResult" g SET "dkimRecordId" = m.keep_id
+FROM dkim_record_merge m
+WHERE g."dkimRecordId" = m.id AND m.id <> m.keep_id;
+
+DELETE FROM "DkimRecord" r
+USING dkim_record_merge m
+WHERE r.id = m.id AND m.id <> m.keep_id;
+
+DROP TABLE dkim_record_merge;
+DROP TABLE dsp_merge;
+
+-- DropIndex
+DROP INDEX "DomainSelectorPair_domain_idx";
+
+-- CreateIndex
+CREATE UNIQUE INDEX "DomainSelectorPair_domain_selector_key" ON "DomainSelectorPair"("domain", "selector");
@@ -54,7 +54,7 @@ export async function addDomainSelectorPair(domain: string, selector: string, so
 	}
 	console.log(`found ${records.length} dkim dns records for ${selector}, ${domain}, adding DSP and records`);
 
-	let newDsp = await prisma.domainSelectorPair.create({
+	const newDsp = await prisma.domainSelectorPair.create({
 		data: {
 			domain,
 			selector,
@@ -74,7 +74,17 @@ export async function addDomainSelectorPair(domain: string, selector: string, so
 		include: {
 			records: true
 		}
-	})
+	}).catch(error => {
+		// the pair was added by a concurrent request after the check above, (domain, selector) is unique
+		if (error instanceof Prisma.PrismaClientKnownRequestError && error.code === 'P2002') {
+			return null;
+		}
+		throw error;
+	});
+	if (!newDsp) {
+		console.log(`domain/selector pair ${selector}, ${domain} was added concurrently`);
+		return { already_in_db: true, added: false };
+	}
 	newDsp.records.forEach(record => {
 		generateWitness(newDsp, record);
 	});
@@ -1,15 +1,33 @@
 import argparse
 import asyncio
-from datetime import datetime, timezone
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from email.headerregistry import DateHeader
-import sys
 from typing import Any
 from prisma import Prisma
-from prisma.enums import KeyType
 
 from dkim_util import decode_dkim_tag_value_list
 from pubkey_finder.common import get_date_interval
 
+# The rows of the TSV file are loaded into a temporary staging table in chunks,
+# and merged into DomainSelectorPair and DkimRecord with a few set-based queries in one transaction,
+# instead of several round trips to the database per row.
+
+# number of TSV rows that are inserted into the staging table per query
+chunk_size = 10000
+
+# domain, selector, value, key data, oldest date, newest date
+StagingRow = tuple[str, str, str, str, str, str]
+
+
+@dataclass
+class ImportCounts:
+	rows: int = 0
+	skipped_rows: int = 0
+	created_dsps: int = 0
+	created_records: int = 0
+	updated_records: int = 0
+
 
 def parse_email_header_date(date_str: str) -> datetime | None:
 	kwds: dict[str, Any] = {}
@@ -30,56 +48,102 @@ def parse_email_header_date(date_str: str) -> datetime | None:
 	return date
 
 
-async def add_records(filename: str, prisma: Prisma):
-	with open(filename, 'r') as f:
-		for index, line in enumerate(f):
-			print()
-			print(f'line {index + 1}')
-			parts = line.strip().split('\t')
-			domain = parts[1]
-			selector = parts[2]
-			dkim_tvl = parts[3]
-			#src1 = parts[4]
-			#src2 = parts[5]
-			date1 = parse_email_header_date(parts[6])
-			date2 = parse_email_header_date(parts[7])
-			oldest_date, newest_date = get_date_interval(date1, date2)
-
-			print(f'domain: {domain}, selector: {selector}, oldest_date: {oldest_date}, newest_date: {newest_date}')
-			if dkim_tvl == '-':
-				print(f'skipping record for {domain} / {selector} with dkim_tvl="-"')
-				continue
-			dsp = await prisma.domainselectorpair.find_first(where={'domain': domain, 'selector': selector})
-			if dsp is None:
-				dsp = await prisma.domainselectorpair.create(data={'domain': domain, 'selector': selector, 'sourceIdentifier': 'public_key_gcd_batch'})
-				print(f'created domain/selector pair: {domain} / {selector}')
-
-			p = decode_dkim_tag_value_list(dkim_tvl).get('p')
-			dkimrecord = await prisma.dkimrecord.find_first(where={'domainSelectorPairId': dsp.id, 'keyData': p})
-			if not dkimrecord:
-				await prisma.dkimrecord.create(
-				    data={
-				        'domainSelectorPairId': dsp.id,
-				        'firstSeenAt': oldest_date or datetime.now(),
-				        'lastSeenAt': newest_date or datetime.now(),
-				        'value': dkim_tvl,
-				        'keyType': KeyType.RSA,
-				        'keyData': p,
-				        'source': 'public_key_gcd_batch',
-				    })
-				print(f'created record for {domain} / {selector}')
-			else:
-				print(f'record already exists for {domain} / {selector}')
-				print(f'oldest_date: {oldest_date}, newest_date: {newest_date}')
-				print(f'firstSeenAt: {dkimrecord.firstSeenAt}, lastSeenAt: {dkimrecord.lastSeenAt}')
-				if oldest_date and oldest_date < dkimrecord.firstSeenAt:
-					print(f'updating firstSeenAt from {dkimrecord.firstSeenAt} to {oldest_date}')
-					dkimrecord.firstSeenAt = oldest_date
-				if newest_date and (dkimrecord.lastSeenAt is None or newest_date > dkimrecord.lastSeenAt):
-					print(f'updating lastSeenAt from {dkimrecord.lastSeenAt} to {newest_date}')
-					dkimrecord.lastSeenAt = newest_date
-				await prisma.dkimrecord.update(where={'id': dkimrecord.id}, data={'firstSeenAt': dkimrecord.firstSeenAt, 'lastSeenAt': dkimrecord.lastSeenAt})
-			sys.stdout.flush()
+def to_db_timestamp(date: datetime | None) -> str:
+	# the timestamp columns are UTC without time zone, an empty string is stored as NULL
+	if date is None:
+		return ''
+	return date.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def parse_row(line: str) -> StagingRow | None:
+	parts = line.strip().split('\t')
+	domain = parts[1]
+	selector = parts[2]
+	dkim_tvl = parts[3]
+	#src1 = parts[4]
+	#src2 = parts[5]
+	if dkim_tvl == '-':
+		return None
+	date1 = parse_email_header_date(parts[6])
+	date2 = parse_email_header_date(parts[7])
+	oldest_date, newest_date = get_date_interval(date1, date2)
+	p = decode_dkim_tag_value_list(dkim_tvl).get('p') or ''
+	return (domain, selector, dkim_tvl, p, to_db_timestamp(oldest_date), to_db_timestamp(newest_date))
+
+
+async def stage_rows(tx: Prisma, rows: list[StagingRow]):
+	columns = [list(column) for column in zip(*rows)]
+	await tx.execute_raw(
+	    """
+		INSERT INTO pubkey_solver_staging
+		SELECT domain, selector, value, NULLIF(key_data, ''), NULLIF(oldest, '')::timestamp, NULLIF(newest, '')::timestamp
+		FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[]) AS t(domain, selector, value, key_data, oldest, newest)
+		""", *columns)
+
+
+async def add_records(filename: str, prisma: Prisma) -> ImportCounts:
+	counts = ImportCounts()
+	async with prisma.tx(max_wait=timedelta(seconds=10), timeout=timedelta(hours=1)) as tx:
+		await tx.execute_raw("""
+			CREATE TEMP TABLE pubkey_solver_staging (
+				domain TEXT NOT NULL,
+				selector TEXT NOT NULL,
+				value TEXT NOT NULL,
+				key_data TEXT,
+				oldest TIMESTAMP(3),
+				newest TIMESTAMP(3)
+			) ON COMMIT DROP
+			""")
+		with open(filename, 'r') as f:
+			rows: list[StagingRow] = []
+			for line in f:
+				counts.rows += 1
+				row = parse_row(line)
+				if row is None:
+					counts.skipped_rows += 1
+					continue
+				rows.append(row)
+				if len(rows) >= chunk_size:
+					await stage_rows(tx, rows)
+					rows = []
+			if rows:
+				await stage_rows(tx, rows)
+
+		counts.created_dsps = await tx.execute_raw("""
+			INSERT INTO "DomainSelectorPair" (domain, selector, "sourceIdentifier")
+			SELECT DISTINCT s.domain, s.selector, 'public_key_gcd_batch'
+			FROM pubkey_solver_staging s
+			ON CONFLICT (domain, selector) DO NOTHING
+			""")
+
+		# one row per domain/selector pair and key, with the date interval over all rows for that key
+		await tx.execute_raw("""
+			CREATE TEMP TABLE pubkey_solver_keys ON COMMIT DROP AS
+			SELECT d.id AS dsp_id, s.key_data, min(s.value) AS value, min(s.oldest) AS oldest, max(s.newest) AS newest
+			FROM pubkey_solver_staging s
+			JOIN "DomainSelectorPair" d ON d.domain = s.domain AND d.selector = s.selector
+			GROUP BY d.id, s.key_data
+			""")
+
+		# widen the firstSeenAt/lastSeenAt interval of existing records
+		counts.updated_records = await tx.execute_raw("""
+			UPDATE "DkimRecord" r
+			SET "firstSeenAt" = LEAST(r."firstSeenAt", k.oldest), "lastSeenAt" = GREATEST(r."lastSeenAt", k.newest)
+			FROM pubkey_solver_keys k
+			WHERE r."domainSelectorPairId" = k.dsp_id AND r."keyData" IS NOT DISTINCT FROM k.key_data
+			AND (k.oldest < r."firstSeenAt" OR k.newest > r."lastSeenAt" OR (r."lastSeenAt" IS NULL AND k.newest IS NOT NULL))
+			""")
+
+		counts.created_records = await tx.execute_raw("""
+			INSERT INTO "DkimRecord" ("domainSelectorPairId", "firstSeenAt", "lastSeenAt", value, "keyType", "keyData", source)
+			SELECT k.dsp_id, COALESCE(k.oldest, now() AT TIME ZONE 'UTC'), COALESCE(k.newest, now() AT TIME ZONE 'UTC'),
+				k.value, 'RSA'::"KeyType", k.key_data, 'public_key_gcd_batch'
+			FROM pubkey_solver_keys k
+			WHERE NOT EXISTS (
+				SELECT 1 FROM "DkimRecord" r WHERE r."domainSelectorPairId" = k.dsp_id AND r."keyData" IS NOT DISTINCT FROM k.key_data
+			)
+			""")
+	return counts
 
 
 async def main():
@@ -88,7 +152,10 @@ async def main():
 	args = argparser.parse_args()
 	prisma = Prisma()
 	await prisma.connect()
-	await add_records(args.filename, prisma)
+	counts = await add_records(args.filename, prisma)
+	print(f'rows: {counts.rows}, skipped rows without a key: {counts.skipped_rows}')
+	print(f'created domain/selector pairs: {counts.created_dsps}')
+	print(f'created records: {counts.created_records}, updated records: {counts.updated_records}')
 
 
 if __name__ == '__main__':
@@ -1,51 +1,267 @@
 #!/usr/bin/env python3
 
 # This script is used to call the batch_update API endpoint
-# Usage: call_batch_update.py [env_file.env]
+# Usage: call_batch_update.py [--env-file env_file.env]
 
 # Example installation and configuration on Ubuntu:
 #
 # sudo apt install python3-pip
-# sudo apt install curl
-# pip install python-dotenv
+# pip install python-dotenv httpx
 #
 # Set the environment variable CRON_SECRET in the environment or in a .env file.
-# Run "crontab -e" and add the following line:
 #
-#     */10 * * * * /path/to/call_batch_update.py --env-file /path/to/env_file.env --batch-size 20 | logger --tag DKIMREG
+# By default, the script runs until it is stopped, and calls the endpoint repeatedly while there are records to update.
+# The batch size is adjusted to the response time of the server: it grows by --batch-size-step while the responses are
+# faster than --target-latency, and is halved when they are slower or when a request fails.
+# On 429 and 5xx responses, all requests are paused, for the time in the Retry-After header if there is one,
+# otherwise with exponential backoff. When the server returns fewer records than requested, there is nothing left to update,
+# and the script waits --idle-interval seconds before the next call. Example systemd service command:
+#
+#     /path/to/call_batch_update.py --env-file /path/to/env_file.env
+#
+# To call the endpoint once and exit, as when run from cron, use --once. Run "crontab -e" and add the following line:
+#
+#     */10 * * * * /path/to/call_batch_update.py --env-file /path/to/env_file.env --batch-size 20 --once | logger --tag DKIMREG
+#
+# To test the driver without a server, use --stub-server, which starts a local server that simulates the endpoint.
 
 import argparse
+import asyncio
+import http.server
+import json
+import logging
 import os
+import random
 import sys
-import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, urljoin, urlparse
 import dotenv
-from urllib.parse import urlencode
-from urllib.parse import urljoin
+import httpx
 
+# the longest pause after repeated errors
+max_backoff = 600
 
-def run_command(command: list[str]):
-	return subprocess.check_output(command)
 
+@dataclass
+class BatchSizeController:
+	batch_size: int
+	min_batch_size: int
+	max_batch_size: int
+	step: int
+	target_latency: float
 
-if __name__ == "__main__":
+	def on_success(self, latency: float):
+		if latency > self.target_latency:
+			self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+		else:
+			self.batch_size = min(self.max_batch_size, self.batch_size + self.step)
+
+	def on_error(self):
+		self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+
+
+@dataclass
+class Throughput:
+	requests: int = 0
+	errors: int = 0
+	records: int = 0
+	latency_sum: float = 0
+	start_time: float = field(default_factory=time.time)
+
+	def report(self, batch_size: int):
+		elapsed = time.time() - self.start_time
+		average_latency = self.latency_sum / self.requests if self.requests else 0
+		logging.info(f'{self.records} records in {elapsed:.0f} s ({self.records / elapsed * 60:.1f}/min), '
+		             f'{self.requests} requests, {self.errors} errors, average latency {average_latency:.1f} s, batch size {batch_size}')
+
+
+def retry_after_seconds(response: httpx.Response) -> float | None:
+	value = response.headers.get('Retry-After')
+	if value is None:
+		return None
+	try:
+		return max(0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+
+class BatchUpdateDriver:
+	def __init__(self, client: httpx.AsyncClient, url: str, controller: BatchSizeController, concurrency: int, idle_interval: float):
+		self.client = client
+		self.url = url
+		self.controller = controller
+		self.concurrency = concurrency
+		self.idle_interval = idle_interval
+		self.throughput = Throughput()
+		self.consecutive_errors = 0
+		self.paused_until = 0.0
+
+	def pause(self, seconds: float):
+		self.paused_until = max(self.paused_until, time.time() + seconds)
+
+	def backoff(self, retry_after: float | None):
+		self.consecutive_errors += 1
+		if retry_after is None:
+			retry_after = min(max_backoff, 5 * 2**(self.consecutive_errors - 1)) * random.uniform(0.5, 1)
+		logging.info(f'pausing requests for {retry_after:.0f} s')
+		self.pause(retry_after)
+
+	async def call_batch_update(self) -> int | None:
+		# returns the number of updated records, or None if the request failed
+		batch_size = self.controller.batch_size
+		start = time.time()
+		try:
+			response = await self.client.get(self.url, params={'batch_size': batch_size})
+		except httpx.HTTPError as e:
+			logging.error(f'request failed: {e!r}')
+			self.throughput.errors += 1
+			self.controller.on_error()
+			self.backoff(None)
+			return None
+		latency = time.time() - start
+		self.throughput.requests += 1
+		self.throughput.latency_sum += latency
+		if response.status_code == 429 or response.status_code >= 500:
+			logging.error(f'status {response.status_code} after {latency:.1f} s: {response.text[:200]}')
+			self.throughput.errors += 1
+			if response.status_code != 429:
+				self.controller.on_error()
+			self.backoff(retry_after_seconds(response))
+			return None
+		if response.status_code != 200:
+			# e.g. 401 Unauthorized, which will not go away by retrying
+			logging.error(f'status {response.status_code}: {response.text[:200]}')
+			sys.exit(1)
+		updated_records = len(response.json().get('updatedRecords', []))
+		logging.info(f'updated {updated_records} records (batch size {batch_size}) in {latency:.1f} s')
+		self.consecutive_errors = 0
+		self.throughput.records += updated_records
+		self.controller.on_success(latency)
+		if updated_records < batch_size:
+			logging.info(f'no more records to update, waiting {self.idle_interval:.0f} s')
+			self.pause(self.idle_interval)
+		return updated_records
+
+	async def worker(self):
+		while True:
+			delay = self.paused_until - time.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+				continue
+			await self.call_batch_update()
+
+	async def reporter(self, report_interval: float):
+		while True:
+			await asyncio.sleep(report_interval)
+			self.throughput.report(self.controller.batch_size)
+
+	async def run(self, report_interval: float):
+		# Note: the endpoint selects the records with the oldest lastRecordUpdate, so concurrent batches may overlap
+		# until the timestamps of the previous batch are written. Use a concurrency above 1 only if that is acceptable.
+		tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+		tasks.append(asyncio.create_task(self.reporter(report_interval)))
+		await asyncio.gather(*tasks)
+
+
+class StubBatchUpdateHandler(http.server.BaseHTTPRequestHandler):
+	# simulates /api/batch_update, with a response time proportional to the batch size and occasional errors
+	seconds_per_record = 0.05
+	error_rate = 0.05
+	backlog = 10000
+
+	def do_GET(self):
+		query = parse_qs(urlparse(self.path).query)
+		batch_size = int(query.get('batch_size', ['10'])[0])
+		roll = random.random()
+		if roll < self.error_rate / 2:
+			self.send_json(429, 'Too Many Requests', {'Retry-After': '2'})
+			return
+		if roll < self.error_rate:
+			self.send_json(500, 'Internal Server Error')
+			return
+		count = min(batch_size, StubBatchUpdateHandler.backlog)
+		StubBatchUpdateHandler.backlog -= count
+		time.sleep(count * self.seconds_per_record)
+		self.send_json(200, {'updatedRecords': [{'id': i} for i in range(count)], 'addedAlternatives': []})
+
+	def send_json(self, status: int, body: object, headers: dict[str, str] = {}):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format: str, *args: object):
+		pass
+
+
+def start_stub_server() -> str:
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubBatchUpdateHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = f'http://127.0.0.1:{server.server_address[1]}'
+	logging.info(f'started stub server at {url}')
+	return url
+
+
+async def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--env-file", type=str, help="the environment file that contains the CRON_SECRET variable")
-	parser.add_argument("--batch-size", type=int, default=10, help="the number of records to update on the server")
+	parser.add_argument("--batch-size", type=int, default=10, help="the initial number of records to update on the server per request")
+	parser.add_argument("--min-batch-size", type=int, default=1)
+	parser.add_argument("--max-batch-size", type=int, default=200)
+	parser.add_argument("--batch-size-step", type=int, default=5, help="the increase of the batch size after each response that is faster than --target-latency")
+	parser.add_argument("--target-latency", type=float, default=30, help="the desired response time in seconds, should be well below the function timeout on the server")
+	parser.add_argument("--concurrency", type=int, default=1, help="the number of requests in flight at the same time")
+	parser.add_argument("--idle-interval", type=float, default=600, help="seconds to wait when there are no more records to update")
+	parser.add_argument("--report-interval", type=float, default=300, help="seconds between each throughput report")
+	parser.add_argument("--once", action="store_true", help="call the endpoint once with --batch-size and exit")
+	parser.add_argument("--stub-server", action="store_true", help="call a local server that simulates the endpoint, for testing")
 	parser.add_argument("--domain", type=str, default="https://archive.prove.email")
 	args = parser.parse_args()
 
+	logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(asctime)s %(levelname)s: %(message)s')
+	logging.getLogger("httpx").setLevel(logging.WARNING)
+
 	if args.env_file:
 		env_file = args.env_file
 		if dotenv.load_dotenv(env_file) == True:
-			print("loaded environment file: ", env_file)
+			logging.info(f"loaded environment file: {env_file}")
 
+	domain = args.domain
 	cron_secret = os.getenv('CRON_SECRET')
+	if args.stub_server:
+		domain = start_stub_server()
+		cron_secret = cron_secret or 'stub'
 	if cron_secret == None:
-		print("error: environment variable CRON_SECRET not found")
+		logging.error("environment variable CRON_SECRET not found")
 		sys.exit(1)
 
-	url = urljoin(args.domain, '/api/batch_update?' + urlencode({'batch_size': args.batch_size}))
-	print(f'calling {url}')
-	cmd = ['curl', url, '-H', 'Accept: application/json', '-H', 'Authorization: Bearer ' + cron_secret]
-	res = run_command(cmd)
-	print(res.decode('utf-8'))
+	url = urljoin(domain, '/api/batch_update')
+	headers = {'Accept': 'application/json', 'Authorization': 'Bearer ' + cron_secret}
+	timeout = httpx.Timeout(args.target_latency * 4, connect=10)
+	limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+	controller = BatchSizeController(args.batch_size, args.min_batch_size, args.max_batch_size, args.batch_size_step, args.target_latency)
+	async with httpx.AsyncClient(headers=headers, timeout=timeout, limits=limits) as client:
+		driver = BatchUpdateDriver(client, url, controller, args.concurrency, args.idle_interval)
+		logging.info(f'calling {url}')
+		if args.once:
+			updated_records = await driver.call_batch_update()
+			sys.exit(0 if updated_records is not None else 1)
+		await driver.run(args.report_interval)
+
+
+if __name__ == "__main__":
+	try:
+		asyncio.run(main())
+	except KeyboardInterrupt:
+		pass
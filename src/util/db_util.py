@@ -2,7 +2,7 @@ from prisma import Prisma
 from prisma.types import DkimRecordWhereUniqueInput
 from prisma.models import DkimRecord
 import logging
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 
 async def load_dkim_records_with_dsps(prisma: Prisma, max_records: int | None = None):
@@ -22,3 +22,20 @@ async def load_dkim_records_with_dsps(prisma: Prisma, max_records: int | None =
 			break
 		cursor = {'id': new_records[-1].id}
 	return records
+
+
+async def iter_dkim_records_with_dsps(prisma: Prisma, order_by_key_data: bool = False, take: int = 50000) -> AsyncIterator[DkimRecord]:
+	# like load_dkim_records_with_dsps, but yields the records page by page instead of loading all of them into memory
+	cursor: Optional[DkimRecordWhereUniqueInput] = None
+	order: list[dict[str, str]] = [{'keyData': 'asc'}, {'id': 'asc'}] if order_by_key_data else [{'id': 'asc'}]
+	fetched = 0
+	while True:
+		skip = 0 if cursor is None else 1
+		new_records = await prisma.dkimrecord.find_many(take=take, include={'domainSelectorPair': True}, cursor=cursor, skip=skip, order=order)  # type: ignore
+		if len(new_records) == 0:
+			break
+		fetched += len(new_records)
+		logging.info(f'fetched {fetched} records')
+		for record in new_records:
+			yield record
+		cursor = {'id': new_records[-1].id}
@@ -0,0 +1,179 @@
+# DNS TXT record cache shared by the util tools
+#
+# Results are kept in a bounded in-memory LRU and in an SQLite database on disk, so that re-running an analysis on the same corpus
+# does not query the same names again. Positive answers are kept for the TTL of the record.
+# Set `min_ttl` to keep them for at least that many seconds, for offline re-analysis runs that should not see changes in DNS.
+# Negative answers (NXDOMAIN, no TXT records) are kept for `negative_ttl` seconds.
+# Transient errors (timeouts, no reachable name servers) are never cached.
+
+import collections
+import logging
+import pickle
+import sqlite3
+import time
+from dataclasses import asdict, dataclass
+import dns.asyncresolver
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+from pubkey_finder.lib import metrics
+
+default_cache_file = 'dns_cache.sqlite3'
+
+TxtRecords = list[bytes]
+
+# number of writes to the database between each commit
+commit_interval = 1000
+
+
+@dataclass
+class DnsCacheStats:
+	memory_hits: int = 0
+	disk_hits: int = 0
+	negative_hits: int = 0
+	misses: int = 0
+	transient_errors: int = 0
+
+
+def normalize_qname(qname: str) -> str:
+	return qname.rstrip('.').lower()
+
+
+def answer_to_records(answer: dns.resolver.Answer) -> tuple[TxtRecords, int]:
+	records = [b''.join(rdata.strings) for rdata in answer]  # type: ignore
+	ttl = answer.rrset.ttl if answer.rrset is not None else 0
+	return records, ttl
+
+
+def query_txt(resolver: dns.resolver.Resolver, qname: str) -> tuple[TxtRecords | None, int]:
+	# return the TXT records of qname and their TTL, or None if the name has no TXT records
+	# raises dns.resolver.NoNameservers or dns.exception.Timeout on transient errors
+	try:
+		return answer_to_records(resolver.resolve(qname, dns.rdatatype.TXT))
+	except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+		return None, 0
+
+
+async def query_txt_async(resolver: dns.asyncresolver.Resolver, qname: str) -> tuple[TxtRecords | None, int]:
+	try:
+		return answer_to_records(await resolver.resolve(qname, dns.rdatatype.TXT))
+	except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+		return None, 0
+
+
+class DnsCache:
+	def __init__(self, filename: str | None = default_cache_file, max_memory_entries: int = 100000, min_ttl: int = 0, negative_ttl: int = 24 * 3600, timeout: float = 5):
+		self.max_memory_entries = max_memory_entries
+		self.min_ttl = min_ttl
+		self.negative_ttl = negative_ttl
+		self.memory: collections.OrderedDict[str, tuple[float, TxtRecords | None]] = collections.OrderedDict()
+		self.stats = DnsCacheStats()
+		self.pending_writes = 0
+		self.resolver = dns.resolver.Resolver()
+		self.resolver.timeout = timeout
+		self.resolver.lifetime = timeout
+		self.async_resolver = dns.asyncresolver.Resolver()
+		self.async_resolver.timeout = timeout
+		self.async_resolver.lifetime = timeout
+		self.db: sqlite3.Connection | None = None
+		if filename:
+			self.db = sqlite3.connect(filename)
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS txt_records (qname TEXT PRIMARY KEY, records BLOB, expires_at REAL NOT NULL)')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_args: object):
+		self.close()
+
+	def close(self):
+		if self.db is not None:
+			self.db.commit()
+			self.db.close()
+			self.db = None
+		self.log_stats()
+		for name, value in asdict(self.stats).items():
+			metrics.increment(f'dns_cache_{name}', value)
+		self.stats = DnsCacheStats()
+
+	def log_stats(self):
+		logging.info(f'dns cache: {self.stats}')
+
+	def remember(self, qname: str, expires_at: float, records: TxtRecords | None):
+		self.memory[qname] = (expires_at, records)
+		self.memory.move_to_end(qname)
+		if len(self.memory) > self.max_memory_entries:
+			self.memory.popitem(last=False)
+
+	def lookup(self, qname: str) -> tuple[bool, TxtRecords | None]:
+		now = time.time()
+		entry = self.memory.get(qname)
+		if entry is not None and entry[0] > now:
+			self.memory.move_to_end(qname)
+			self.stats.memory_hits += 1
+			return True, entry[1]
+		if self.db is not None:
+			row = self.db.execute('SELECT records, expires_at FROM txt_records WHERE qname = ?', (qname, )).fetchone()
+			if row is not None and row[1] > now:
+				records = pickle.loads(row[0]) if row[0] is not None else None
+				self.remember(qname, row[1], records)
+				self.stats.disk_hits += 1
+				return True, records
+		return False, None
+
+	def store(self, qname: str, records: TxtRecords | None, ttl: int):
+		ttl = max(ttl, self.min_ttl) if records is not None else self.negative_ttl
+		expires_at = time.time() + ttl
+		self.remember(qname, expires_at, records)
+		if self.db is not None:
+			data = pickle.dumps(records) if records is not None else None
+			self.db.execute('INSERT OR REPLACE INTO txt_records (qname, records, expires_at) VALUES (?, ?, ?)', (qname, data, expires_at))
+			self.pending_writes += 1
+			if self.pending_writes >= commit_interval:
+				self.db.commit()
+				self.pending_writes = 0
+
+	def cached(self, qname: str) -> tuple[bool, TxtRecords | None]:
+		found, records = self.lookup(qname)
+		if found:
+			if records is None:
+				self.stats.negative_hits += 1
+		else:
+			self.stats.misses += 1
+		return found, records
+
+	def resolve_txt(self, qname: str) -> TxtRecords | None:
+		qname = normalize_qname(qname)
+		found, records = self.cached(qname)
+		if found:
+			return records
+		try:
+			with metrics.timer('dns_query'):
+				records, ttl = query_txt(self.resolver, qname)
+		except (dns.resolver.NoNameservers, dns.exception.Timeout) as e:
+			logging.debug(f'dns resolver error: {e}')
+			self.stats.transient_errors += 1
+			return None
+		self.store(qname, records, ttl)
+		return records
+
+	async def resolve_txt_async(self, qname: str) -> TxtRecords | None:
+		qname = normalize_qname(qname)
+		found, records = self.cached(qname)
+		if found:
+			return records
+		try:
+			with metrics.timer('dns_query'):
+				records, ttl = await query_txt_async(self.async_resolver, qname)
+		except (dns.resolver.NoNameservers, dns.exception.Timeout) as e:
+			logging.debug(f'dns resolver error: {e}')
+			self.stats.transient_errors += 1
+			return None
+		self.store(qname, records, ttl)
+		return records
+
+	def dnsfunc(self, qname: bytes, timeout: int = 5) -> bytes | None:
+		# drop-in replacement for the dnsfunc parameter of dkim.verify, which expects the first TXT record for the name
+		records = self.resolve_txt(qname.decode())
+		return records[0] if records else None
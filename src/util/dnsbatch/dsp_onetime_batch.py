@@ -12,13 +12,21 @@
 # example local run:
 # python dsp_onetime_batch.py --domains-filename domains.txt --selectors-filename selectors.txt > output.txt
 #
+# example local run, with DNS results cached between runs:
+# python dsp_onetime_batch.py --domains-filename domains.txt --selectors-filename selectors.txt --dns-cache-file dns_cache.sqlite3 > output.txt
+#
 
 import argparse
 import datetime
+import os
 import sys
 import time
+from typing import Any
 import modal
 
+# the metrics module is only available for local runs, the remote image only includes this file
+metrics: Any = None
+
 stub = modal.Stub("dsp-onetime-batch")
 dns_image = (modal.Image.debian_slim(python_version="3.10").pip_install("dnspython"))
 
@@ -39,45 +47,54 @@ def parse_tags(txtData: str) -> dict[str, str]:
 	return dkimData
 
 
-def resolve_qname(domain: str, selector: str):
+def query_txt_records(qname: str) -> list[bytes] | None:
 	import dns.exception
 	import dns.resolver
 	import dns.rdatatype
 
-	qname = f"{selector}._domainkey.{domain}"
-
 	try:
 		response = dns.resolver.resolve(qname, dns.rdatatype.TXT)
-		if len(response) == 0:
-			#print(f'warning: no records found for {qname}')
-			return
-		txtData = ""
-		for i in range(len(response)):
-			txtData += b''.join(response[i].strings).decode()  # type: ignore
-			txtData += ";"
-		tags = parse_tags(txtData)
-		if 'p' not in tags:
-			#print(f'warning: no p= tag found for {qname}, {txtData}')
-			return
-		if tags['p'] == "":
-			#print(f'warning: empty p= tag found for {qname}, {txtData}')
-			return
-		if tags['p'] in ["reject", "none"]:
-			#print(f'info: p=reject found for {qname}, {txtData}')
-			return
-		if len(tags['p']) < 10:
-			print(f'# short p= tag found for {qname}, {txtData}\n')
-			return
-		tsv_row = f'DNS_BATCH_RESULT,{domain},{selector},{txtData}\n'  # extra newline at the end as a workaround for that the stdout from modal.com somtimes has merged lines if there is just one newline
-		print(tsv_row)
+		return [b''.join(response[i].strings) for i in range(len(response))]  # type: ignore
 	except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers, dns.exception.Timeout) as _e:
 		#print(f'warning: dns resolver error: {e}')
-		pass
+		return None
+
 
+def resolve_qname(domain: str, selector: str, dns_cache: Any = None):
+	qname = f"{selector}._domainkey.{domain}"
 
-def process_domain(domain: str, selectors: list[str]):
+	records = dns_cache.resolve_txt(qname) if dns_cache is not None else query_txt_records(qname)
+	if metrics is not None:
+		metrics.increment('dsp_onetime_batch_queries')
+		if records:
+			metrics.increment('dsp_onetime_batch_txt_records_found')
+	if not records:
+		#print(f'warning: no records found for {qname}')
+		return
+	txtData = ""
+	for record in records:
+		txtData += record.decode()
+		txtData += ";"
+	tags = parse_tags(txtData)
+	if 'p' not in tags:
+		#print(f'warning: no p= tag found for {qname}, {txtData}')
+		return
+	if tags['p'] == "":
+		#print(f'warning: empty p= tag found for {qname}, {txtData}')
+		return
+	if tags['p'] in ["reject", "none"]:
+		#print(f'info: p=reject found for {qname}, {txtData}')
+		return
+	if len(tags['p']) < 10:
+		print(f'# short p= tag found for {qname}, {txtData}\n')
+		return
+	tsv_row = f'DNS_BATCH_RESULT,{domain},{selector},{txtData}\n'  # extra newline at the end as a workaround for that the stdout from modal.com somtimes has merged lines if there is just one newline
+	print(tsv_row)
+
+
+def process_domain(domain: str, selectors: list[str], dns_cache: Any = None):
 	for selector in selectors:
-		resolve_qname(domain, selector)
+		resolve_qname(domain, selector, dns_cache)
 
 
 @stub.function(image=dns_image)  # type: ignore
@@ -85,7 +102,7 @@ def process_domain_wrapper(domain: str, selectors: list[str]):
 	process_domain(domain, selectors)
 
 
-def run_batch_job(domains_filename: str, selectors_filename: str, *, local: bool = False, sparse: bool = False):
+def run_batch_job(domains_filename: str, selectors_filename: str, *, local: bool = False, sparse: bool = False, dns_cache: Any = None):
 	with open(selectors_filename) as f:
 		selectors = f.read().splitlines()
 	with open(domains_filename) as f:
@@ -99,7 +116,7 @@ def run_batch_job(domains_filename: str, selectors_filename: str, *, local: bool
 		time_left_hrs = ((len(domains) - index) * elapsed_hrs / index) if index > 0 else 0
 		print(f"processing domain {index}, elapsed: {elapsed_hrs:.2f}, time left: {time_left_hrs:.2f} hours, {domain}", file=sys.stderr)
 		if local:
-			process_domain(domain, selectors)
+			process_domain(domain, selectors, dns_cache)
 		else:
 			process_domain_wrapper.spawn(domain, selectors)
 
@@ -115,5 +132,19 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--domains-filename', type=str)
 	parser.add_argument('--selectors-filename', type=str)
+	parser.add_argument('--dns-cache-file', type=str, help='cache DNS results in this SQLite file, so that a rerun does not query the same names again')
+	parser.add_argument('--dns-min-ttl',
+	                    type=int,
+	                    default=0,
+	                    help='keep positive results in --dns-cache-file for at least this many seconds instead of the TTL of the record, for reruns on the same input')
 	args = parser.parse_args()
-	run_batch_job(args.domains_filename, args.selectors_filename, local=True)
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+	from pubkey_finder.lib import metrics
+	metrics.enable_export('dsp_onetime_batch')
+	if args.dns_cache_file:
+		# the cache is only available for local runs, the remote image only includes this file
+		from dns_cache import DnsCache
+		with DnsCache(args.dns_cache_file, min_ttl=args.dns_min_ttl) as dns_cache:
+			run_batch_job(args.domains_filename, args.selectors_filename, local=True, dns_cache=dns_cache)
+	else:
+		run_batch_job(args.domains_filename, args.selectors_filename, local=True)
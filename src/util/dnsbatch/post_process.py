@@ -1,52 +1,145 @@
 #!.venv/bin/python
 # post-processing tool for the log output of dsp_onetime_batch.py
+#
+# The log files from a full sweep can be tens of GB, so the results are never held in memory at once.
+# Each log file is split (in parallel, one process per log file) into sorted runs of unique "domain<TAB>selector" lines,
+# which are written to a temporary directory. The runs are then merged, so that all selectors of a domain arrive together,
+# and each domain can be counted, filtered and written to the TSV output before moving on to the next one.
 
 import argparse
-from typing import TextIO
+import heapq
+import itertools
+import multiprocessing
+import os
+import tempfile
+from typing import Callable, Iterable, Iterator, TextIO
 
+# Some domains repond to every call to <selector>._domainkey.example.com,
+# regardless of the selector value, which results in 1000s of results per domain.
+# The current statistics show that the domains with the most "real" selectors
+# have about 30 selectors, so we filter out domains with more than 100 selectors:
+max_selectors_per_domain = 100
 
-def post_process(logfiles: list[TextIO], tsv_output: TextIO, print_selectors_per_domain: bool, print_selector_count: bool):
+# maximum number of run files that are opened at the same time when merging
+max_open_runs = 256
+
+SortKey = Callable[[str], int] | None
+
+
+def write_run(lines: Iterable[str], tmpdir: str) -> str:
+	fd, path = tempfile.mkstemp(dir=tmpdir, suffix='.run')
+	with os.fdopen(fd, 'w') as f:
+		for line in lines:
+			f.write(f'{line}\n')
+	return path
+
+
+def read_run(path: str) -> Iterator[str]:
+	with open(path) as f:
+		for line in f:
+			yield line.rstrip('\n')
+
+
+def merge_runs(runs: list[str], key: SortKey = None, reverse: bool = False) -> Iterator[str]:
+	return heapq.merge(*(read_run(run) for run in runs), key=key, reverse=reverse)
+
+
+def reduce_runs(runs: list[str], tmpdir: str, key: SortKey = None, reverse: bool = False) -> list[str]:
+	# merge groups of runs into larger runs until all of them can be opened at the same time
+	while len(runs) > max_open_runs:
+		merged_runs: list[str] = []
+		for i in range(0, len(runs), max_open_runs):
+			group = runs[i:i + max_open_runs]
+			merged_runs.append(write_run(merge_runs(group, key, reverse), tmpdir))
+			for run in group:
+				os.remove(run)
+		runs = merged_runs
+	return runs
+
+
+def sorted_runs(lines: Iterable[str], tmpdir: str, run_size: int, key: SortKey = None, reverse: bool = False) -> list[str]:
+	runs: list[str] = []
+	chunk: list[str] = []
+	for line in lines:
+		chunk.append(line)
+		if len(chunk) >= run_size:
+			runs.append(write_run(sorted(chunk, key=key, reverse=reverse), tmpdir))
+			chunk = []
+	if chunk:
+		runs.append(write_run(sorted(chunk, key=key, reverse=reverse), tmpdir))
+	return runs
+
+
+def split_logfile(logfile: str, tmpdir: str, run_size: int) -> tuple[list[str], dict[str, int]]:
+	# "domain<TAB>selector" lines sort by domain first, since the tab character sorts before any character allowed in a domain name
+	# the selectors are counted here, for each log line, because the runs only contain unique domain/selector pairs
+	runs: list[str] = []
+	dsps: set[str] = set()
 	selector_count: dict[str, int] = {}
-	selectors_per_domain: dict[str, set[str]] = {}
-	dsp_list: list[tuple[str, str]] = []
-	for f in logfiles:
+	with open(logfile) as f:
 		for line in f:
 			line = line.strip()
 			if not line.startswith("DNS_BATCH_RESULT,"):
 				continue
-			_, domain, selector, _ = line.strip().split(",", maxsplit=3)
-			dsp_list.append((domain, selector))
-
-			if selector in selector_count:
-				selector_count[selector] += 1
-			else:
-				selector_count[selector] = 1
-
-			if domain in selectors_per_domain:
-				selectors_per_domain[domain].add(selector)
-			else:
-				selectors_per_domain[domain] = {selector}
-	filtered_domains: set[str] = set()
-
-	selectors_per_domain = dict(sorted(selectors_per_domain.items(), key=lambda item: len(item[1]), reverse=True))
-	for domain, selectors in selectors_per_domain.items():
-		if print_selectors_per_domain:
-			print(f"{domain} {len(selectors)}")
+			_, domain, selector, _ = line.split(",", maxsplit=3)
+			dsps.add(f'{domain}\t{selector}')
+			selector_count[selector] = selector_count.get(selector, 0) + 1
+			if len(dsps) >= run_size:
+				runs.append(write_run(sorted(dsps), tmpdir))
+				dsps = set()
+	if dsps:
+		runs.append(write_run(sorted(dsps), tmpdir))
+	return runs, selector_count
+
+
+def selectors_per_domain(runs: list[str]) -> Iterator[tuple[str, list[str]]]:
+	unique_dsps = (dsp for dsp, _group in itertools.groupby(merge_runs(runs)))
+	split_dsps = (dsp.split('\t', 1) for dsp in unique_dsps)
+	for domain, group in itertools.groupby(split_dsps, key=lambda dsp: dsp[0]):
+		yield domain, [selector for _domain, selector in group]
+
 
-		# Some domains repond to every call to <selector>._domainkey.example.com,
-		# regardless of the selector value, which results in 1000s of results per domain.
-		# The current statistics show that the domains with the most "real" selectors
-		# have about 30 selectors, so we filter out domains with more than 100 selectors:
-		if len(selectors) > 100:
-			filtered_domains.add(domain)
+def domain_count_key(line: str) -> int:
+	return int(line.split('\t', 1)[0])
 
-	selectors_per_domain = {k: v for k, v in selectors_per_domain.items() if k not in filtered_domains}
 
-	# remove filtered domains from dsp_list
-	dsp_list = [(domain, selector) for domain, selector in dsp_list if domain not in filtered_domains]
+def post_process(logfiles: list[str], tsv_output: TextIO | None, print_selectors_per_domain: bool, print_selector_count: bool, processes: int, run_size: int):
+	selector_count: dict[str, int] = {}
+	total_domains = 0
+	total_selectors = 0
+	with tempfile.TemporaryDirectory() as tmpdir:
+		with multiprocessing.Pool(processes) as pool:
+			results = pool.starmap(split_logfile, [(logfile, tmpdir, run_size) for logfile in logfiles])
+		runs = reduce_runs(list(itertools.chain(*(logfile_runs for logfile_runs, _ in results))), tmpdir)
+		for _, logfile_selector_count in results:
+			for selector, count in logfile_selector_count.items():
+				selector_count[selector] = selector_count.get(selector, 0) + count
+
+		domain_counts: list[str] = []
+		count_runs: list[str] = []
+		for domain, selectors in selectors_per_domain(runs):
+			if print_selectors_per_domain:
+				domain_counts.append(f'{len(selectors)}\t{domain}')
+				if len(domain_counts) >= run_size:
+					count_runs.extend(sorted_runs(domain_counts, tmpdir, run_size, key=domain_count_key, reverse=True))
+					domain_counts = []
+			if len(selectors) > max_selectors_per_domain:
+				continue
+			total_domains += 1
+			total_selectors += len(selectors)
+			if tsv_output:
+				for selector in selectors:
+					print(f"{domain}\t{selector}", file=tsv_output)
+
+		if print_selectors_per_domain:
+			count_runs.extend(sorted_runs(domain_counts, tmpdir, run_size, key=domain_count_key, reverse=True))
+			count_runs = reduce_runs(count_runs, tmpdir, key=domain_count_key, reverse=True)
+			for line in merge_runs(count_runs, key=domain_count_key, reverse=True):
+				count, domain = line.split('\t', 1)
+				print(f"{domain} {count}")
 
 	# calculate average number of selectors per domain
-	average_selectors_per_domain = sum(len(selectors) for selectors in selectors_per_domain.values()) / len(selectors_per_domain)
+	average_selectors_per_domain = total_selectors / total_domains if total_domains else 0
 	print(f"Average number of selectors per domain: {average_selectors_per_domain}")
 
 	if print_selector_count:
@@ -54,19 +147,16 @@ def post_process(logfiles: list[TextIO], tsv_output: TextIO, print_selectors_per
 		selector_count = dict(sorted(selector_count.items(), key=lambda item: item[1], reverse=True))
 		for selector, count in selector_count.items():
 			print(f"{selector} {count}")
-			pass
-
-	if tsv_output:
-		for domain, selector in dsp_list:
-			print(f"{domain}\t{selector}", file=tsv_output)
 
 
 # local entrypoint
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
-	parser.add_argument('logfiles', type=argparse.FileType('r'), nargs='+')
+	parser.add_argument('logfiles', type=str, nargs='+')
 	parser.add_argument('--tsv-output', type=argparse.FileType('w'))
 	parser.add_argument('--print-selectors-per-domain', action='store_true')
 	parser.add_argument('--print-selector-count', action='store_true')
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of log files to split into sorted runs in parallel')
+	parser.add_argument('--run-size', type=int, default=1000000, help='number of lines per sorted run, limits the memory usage of each process')
 	args = parser.parse_args()
-	post_process(args.logfiles, args.tsv_output, args.print_selectors_per_domain, args.print_selector_count)
+	post_process(args.logfiles, args.tsv_output, args.print_selectors_per_domain, args.print_selector_count, args.processes, args.run_size)
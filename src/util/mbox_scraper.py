@@ -1,44 +1,72 @@
 import argparse
+import glob
+import os
 import sys
-import mailbox
+from dataclasses import dataclass, field
 
-from dkim_util import decode_dkim_tag_value_list
+from dkim_util import DecodeTvlException, decode_dkim_tag_value_list
+from pubkey_finder.lib.mbox_scanner import Collector, ScannedMessage, scan_mbox_files
 
 
-def add_to_dict(dct: dict[str, list[str]], domain: str, selector: str):
+def add_to_dict(dct: dict[str, set[str]], domain: str, selector: str):
 	if (not selector) or (not domain):
 		return
 	if domain not in dct:
-		dct[domain] = []
-	if selector not in dct[domain]:
-		dct[domain].append(selector)
+		dct[domain] = set()
+	dct[domain].add(selector)
 
 
-def get_domain_selectors(outputDict: dict[str, list[str]], mboxFile: str):
-	print(f'processing {mboxFile}', file=sys.stderr)
-	for message in mailbox.mbox(mboxFile):
-		dkimSignatures = message.get_all('DKIM-Signature')
+@dataclass
+class DomainSelectorsCollector(Collector):
+	domainSelectors: dict[str, set[str]] = field(default_factory=dict)
+
+	def collect(self, msg: ScannedMessage):
+		dkimSignatures = msg.headers.get_all('DKIM-Signature')
 		if not dkimSignatures:
-			continue
+			return
 		for dkimSignature in dkimSignatures:
-			dkimRecord = decode_dkim_tag_value_list(dkimSignature)
-			domain = dkimRecord['d']
-			selector = dkimRecord['s']
-			add_to_dict(outputDict, domain, selector)
+			try:
+				dkimRecord = decode_dkim_tag_value_list(dkimSignature)
+			except DecodeTvlException:
+				continue
+			domain = dkimRecord.get('d', '')
+			selector = dkimRecord.get('s', '')
+			add_to_dict(self.domainSelectors, domain, selector)
+
+	def merge(self, other: 'DomainSelectorsCollector'):
+		for domain, selectors in other.domainSelectors.items():
+			if domain not in self.domainSelectors:
+				self.domainSelectors[domain] = selectors
+			else:
+				self.domainSelectors[domain] |= selectors
+
+
+def expand_mbox_files(patterns: list[str]) -> list[str]:
+	mboxFiles: dict[str, None] = {}
+	for pattern in patterns:
+		matches = sorted(glob.glob(pattern, recursive=True))
+		if not matches:
+			print(f'warning: no files found for {pattern}', file=sys.stderr)
+		for match in matches:
+			mboxFiles[match] = None
+	return list(mboxFiles)
 
 
 def main():
-	parser = argparse.ArgumentParser(description='extract domains and selectors from the DKIM-Signature header fields in an mbox file and output them in TSV format')
-	parser.add_argument('mbox_file')
+	parser = argparse.ArgumentParser(description='extract domains and selectors from the DKIM-Signature header fields in mbox files and output them in TSV format')
+	parser.add_argument('mbox_files', nargs='+', help='mbox files or glob patterns, such as "exports/**/*.mbox"')
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes that scan the mbox files')
 	args = parser.parse_args()
-	domainSelectorsDict: dict[str, list[str]] = {}
-	get_domain_selectors(domainSelectorsDict, args.mbox_file)
-	domainSelectorsDict = dict(sorted(domainSelectorsDict.items()))
-	for domain, selectors in domainSelectorsDict.items():
+	mboxFiles = expand_mbox_files(args.mbox_files)
+	print(f'processing {len(mboxFiles)} mbox files', file=sys.stderr)
+	collector = scan_mbox_files(mboxFiles, [DomainSelectorsCollector], args.processes)[0]
+	assert isinstance(collector, DomainSelectorsCollector)
+	domainSelectorsDict = collector.domainSelectors
+	for domain in sorted(domainSelectorsDict):
 		if '\t' in domain:
 			print(f'warning: domain {domain} includes a tab character, skipping', file=sys.stderr)
 			continue
-		for selector in selectors:
+		for selector in sorted(domainSelectorsDict[domain]):
 			if '\t' in selector:
 				print(f'warning: selector {selector} includes a tab character, skipping', file=sys.stderr)
 				continue
@@ -13,6 +13,7 @@ from prisma import Prisma
 from tqdm import tqdm
 from dkim_util import decode_dkim_tag_value_list
 from db_util import load_dkim_records_with_dsps
+from pubkey_finder.lib import metrics
 
 
 class CommandException(Exception):
@@ -26,6 +27,8 @@ class CommandException(Exception):
 tsv_queue: "queue.Queue[tuple[int, str]]" = queue.Queue(maxsize=10)
 out_queue: "queue.Queue[tuple[int, str]]" = queue.Queue(maxsize=10)
 stop_event = threading.Event()
+# (domain, selector) by DkimRecord id, for --with-dsps
+record_dsps: dict[int, tuple[str, str]] = {}
 
 
 def run_command(command: list[str], input: bytes) -> str:
@@ -70,10 +73,12 @@ def read_and_resolve_worker():
 		try:
 			db_id, dkim_tvl = tsv_queue.get(block=True, timeout=0.2)
 			try:
-				rsa_modulus = get_rsa_modulus(dkim_tvl)
+				with metrics.timer('get_rsa_modulus'):
+					rsa_modulus = get_rsa_modulus(dkim_tvl)
 				if rsa_modulus is not None:
 					out_queue.put((db_id, rsa_modulus))
 			except Exception as e:
+				metrics.increment('modulus_extractor_errors')
 				errstr = f'{e}'.replace('\n', '\\n')
 				logging.debug(f'{db_id}\t{e.__class__.__name__}: {errstr}')
 			tsv_queue.task_done()
@@ -82,16 +87,23 @@ def read_and_resolve_worker():
 
 
 def write_worker():
+	# with --with-dsps, a modulus is written once for each domain/selector pair
 	unique_moduli: set[str] = set()
+	unique_rows: set[tuple[str, tuple[str, str] | None]] = set()
 	duplicates = 0
 	while not stop_event.is_set():
 		try:
 			db_id, rsa_modulus = out_queue.get(block=True, timeout=0.2)
-			if rsa_modulus not in unique_moduli:
-				unique_moduli.add(rsa_modulus)
-				print(f'{db_id},{rsa_modulus}')
+			dsp = record_dsps.get(db_id)
+			if (rsa_modulus, dsp) not in unique_rows:
+				unique_rows.add((rsa_modulus, dsp))
+				print(f'{db_id},{rsa_modulus},{dsp[0]},{dsp[1]}' if dsp else f'{db_id},{rsa_modulus}')
+				if rsa_modulus not in unique_moduli:
+					unique_moduli.add(rsa_modulus)
+					metrics.increment('modulus_extractor_unique_moduli')
 			else:
 				duplicates += 1
+				metrics.increment('modulus_extractor_duplicates')
 			out_queue.task_done()
 		except queue.Empty:
 			pass
@@ -132,9 +144,13 @@ async def post_process(csvFile: TextIO, prisma: Prisma):
 		print()
 
 
-async def extract_moduli(prisma: Prisma):
+async def extract_moduli(prisma: Prisma, with_dsps: bool):
 	logging.info('fetching records')
 	records = await load_dkim_records_with_dsps(prisma)
+	if with_dsps:
+		for record in records:
+			if record.domainSelectorPair is not None:
+				record_dsps[record.id] = (record.domainSelectorPair.domain, record.domainSelectorPair.selector)
 
 	await prisma.disconnect()
 
@@ -161,8 +177,13 @@ async def main():
 	    'Extract RSA moduli from DKIM records and output them as CSV with columns: id, modulus. Alternatively, post process a CSV file with columns: id, factor_p, factor_q and check if the factors are correct for the modulus in the database.'
 	)
 	argparser.add_argument('--extract-moduli', action='store_true', help='extract RSA moduli from DKIM records and output them to standard output as CSV with columns: id, modulus')
+	argparser.add_argument(
+	    '--with-dsps',
+	    action='store_true',
+	    help='use together with --extract-moduli to add the columns: domain, selector, with one row per modulus and domain/selector pair, for find_public_keys.py --known-keys-csv')
 	argparser.add_argument('--post-process', type=argparse.FileType('r'), help='post process a CSV file with columns: id, factor_p, factor_q')
 	args = argparser.parse_args()
+	metrics.enable_export('modulus_extractor')
 
 	prisma = Prisma()
 	await prisma.connect()
@@ -170,7 +191,7 @@ async def main():
 	if args.post_process:
 		await post_process(args.post_process, prisma)
 	elif args.extract_moduli:
-		await extract_moduli(prisma)
+		await extract_moduli(prisma, args.with_dsps)
 	else:
 		raise ValueError('either --extract-moduli or --post-process must be specified')
 
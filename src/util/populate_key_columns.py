@@ -13,6 +13,7 @@ from prisma.types import DkimRecordWhereUniqueInput
 from prisma.types import DkimRecordWhereInput
 from tqdm import tqdm
 from dkim_util import DecodeTvlException, decode_dkim_tag_value_list
+from pubkey_finder.lib import metrics
 
 
 class Asn1ParseException(Exception):
@@ -99,14 +100,20 @@ def verify_dkim_tvl(tvl: str) -> KeyInfo:
 async def process_record(record: DkimRecord, prisma: Prisma):
 	if record.keyType is not None and record.keyData is not None:
 		logging.debug(f'skipping record {record.id} because it already has a key')
+		metrics.increment('populate_key_columns_skipped')
 		return
 	try:
-		rsa_key = verify_dkim_tvl(record.value)
+		with metrics.timer('verify_dkim_tvl'):
+			rsa_key = verify_dkim_tvl(record.value)
 		if rsa_key.key_data_base64 is not None:
 			await prisma.dkimrecord.update(where={'id': record.id}, data={'keyType': rsa_key.key_type, 'keyData': rsa_key.key_data_base64})
+			metrics.increment('populate_key_columns_updated')
 	except Exception as e:
 		if isinstance(e, TagsNotPresentException) or isinstance(e, Asn1ParseException) or isinstance(e, Base64DecodeException) or isinstance(e, DecodeTvlException):
 			await prisma.dkimrecord.update(where={'id': record.id}, data={'keyData': '-'})
+			metrics.increment('populate_key_columns_invalid')
+		else:
+			metrics.increment('populate_key_columns_errors')
 		errstr = f'{e}'.replace('\n', '\\n')
 		logging.debug(f'record id {record.id}: {e.__class__.__name__}: {errstr}')
 
@@ -125,6 +132,7 @@ async def main(loop: asyncio.AbstractEventLoop):
 	workers = [loop.create_task(download_worker(q, prisma)) for _ in range(20)]
 	logging.basicConfig(level=logging.INFO)
 	logging.getLogger("httpx").setLevel(logging.WARNING)
+	metrics.enable_export('populate_key_columns')
 
 	cursor: Optional[DkimRecordWhereUniqueInput] = None
 
@@ -1,75 +1,99 @@
 import sys
 import argparse
+import multiprocessing
+import os
 import pypff
 import email.parser
-from dataclasses import dataclass
-from typing import cast
-from dkim_util import decode_dkim_tag_value_list
+from dkim_util import DecodeTvlException, decode_dkim_tag_value_list
+from pubkey_finder.lib.util import ProgressReporter
 
+# the path to a folder from the root folder, as a list of sub folder indices
+FolderPath = tuple[int, ...]
 
-@dataclass
-class Property:
-	entry_type: int
-	value_type: int
+# the number of messages that a worker process reads per task
+batch_size = 200
 
-	def match(self, entry_type: int, value_type: int):
-		return self.entry_type == entry_type and self.value_type == value_type
+# the PST file opened by each worker process, see open_pst_file
+pst_file = None
 
 
-# https://github.com/libyal/libfmapi/blob/main/documentation/MAPI%20definitions.asciidoc
-PR_TRANSPORT_MESSAGE_HEADERS = Property(0x007d, 0x001f)
-
-dsps: set[str] = set()
-
-
-def parse_header(data: str):
+def parse_header(data: str, dsps: set[str]):
 	h = email.parser.HeaderParser().parsestr(data)
 	dkim_fields = h.get_all('DKIM-Signature')
 	if not dkim_fields:
 		return
 	for dkim_field in dkim_fields:
-		dkimRecord = decode_dkim_tag_value_list(dkim_field)
-		domain = dkimRecord['d']
-		selector = dkimRecord['s']
-		dsps.add(f'{domain}\t{selector}')
-
-
-def parse_message(msg):
-	for record_set in msg.record_sets:
-		for entry in record_set.entries:
-			if (PR_TRANSPORT_MESSAGE_HEADERS.match(entry.get_entry_type(), entry.get_value_type())):
-				unicode16_data = cast(bytes, entry.get_data())
-				header_data = unicode16_data.decode('utf-16')
-				parse_header(header_data)
-
-
-def parse_item(index: int, item, depth: int):
-	indent = '    ' * depth
-	if isinstance(item, pypff.message):
-		print(f'{indent}{type(item)} {index}: "{item.subject}"', file=sys.stderr)
-		parse_message(item)
-	else:
-		if isinstance(item, pypff.folder):
-			print(f'{indent}{type(item)} {index}: "{item.name}"', file=sys.stderr)
-		else:
-			print(f'{indent}{type(item)} {index}', file=sys.stderr)
-		if hasattr(item, 'sub_items') and item.sub_items is not None:
-			for i in range(len(item.sub_items)):
-				sub_item = item.sub_items[i]
-				parse_item(i, sub_item, depth + 1)
+		try:
+			dkimRecord = decode_dkim_tag_value_list(dkim_field)
+		except DecodeTvlException:
+			continue
+		domain = dkimRecord.get('d')
+		selector = dkimRecord.get('s')
+		if domain and selector:
+			dsps.add(f'{domain}\t{selector}')
+
+
+def find_message_batches(folder, path: FolderPath, batches: list[tuple[FolderPath, int, int]]):
+	# enumerate the messages of each folder as (folder path, start index, stop index) batches, without reading the messages
+	number_of_messages = folder.get_number_of_sub_messages()
+	for start in range(0, number_of_messages, batch_size):
+		batches.append((path, start, min(start + batch_size, number_of_messages)))
+	for i in range(folder.get_number_of_sub_folders()):
+		find_message_batches(folder.get_sub_folder(i), path + (i, ), batches)
+
+
+def open_pst_file(filename: str):
+	global pst_file
+	pst_file = pypff.file()
+	pst_file.open(filename)
+
+
+def extract_dsps(batch: tuple[FolderPath, int, int]) -> tuple[int, set[str], int]:
+	path, start, stop = batch
+	folder = pst_file.get_root_folder()  # type: ignore
+	for i in path:
+		folder = folder.get_sub_folder(i)
+	dsps: set[str] = set()
+	errors = 0
+	for i in range(start, stop):
+		try:
+			# only the transport headers property is read, not the body, attachments or other properties
+			header_data = folder.get_sub_message(i).get_transport_headers()
+		except (IOError, OSError):
+			errors += 1
+			continue
+		if header_data:
+			parse_header(header_data, dsps)
+	return stop - start, dsps, errors
 
 
 def decode_pst():
 	parser = argparse.ArgumentParser(description='extract domains and selectors from the DKIM-Signature header fields in a PST file and output them in TSV format')
 	parser.add_argument('pst_file')
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes that read messages from the PST file')
 	args = parser.parse_args()
 	pst = pypff.file()
 	pst.open(args.pst_file)
-	parse_item(0, pst.get_root_folder(), 0)
+	batches: list[tuple[FolderPath, int, int]] = []
+	find_message_batches(pst.get_root_folder(), (), batches)
 	pst.close()
+	total = sum(stop - start for _path, start, stop in batches)
+	print(f'found {total} messages', file=sys.stderr)
+
+	dsps: set[str] = set()
+	errors = 0
+	progressReporter = ProgressReporter(total, 0, file=sys.stderr)
+	with multiprocessing.Pool(args.processes, initializer=open_pst_file, initargs=(args.pst_file, )) as pool:
+		for count, batch_dsps, batch_errors in pool.imap_unordered(extract_dsps, batches):
+			dsps |= batch_dsps
+			errors += batch_errors
+			progressReporter.increment(count)
+	print(file=sys.stderr)
+	if errors:
+		print(f'warning: {errors} messages could not be read', file=sys.stderr)
+	for dsp in sorted(dsps):
+		print(dsp)
 
 
 if __name__ == '__main__':
 	decode_pst()
-	for dsp in dsps:
-		print(dsp)
@@ -0,0 +1,196 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from common import load_signed_data
+from known_keys import KnownKeyIndex
+
+# Runs extract_signed_data.py, find_public_keys.py and gcd_solver.py on a corpus from generate_test_corpus.py,
+# and reports the throughput and peak memory usage of each stage, and the fraction of the keys that are recovered.
+# Each stage runs in a separate process, so that the peak RSS is measured per stage.
+
+
+@dataclass
+class StageResult:
+	stage: str
+	items: int
+	unit: str
+	seconds: float
+	peak_rss_mb: float
+
+	def rate(self) -> float:
+		return self.items / self.seconds if self.seconds > 0 else 0
+
+
+def run_stage(stage: str, cmd: list[str], output_file: str, verbose: bool) -> tuple[float, float]:
+	# returns the wall time and the peak RSS of the process and its child processes
+	logging.info(f'running {stage}: {" ".join(cmd)}')
+	start_time = time.time()
+	with open(output_file, 'wb') as f:
+		process = subprocess.Popen(cmd, stdout=f, stderr=None if verbose else subprocess.DEVNULL)
+		_pid, status, rusage = os.wait4(process.pid, 0)
+	seconds = time.time() - start_time
+	process.returncode = os.waitstatus_to_exitcode(status)
+	if process.returncode != 0:
+		logging.error(f'{stage} failed with exit code {process.returncode}')
+		sys.exit(1)
+	return seconds, rusage.ru_maxrss / 1024
+
+
+def load_truth_keys(corpus_dir: str) -> dict[tuple[str, str], tuple[int, str]]:
+	truth_keys: dict[tuple[str, str], tuple[int, str]] = {}
+	with open(os.path.join(corpus_dir, 'truth_keys.tsv')) as f:
+		for line in f:
+			domain, selector, bits, key_tvl = line.rstrip('\n').split('\t')
+			truth_keys[(domain, selector)] = (int(bits), key_tvl)
+	return truth_keys
+
+
+def key_recovery(find_public_keys_output: str, truth_keys: dict[tuple[str, str], tuple[int, str]]) -> tuple[int, int, int]:
+	# returns the number of correct keys, wrong keys and domain/selector pairs that were searched
+	found_keys: dict[tuple[str, str], set[str]] = {}
+	with open(find_public_keys_output) as f:
+		for line in f:
+			parts = line.rstrip('\n').split('\t')
+			found_keys.setdefault((parts[1], parts[2]), set()).add(parts[3])
+	correct = 0
+	wrong = 0
+	for dsp, key_results in found_keys.items():
+		key_results.discard('-')
+		if truth_keys[dsp][1] in key_results:
+			correct += 1
+		elif key_results:
+			wrong += 1
+	return correct, wrong, len(found_keys)
+
+
+def gcd_solver_stages(datasig_file: str, truth_keys: dict[tuple[str, str], tuple[int, str]], workdir: str, verbose: bool) -> list[StageResult]:
+	# run gcd_solver.py on one message pair for each key size
+	results: list[StageResult] = []
+	done_sizes: set[int] = set()
+	for dsp, msg_infos in load_signed_data([datasig_file]).items():
+		bits = truth_keys[(dsp.domain, dsp.selector)][0]
+		if bits in done_sizes or len(msg_infos) < 2:
+			continue
+		done_sizes.add(bits)
+		msg1, msg2 = msg_infos[0], msg_infos[1]
+		cmd = [
+		    sys.executable, 'gcd_solver.py',
+		    msg1.hexdigest(),
+		    base64.b64encode(msg1.signature).decode(),
+		    msg2.hexdigest(),
+		    base64.b64encode(msg2.signature).decode(), msg1.hashfn
+		]
+		seconds, peak_rss_mb = run_stage(f'gcd_solver {bits} bit', cmd, os.path.join(workdir, f'gcd_solver_{bits}.json'), verbose)
+		results.append(StageResult(f'gcd_solver ({bits} bit)', 1, 'gcds', seconds, peak_rss_mb))
+	return sorted(results, key=lambda r: r.stage)
+
+
+def known_key_stages(datasig_file: str, truth_keys: dict[tuple[str, str], tuple[int, str]], other_keys: int) -> list[StageResult]:
+	# Compare the known key check of find_public_keys.py --known-keys-csv with the GCDs that it avoids, with an index of the truth keys
+	# and other_keys keys of other domains for each key size. The check of the first signature of each domain/selector pair is measured
+	# for a domain with a known key, for a domain without known keys, and against all keys of the size, which is the cost without
+	# narrowing the candidates down to the domain and the shared keys.
+	index = KnownKeyIndex()
+	for dsp, (_bits, key_tvl) in truth_keys.items():
+		index.add_key_data(key_tvl.rsplit('p=', 1)[1].strip(), dsp)
+	for bits in {bits for bits, _ in truth_keys.values()}:
+		for i in range(other_keys):
+			# not valid keys, but a verification takes as long as with a valid key of the same size
+			index.add_key(random.getrandbits(bits) | (1 << (bits - 1)) | 1, 0x10001, '-', (f'other{i}.example.net', 'selector'))
+	signatures = [(dsp.domain, msg_infos[0]) for dsp, msg_infos in load_signed_data([datasig_file]).items()]
+
+	results: list[StageResult] = []
+	for stage, other_domain in (('known keys (hit)', None), ('known keys (miss)', 'unknown.example.net')):
+		start_time = time.process_time()
+		found = sum(index.find_key(msg.hexdigest(), msg.signature, msg.hashfn, other_domain or domain) is not None for domain, msg in signatures)
+		logging.info(f'{stage}: {found} of {len(signatures)} signatures verified under a known key')
+		results.append(StageResult(stage, len(signatures), 'lookups', time.process_time() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+	start_time = time.process_time()
+	for _domain, msg in signatures:
+		for key in index.keys.values():
+			index.verify(key, msg.hexdigest(), msg.signature, msg.hashfn)
+	results.append(StageResult('known keys (all keys)', len(signatures), 'lookups', time.process_time() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+	return results
+
+
+def run_benchmark(corpus_dir: str, threads: int, other_known_keys: int, verbose: bool) -> tuple[list[StageResult], dict[str, int | float]]:
+	with open(os.path.join(corpus_dir, 'manifest.json')) as f:
+		manifest = json.load(f)
+	truth_keys = load_truth_keys(corpus_dir)
+	mbox_file = os.path.join(corpus_dir, 'corpus.mbox')
+	datasig_file = f'{mbox_file}.datasig'
+	results: list[StageResult] = []
+
+	seconds, peak_rss_mb = run_stage('extract_signed_data', [sys.executable, 'extract_signed_data.py', '--mbox-files', mbox_file, '--full'],
+	                                 os.path.join(corpus_dir, 'extract_signed_data.out'), verbose)
+	results.append(StageResult('extract_signed_data', manifest['messages'], 'messages', seconds, peak_rss_mb))
+
+	keys_output = os.path.join(corpus_dir, 'find_public_keys.tsv')
+	cmd = [sys.executable, 'find_public_keys.py', '--datasig-files', datasig_file, '--threads', str(threads), '--gcd-cache-file', '']
+	seconds, peak_rss_mb = run_stage('find_public_keys', cmd, keys_output, verbose)
+	with open(keys_output) as f:
+		solver_calls = sum(1 for _ in f)
+	results.append(StageResult('find_public_keys', solver_calls, 'gcds', seconds, peak_rss_mb))
+
+	results.extend(gcd_solver_stages(datasig_file, truth_keys, corpus_dir, verbose))
+	results.extend(known_key_stages(datasig_file, truth_keys, other_known_keys))
+
+	correct, wrong, searched = key_recovery(keys_output, truth_keys)
+	recovery = {
+	    'domain_selector_pairs': len(truth_keys),
+	    'searched': searched,
+	    'recovered': correct,
+	    'wrong_keys': wrong,
+	    'recovery_rate': correct / searched if searched else 0,
+	}
+	return results, recovery
+
+
+def print_results(results: list[StageResult], recovery: dict[str, int | float]):
+	print(f'{"stage":<28} {"items":>10} {"seconds":>10} {"rate":>16} {"peak RSS":>12}')
+	for r in results:
+		print(f'{r.stage:<28} {r.items:>10} {r.seconds:>10.2f} {r.rate():>10.3g} {r.unit + "/s":<5} {r.peak_rss_mb:>9.1f} MB')
+	print(f'recovered {recovery["recovered"]} of {recovery["searched"]} searched domain/selector pairs '
+	      f'({recovery["recovery_rate"]:.1%}), {recovery["wrong_keys"]} wrong keys')
+
+
+class ProgramArgs(argparse.Namespace):
+	corpus_dir: str
+	threads: int
+	json_output: str | None
+	other_known_keys: int
+	verbose: bool
+
+
+def main():
+	parser = argparse.ArgumentParser(description='benchmark the pubkey_finder stages on a corpus from generate_test_corpus.py')
+	parser.add_argument('--corpus-dir', type=str, required=True, help='the --output-dir of generate_test_corpus.py')
+	parser.add_argument('--threads', type=int, default=os.cpu_count(), help='the --threads argument of find_public_keys.py')
+	parser.add_argument('--json-output', type=str, help='also write the results to this JSON file, for comparing runs')
+	parser.add_argument('--other-known-keys',
+	                    type=int,
+	                    default=10000,
+	                    help='the number of keys of other domains per key size in the index of the known key benchmark, in addition to the truth keys')
+	parser.add_argument('--verbose', action='store_true', help='show the log output of each stage')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.basicConfig(level=logging.INFO, format='%(name)s: %(levelname)s: %(message)s')
+
+	results, recovery = run_benchmark(args.corpus_dir, args.threads, args.other_known_keys, args.verbose)
+	print_results(results, recovery)
+	if args.json_output:
+		with open(args.json_output, 'w') as f:
+			json.dump({'stages': [asdict(r) | {'rate': r.rate()} for r in results], 'key_recovery': recovery}, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
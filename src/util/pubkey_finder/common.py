@@ -1,25 +1,175 @@
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import FrozenInstanceError, dataclass
+from datetime import datetime, timezone
+import email.utils
+import hashlib
+import logging
+import os
 import pickle
+import sys
+from typing import Iterator
 
+# Dsp and MsgInfo are held in memory for every message in the .datasig files, so they use slots instead of a __dict__,
+# the domain, selector and canonicalization strings are interned, and the message source and date are stored as
+# a source file id, a message index and an epoch timestamp instead of formatted strings.
+# Files written with the older dict-based classes can still be loaded, see __setstate__.
+# With extract_signed_data.py --hash-only, MsgInfo stores the digests of the signed data instead of the signed data,
+# which is all that the solver needs, and is a fraction of the size of the canonicalized header fields.
 
-@dataclass(frozen=True)
+
+@dataclass(slots=True)
 class Dsp:
+	# immutable, but not frozen=True, since on Python 3.10 a frozen dataclass with slots replaces __getstate__ and __setstate__
 	domain: str
 	selector: str
 
 	def __init__(self, domain: str, selector: str):
-		object.__setattr__(self, 'domain', domain.lower())
-		object.__setattr__(self, 'selector', selector.lower())
+		object.__setattr__(self, 'domain', sys.intern(domain.lower()))
+		object.__setattr__(self, 'selector', sys.intern(selector.lower()))
+
+	def __setattr__(self, name: str, value: object):
+		raise FrozenInstanceError(f'cannot assign to field {name!r}')
+
+	def __delattr__(self, name: str):
+		raise FrozenInstanceError(f'cannot delete field {name!r}')
+
+	def __hash__(self):
+		return hash((self.domain, self.selector))
+
+	def __getstate__(self):
+		return (self.domain, self.selector)
+
+	def __setstate__(self, state: tuple[str, str] | dict[str, str]):
+		if isinstance(state, dict):
+			# pickled before Dsp had slots
+			state = (state['domain'], state['selector'])
+		object.__setattr__(self, 'domain', sys.intern(state[0]))
+		object.__setattr__(self, 'selector', sys.intern(state[1]))
+
+
+# the names of the source files of the messages, indexed by MsgInfo.sourceFileId
+source_files: list[str] = []
+source_file_ids: dict[str, int] = {}
+
 
+def source_file_id(filename: str) -> int:
+	file_id = source_file_ids.get(filename)
+	if file_id is None:
+		file_id = len(source_files)
+		source_files.append(sys.intern(filename))
+		source_file_ids[filename] = file_id
+	return file_id
 
-@dataclass
+
+def parse_date_header(date: str | None) -> float | None:
+	# return the value of a Date header field as an epoch timestamp, or None if it is missing or invalid
+	if not date:
+		return None
+	try:
+		parsed_date = email.utils.parsedate_to_datetime(date)
+	except (TypeError, ValueError):
+		return None
+	if parsed_date.tzinfo is None:
+		parsed_date = parsed_date.replace(tzinfo=timezone.utc)
+	return parsed_date.timestamp()
+
+
+@dataclass(slots=True)
 class MsgInfo:
-	signedData: bytes
+	# None for messages extracted with --hash-only, which only store the digests of the signed data
+	signedData: bytes | None
 	signature: bytes
-	source: str
-	date: str
+	sourceFileId: int
+	sourceIndex: int
+	timestamp: float | None
 	canonInfo: str
+	hashfn: str = 'sha256'  # the hash function of the signing algorithm, 'sha256' for rsa-sha256 and 'sha1' for rsa-sha1
+	# (sourceFileId, sourceIndex) of the other copies of the same signature, set by load_signed_data, not pickled
+	duplicateSources: tuple[tuple[int, int], ...] = ()
+	# (hashfn, digest of the signed data) for messages without signedData: the digest for hashfn and the sha256 digest
+	digests: tuple[tuple[str, bytes], ...] = ()
+
+	def __post_init__(self):
+		self.canonInfo = sys.intern(self.canonInfo)
+		self.hashfn = sys.intern(self.hashfn)
+
+	def digest(self, hashfn: str | None = None) -> bytes:
+		hashfn = hashfn or self.hashfn
+		if self.signedData is not None:
+			return hashlib.new(hashfn, self.signedData).digest()
+		for digest_hashfn, digest in self.digests:
+			if digest_hashfn == hashfn:
+				return digest
+		raise ValueError(f'{self.source}: no {hashfn} digest of the signed data')
+
+	def hexdigest(self, hashfn: str | None = None) -> str:
+		return self.digest(hashfn).hex()
+
+	def without_signed_data(self) -> 'MsgInfo':
+		# the hash-only form of the message, with the digests that the solver and the database import use
+		hashfns = dict.fromkeys((self.hashfn, 'sha256'))
+		return MsgInfo(None,
+		               self.signature,
+		               self.sourceFileId,
+		               self.sourceIndex,
+		               self.timestamp,
+		               self.canonInfo,
+		               self.hashfn,
+		               digests=tuple((hashfn, self.digest(hashfn)) for hashfn in hashfns))
+
+	@property
+	def source(self) -> str:
+		return f'{source_files[self.sourceFileId]}:{self.sourceIndex}'
+
+	@property
+	def sources(self) -> list[str]:
+		return [self.source] + [f'{source_files[file_id]}:{index}' for file_id, index in self.duplicateSources]
+
+	def content_key(self) -> tuple[bytes, bytes]:
+		return (self.signature, self.digest('sha256'))
+
+	@property
+	def date(self) -> str:
+		if self.timestamp is None:
+			return 'unknown'
+		return email.utils.formatdate(self.timestamp, usegmt=True)
+
+	def __getstate__(self):
+		# the file name is pickled instead of the id, since the ids are only valid within one process
+		return (self.signedData, self.signature, source_files[self.sourceFileId], self.sourceIndex, self.timestamp, self.canonInfo, self.hashfn, self.digests)
+
+	def __setstate__(self,
+	                 state: tuple[bytes | None, bytes, str, int, float | None, str, str, tuple[tuple[str, bytes], ...]] | tuple[bytes, bytes, str, int, float | None, str, str]
+	                 | tuple[bytes, bytes, str, int, float | None, str] | dict[str, bytes | str]):
+		if isinstance(state, dict):
+			# pickled before MsgInfo had slots, with source as "filename:index" and the raw Date header field
+			filename, _, index = str(state['source']).rpartition(':')
+			state = (state['signedData'], state['signature'], filename, int(index), parse_date_header(str(state['date'])), str(state['canonInfo']))  # type: ignore
+		if len(state) == 6:
+			# pickled before the hash function was recorded, when all signatures were assumed to be rsa-sha256
+			state = (*state, 'sha256')  # type: ignore
+		if len(state) == 7:
+			# pickled before hash-only messages
+			state = (*state, ())  # type: ignore
+		self.signedData, self.signature, filename, self.sourceIndex, self.timestamp, canonInfo, hashfn, digests = state  # type: ignore
+		self.sourceFileId = source_file_id(filename)
+		self.canonInfo = sys.intern(canonInfo)
+		self.hashfn = sys.intern(hashfn)
+		self.digests = tuple((sys.intern(digest_hashfn), digest) for digest_hashfn, digest in digests)
+		self.duplicateSources = ()
+
+
+def hashfn_from_signing_algorithm(algorithm: str) -> str:
+	# 'rsa-sha256' -> 'sha256'
+	return algorithm.lower().removeprefix('rsa-')
+
+
+def group_by_hashfn_and_size(msg_infos: list[MsgInfo]) -> dict[tuple[str, int], list[MsgInfo]]:
+	# only signatures with the same hash function and the same size can be solved together:
+	# the size of a signature is the size of the modulus of the key
+	groups: dict[tuple[str, int], list[MsgInfo]] = {}
+	for msg_info in msg_infos:
+		groups.setdefault((msg_info.hashfn, len(msg_info.signature)), []).append(msg_info)
+	return groups
 
 
 # https://stackoverflow.com/a/2212923/961254
@@ -47,17 +197,76 @@ def first_n_primes(n: int) -> list[int]:
 	return list(sorted(x))
 
 
-def load_signed_data(datasig_files: list[str]):
+def load_datasig_pickles(datasig_file: str) -> Iterator[dict[Dsp, list[MsgInfo]]]:
+	# a .datasig file contains one pickled dict for the first run of extract_signed_data.py,
+	# and one more for each incremental run that appended messages
+	with open(datasig_file, 'rb') as f:
+		while True:
+			try:
+				yield pickle.load(f)
+			except EOFError:
+				return
+
+
+def signed_text_file(datasig_file: str) -> str:
+	# the signed data of the messages that extract_signed_data.py --hash-only --signed-text-file extracted to datasig_file
+	return f'{datasig_file}.text'
+
+
+def load_signed_texts(datasig_files: list[str]) -> dict[bytes, bytes]:
+	# the signed data from the .datasig.text files next to datasig_files, by its sha256 digest
+	texts: dict[bytes, bytes] = {}
+	for datasig_file in datasig_files:
+		text_file = signed_text_file(datasig_file)
+		if not os.path.exists(text_file):
+			continue
+		with open(text_file, 'rb') as f:
+			while True:
+				try:
+					texts.update(pickle.load(f))
+				except EOFError:
+					break
+	return texts
+
+
+def load_signed_data(datasig_files: list[str], dedupe: bool = True):
+	# The same message is often found in several mbox files, e.g. in overlapping exports of the same mailbox.
+	# With dedupe, each signature is only kept once, identified by the signature and the hash of the signed data,
+	# and the sources of the other copies are recorded in MsgInfo.duplicateSources.
 	result: dict[Dsp, list[MsgInfo]] = {}
+	loaded: dict[tuple[bytes, bytes], MsgInfo] = {}
+	# the sources of the duplicates are collected in lists and set once at the end, appending to the tuple is quadratic
+	duplicate_sources: dict[tuple[bytes, bytes], list[tuple[int, int]]] = {}
+	signatures = 0
 	for f in datasig_files:
-		file_load_result = pickle.load(open(f, 'rb'))
-		for dsp, msg_infos in file_load_result.items():
-			if not dsp in result:
-				result[dsp] = []
-			result[dsp].extend(msg_infos)
+		for file_load_result in load_datasig_pickles(f):
+			for dsp, msg_infos in file_load_result.items():
+				if not dsp in result:
+					result[dsp] = []
+				signatures += len(msg_infos)
+				if not dedupe:
+					result[dsp].extend(msg_infos)
+					continue
+				for msg_info in msg_infos:
+					key = msg_info.content_key()
+					first = loaded.get(key)
+					if first is None:
+						loaded[key] = msg_info
+						result[dsp].append(msg_info)
+					else:
+						duplicate_sources.setdefault(key, []).append((msg_info.sourceFileId, msg_info.sourceIndex))
+	for key, sources in duplicate_sources.items():
+		loaded[key].duplicateSources = tuple(sources)
+	if dedupe:
+		duplicates = signatures - len(loaded)
+		logging.info(f'loaded {signatures} signatures from {len(datasig_files)} files, {duplicates} duplicates ({duplicates / max(signatures, 1):.1%})')
 	return result
 
 
+def count_duplicates(signed_data: dict[Dsp, list[MsgInfo]]) -> int:
+	return sum(len(msg_info.duplicateSources) for msg_infos in signed_data.values() for msg_info in msg_infos)
+
+
 def get_date_interval(date1: datetime | None, date2: datetime | None):
 	if date1 and date2:
 		oldest_date = date1 if date1 < date2 else date2
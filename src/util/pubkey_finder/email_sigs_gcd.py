@@ -1,4 +1,5 @@
 import asyncio
+import base64
 import binascii
 import json
 import logging
@@ -7,17 +8,37 @@ import subprocess
 import random
 from datetime import datetime
 from prisma import Prisma
-from prisma.models import EmailSignature
+from prisma.models import DkimRecord, EmailSignature
 from prisma.enums import KeyType
 from Crypto.PublicKey import RSA
-from common import Dsp, get_date_interval
+from common import Dsp, get_date_interval, hashfn_from_signing_algorithm
+from known_keys import KnownKeyIndex, load_known_keys_from_db
+from lib.dsp_id_cache import DspIdCache, TransactionDspIds
 
 DspToSigs = dict[Dsp, list[EmailSignature]]
 
+# EmailSignature.headerHash is the SHA-256 hash of the signed data, see src/lib/store_email_signature.ts,
+# so the GCD can only be calculated for signatures where that is also the hash that was signed
+supported_signing_algorithms = ('rsa-sha256', )
+
+# ids of the domain/selector pairs in the database, loaded in one batch in main and updated by store_key
+dsp_ids = DspIdCache()
+
+
+def group_signatures(sigs: list[EmailSignature]) -> dict[tuple[str, int], list[EmailSignature]]:
+	# group the signatures by signing algorithm and signature size, the signatures in a pair must have the same of both
+	groups: dict[tuple[str, int], list[EmailSignature]] = {}
+	for sig in sigs:
+		algorithm = sig.signingAlgorithm.lower()
+		if algorithm not in supported_signing_algorithms:
+			continue
+		groups.setdefault((algorithm, len(base64.b64decode(sig.dkimSignature))), []).append(sig)
+	return groups
+
 
 def find_key(dsp: Dsp, sig0: EmailSignature, sig1: EmailSignature, loglevel: int) -> str | None:
 	cmd = ["python3", "src/util/pubkey_finder/gcd_solver.py", "--loglevel", str(loglevel)]
-	hashfn = 'sha256'
+	hashfn = hashfn_from_signing_algorithm(sig0.signingAlgorithm)
 	data_parameters = [sig0.headerHash, sig0.dkimSignature, sig1.headerHash, sig1.dkimSignature, hashfn]
 	logging.debug(" ".join(cmd) + ' [... data parameters ...]')
 
@@ -33,42 +54,55 @@ def find_key(dsp: Dsp, sig0: EmailSignature, sig1: EmailSignature, loglevel: int
 	return keyDER_base64
 
 
-async def has_known_keys(prisma: Prisma, dsp: Dsp, dspsWithKnownKeys: set[Dsp]) -> bool:
-	if dsp in dspsWithKnownKeys:
-		return True
-	dnsRecord = await prisma.domainselectorpair.find_first(where={'domain': dsp.domain, 'selector': dsp.selector})
-	if dnsRecord:
-		dspsWithKnownKeys.add(dsp)
-		return True
+async def has_known_keys(prisma: Prisma, dsp: Dsp) -> bool:
+	return await dsp_ids.get_id(prisma, (dsp.domain, dsp.selector)) is not None
+
+
+async def store_key(dsp: Dsp, p: str, sig1: EmailSignature, sig2: EmailSignature, prisma: Prisma, tx_dsp_ids: TransactionDspIds | None = None) -> DkimRecord:
+	# in a transaction, pass tx_dsp_ids and call its commit after the transaction was committed
+	dsp_id = await (tx_dsp_ids or dsp_ids).get_or_create_id(prisma, (dsp.domain, dsp.selector), 'public_key_gcd_batch')
+	dkimrecord = await prisma.dkimrecord.find_first(where={'domainSelectorPairId': dsp_id, 'keyData': p})
+	if dkimrecord is None:
+		date1 = sig1.timestamp
+		date2 = sig2.timestamp
+		oldest_date, newest_date = get_date_interval(date1, date2)
+		dkimrecord = await prisma.dkimrecord.create(
+		    data={
+		        'domainSelectorPairId': dsp_id,
+		        'firstSeenAt': oldest_date or datetime.now(),
+		        'lastSeenAt': newest_date or datetime.now(),
+		        'value': f'k=rsa; p={p}',
+		        'keyType': KeyType.RSA,
+		        'keyData': p,
+		        'source': 'public_key_gcd_batch',
+		    })
+		logging.info(f'created dkim record: {dkimrecord}')
+	return dkimrecord
+
+
+async def find_known_key_for_signatures(dsp: Dsp, sigs: list[EmailSignature], known_keys: KnownKeyIndex, prisma: Prisma) -> bool:
+	# if two signatures verify under the same known key, store the key for the domain/selector pair without running the GCD solver
+	# the signatures have the same algorithm and size, so only the first one is looked up in the index,
+	# and the others are only verified under the key that it verifies under
+	first, others = sigs[0], sigs[1:]
+	hashfn = hashfn_from_signing_algorithm(first.signingAlgorithm)
+	key = known_keys.find_key(first.headerHash, base64.b64decode(first.dkimSignature), hashfn, dsp.domain)
+	if key is None:
+		return False
+	for sig in others:
+		if known_keys.verify(key, sig.headerHash, base64.b64decode(sig.dkimSignature), hashfn):
+			logging.info(f'signatures {first.id} and {sig.id} verify under a known key, storing the key for {dsp}')
+			await store_key(dsp, key.keyData, first, sig, prisma)
+			return True
 	return False
 
 
-async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature, prisma: Prisma):
+async def store_gcd_result(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature, p: str | None, prisma: Prisma, tx_dsp_ids: TransactionDspIds | None = None):
+	# record the result of the GCD solver for a pair of signatures, and store the key if one was found
 	info = f'dsp {dsp} and signatures {sig1.id} and {sig2.id}'
-	logging.info(f'run gcd solver for {info}')
-	p = find_key(dsp, sig1, sig2, logging.INFO)
 	if p:
 		logging.info(f'found public key for {info}')
-		dsp_record = await prisma.domainselectorpair.find_first(where={'domain': dsp.domain, 'selector': dsp.selector})
-		if dsp_record is None:
-			dsp_record = await prisma.domainselectorpair.create(data={'domain': dsp.domain, 'selector': dsp.selector, 'sourceIdentifier': 'public_key_gcd_batch'})
-			logging.info(f'created domain/selector pair: {dsp.domain} / {dsp.selector}')
-		dkimrecord = await prisma.dkimrecord.find_first(where={'domainSelectorPairId': dsp_record.id, 'keyData': p})
-		if dkimrecord is None:
-			date1 = sig1.timestamp
-			date2 = sig2.timestamp
-			oldest_date, newest_date = get_date_interval(date1, date2)
-			dkimrecord = await prisma.dkimrecord.create(
-			    data={
-			        'domainSelectorPairId': dsp_record.id,
-			        'firstSeenAt': oldest_date or datetime.now(),
-			        'lastSeenAt': newest_date or datetime.now(),
-			        'value': f'k=rsa; p={p}',
-			        'keyType': KeyType.RSA,
-			        'keyData': p,
-			        'source': 'public_key_gcd_batch',
-			    })
-			logging.info(f'created dkim record: {dkimrecord}')
+		dkimrecord = await store_key(dsp, p, sig1, sig2, prisma, tx_dsp_ids)
 		await prisma.emailpairgcdresult.create(data={
 		    'emailSignatureA_id': sig1.id,
 		    'emailSignatureB_id': sig2.id,
@@ -87,28 +121,39 @@ async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: Emai
 		})
 
 
+async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature, prisma: Prisma):
+	logging.info(f'run gcd solver for dsp {dsp} and signatures {sig1.id} and {sig2.id}')
+	p = find_key(dsp, sig1, sig2, logging.INFO)
+	await store_gcd_result(dsp, sig1, sig2, p, prisma)
+
+
 async def main():
 	logging.root.name = os.path.basename(__file__)
 	logging.getLogger("httpx").setLevel(logging.WARNING)
 	logging.basicConfig(level=logging.INFO, format='%(name)s: %(levelname)s: %(message)s')
 	prisma = Prisma()
 	await prisma.connect()
+	known_keys = await load_known_keys_from_db(prisma)
 	email_signatures = await prisma.emailsignature.find_many()
 	dspToSigs: DspToSigs = {}
-	dspsWithKnownKeys: set[Dsp] = set()
 	logging.info(f"filtering out email signatures for which we already have keys")
 	for s in email_signatures:
 		dsp = Dsp(domain=s.domain, selector=s.selector)
 		if dspToSigs.get(dsp) is None:
 			dspToSigs[dsp] = []
 		dspToSigs[dsp].append(s)
+	await dsp_ids.get_ids(prisma, [(dsp.domain, dsp.selector) for dsp in dspToSigs])
 
 	for dsp, sigs in dspToSigs.items():
 		logging.info(f"searching for public key for {dsp}")
-		if await has_known_keys(prisma, dsp, dspsWithKnownKeys):
+		if await has_known_keys(prisma, dsp):
 			logging.info(f"keys already known for {dsp.domain} {dsp.selector}")
 			continue
-		if len(sigs) >= 2:
+		groups = [group for group in group_signatures(sigs).values() if len(group) >= 2]
+		if groups:
+			sigs = max(groups, key=len)
+			if await find_known_key_for_signatures(dsp, sigs, known_keys, prisma):
+				continue
 			sig1, sig2 = random.sample(sigs, 2)
 			pairGcdResult = await prisma.emailpairgcdresult.find_first(
 			    where={'OR': [
@@ -126,7 +171,7 @@ async def main():
 				continue
 			await find_key_for_signature_pair(dsp, sig1, sig2, prisma)
 		else:
-			logging.info(f"less than 2 signatures found for {dsp}")
+			logging.info(f"less than 2 signatures with the same algorithm and size found for {dsp}")
 
 
 if __name__ == '__main__':
@@ -4,10 +4,14 @@ import argparse
 import pickle
 import sys
 import mailbox
+import mmap
 import base64
-from common import Dsp, MsgInfo
+from common import Dsp, MsgInfo, hashfn_from_signing_algorithm, parse_date_header, signed_text_file, source_file_id
+from lib import metrics
+from lib.mbox_index import IndexEntry, MboxIndex, append_to_index, content_hash, index_matches, load_index, normalize_message_id
+from lib.mbox_scanner import find_message_start, iter_mbox_messages
 from lib.util import ProgressReporter
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 
 sys.path.insert(0, "dkimpy")
 import dkimpy.dkim as dkim
@@ -40,24 +44,49 @@ class Statistics:
 	missing_signature_tag: int = 0
 	unicode_error: int = 0
 	validation_error: int = 0
+	already_processed: int = 0
 
 
-def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
+def count_messages(data: mmap.mmap | bytes, start: int) -> int:
+	count = 0
+	offset = find_message_start(data, start, len(data))
+	while offset >= 0:
+		count += 1
+		offset = find_message_start(data, offset + 1, len(data))
+	return count
+
+
+def parse_mbox_file(filepath: str, data: mmap.mmap | bytes, start: int, first_message_index: int, processed_hashes: set[str], hash_only: bool,
+                    signed_texts: dict[bytes, bytes] | None) -> tuple[dict[Dsp, list[MsgInfo]], list[IndexEntry], int]:
+	# extract the messages whose "From " line starts at or after start,
+	# returns the results, the index entries of the extracted messages and the end offset of the last message
+	# with hash_only, only the digests of the signed data are kept, and the signed data is added to signed_texts if it is set
 	results: dict[Dsp, list[MsgInfo]] = {}
-	filename = os.path.basename(filepath)
+	entries: list[IndexEntry] = []
+	end_offset = start
+	file_id = source_file_id(os.path.basename(filepath))
 	logging.info(f'loading {filepath}')
-	mb = mailbox.mbox(filepath, create=False)
-	number_of_messages = len(mb)
+	number_of_messages = count_messages(data, start)
 	progressReporter = ProgressReporter(number_of_messages, 0)
 	statistics = Statistics()
-	logging.info(f'processing {len(mb)} messages')
-	for message_index, message in enumerate(mb):
+	logging.info(f'processing {number_of_messages} messages from offset {start}')
+	for message_index, scanned_message in enumerate(iter_mbox_messages(filepath, data, start), first_message_index):
 		progressReporter.increment()
+		metrics.increment('extract_signed_data_messages')
+		raw_message = scanned_message.raw()
+		message_hash = content_hash(raw_message)
+		end_offset = scanned_message.end
+		entries.append(IndexEntry(scanned_message.start, len(raw_message), message_hash, normalize_message_id(scanned_message.headers.get('Message-ID'))))
+		if message_hash in processed_hashes:
+			# the same message was appended again after it was processed
+			statistics.already_processed += 1
+			continue
+		message = mailbox.mboxMessage(raw_message)
 		dkimSignatureFields = message.get_all('DKIM-Signature')
 		if not dkimSignatureFields:
 			statistics.missing_dkim_signature += 1
 			continue
-		for field in dkimSignatureFields:
+		for sig_index, field in enumerate(dkimSignatureFields):
 			tags = decode_dkim_header_field(field)
 			domain = tags['d']
 			selector = tags['s']
@@ -85,7 +114,8 @@ def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
 				continue
 
 			try:
-				d.verify(0, infoOut=infoOut)  # type: ignore
+				with metrics.timer('dkim_signed_data'):
+					d.verify(sig_index, infoOut=infoOut)  # type: ignore
 			except dkim.ValidationError as e:
 				logging.error(f'message {message_index}: ValidationError: {e}')
 				statistics.validation_error += 1
@@ -101,19 +131,73 @@ def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
 				sys.exit(1)
 
 			dsp = Dsp(domain, selector)
-			msg_date = message.get('Date', 'unknown')
-			msg_info = MsgInfo(signed_data, signature, f'{filename}:{message_index}', msg_date, 'dkimpy_fork')
+			msg_date = parse_date_header(message.get('Date'))
+			msg_info = MsgInfo(signed_data, signature, file_id, message_index, msg_date, 'dkimpy_fork', hashfn_from_signing_algorithm(signAlgo))
+			if hash_only:
+				if signed_texts is not None:
+					signed_texts[msg_info.digest('sha256')] = signed_data
+				msg_info = msg_info.without_signed_data()
 			if not dsp in results:
 				results[dsp] = []
 			results[dsp].append(msg_info)
 			statistics.total += 1
-	logging.info(f'processed {len(mb)} messages')
+	logging.info(f'processed {number_of_messages} messages')
 	logging.info(f'statistics: {statistics}')
-	return results
+	for name, value in asdict(statistics).items():
+		# statistics.total is the number of extracted signatures
+		metrics.increment(f'extract_signed_data_{"signatures" if name == "total" else name}', value)
+	return results, entries, end_offset
+
+
+def extract_mbox_file(mbox_file: str, full: bool, hash_only: bool, signed_text: bool):
+	# extract the messages that were added to mbox_file since the last run and append the results to the .datasig file,
+	# or extract all messages if there is no valid index or if full is set
+	datasig_file = f'{mbox_file}.datasig'
+	index_file = f'{datasig_file}.idx'
+	index: MboxIndex | None = None
+	if not full and os.path.exists(datasig_file):
+		index = load_index(index_file)
+	with open(mbox_file, 'rb') as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+		try:
+			if index is not None and not index_matches(index, data, os.path.getsize(datasig_file)):
+				logging.warning(f'{mbox_file} or {datasig_file} has changed since {index_file} was written, extracting all messages')
+				index = None
+			start = index.endOffset if index is not None else 0
+			first_message_index = len(index.entries) if index is not None else 0
+			processed_hashes: set[str] = index.content_hashes() if index is not None else set()
+			signed_texts: dict[bytes, bytes] | None = {} if hash_only and signed_text else None
+			with metrics.timer('extract_signed_data_file'):
+				results, entries, end_offset = parse_mbox_file(mbox_file, data, start, first_message_index, processed_hashes, hash_only, signed_texts)
+		finally:
+			if isinstance(data, mmap.mmap):
+				data.close()
+	if index is not None and not entries:
+		logging.info(f'no new messages in {mbox_file}')
+		return
+	if signed_texts is not None:
+		# the signed data of each run is appended as a separate pickle, see load_signed_texts
+		# an interrupted run can leave the signed data of messages that are extracted again, which is harmless since it is looked up by digest
+		with open(signed_text_file(datasig_file), 'ab' if index is not None else 'wb') as f:
+			pickle.dump(signed_texts, f)
+	# the results of each run are appended to the .datasig file as a separate pickle, see load_signed_data
+	with open(datasig_file, 'wb' if index is None else 'r+b') as f:
+		if index is not None:
+			f.seek(index.datasigSize)
+			f.truncate()
+		pickle.dump(results, f)
+		f.flush()
+		os.fsync(f.fileno())
+		datasig_size = f.tell()
+	append_to_index(index_file, index, entries, end_offset, datasig_size)
+	logging.info(f'results {"appended" if index is not None else "saved"} to {datasig_file}')
 
 
 class ProgramArgs(argparse.Namespace):
 	mbox_files: list[str]
+	full: bool
+	hash_only: bool
+	signed_text_file: bool
 	loglevel: int
 
 
@@ -122,16 +206,22 @@ def main():
             and try to find the RSA public key from pairs of messages signed with the same key',
 	                                 allow_abbrev=False)
 	parser.add_argument('--mbox-files', help='load data from mbox files and save to corresponding .mbox.datasig', type=str, nargs='+', required=True)
+	parser.add_argument('--full', action='store_true', help='extract all messages, instead of only the messages that were appended since the last run')
+	parser.add_argument('--hash-only',
+	                    action='store_true',
+	                    help='store the digests of the signed data instead of the signed data, which is enough for find_public_keys.py and makes the .datasig files much smaller')
+	parser.add_argument('--signed-text-file',
+	                    action='store_true',
+	                    help='use together with --hash-only to write the signed data to a .datasig.text file, for find_public_keys.py --display-signed-text')
 	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO, help='enable debug logging')
 	args = parser.parse_args(namespace=ProgramArgs)
 
 	logging.root.name = os.path.basename(__file__)
 	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
+	metrics.enable_export('extract_signed_data')
 
 	for mbox_file in args.mbox_files:
-		results = parse_mbox_file(mbox_file)
-		pickle.dump(results, open(f'{mbox_file}.datasig', 'wb'))
-		logging.info(f'results saved to {mbox_file}.datasig')
+		extract_mbox_file(mbox_file, args.full, args.hash_only, args.signed_text_file)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,5 @@
 import base64
 import binascii
-import hashlib
 import json
 import logging
 import os
@@ -10,17 +9,55 @@ import subprocess
 import sys
 import threading
 from Crypto.PublicKey import RSA
-from common import Dsp, MsgInfo, load_signed_data
+from common import Dsp, MsgInfo, count_duplicates, group_by_hashfn_and_size, load_signed_data, load_signed_texts
+from gcd_result_cache import GcdResultCache, default_cache_file
+from known_keys import KnownKeyIndex, load_known_keys_from_csv
+from lib import metrics
 
-dsp_queue: "queue.Queue[tuple[int, Dsp, list[tuple[MsgInfo, MsgInfo]]]]" = queue.Queue()
+# jobs are ordered by the signature size, since the cost of a GCD grows with the size of the key: small keys are solved first,
+# and the largest keys last, when they do not hold back the other jobs
+# a DSP can have several groups with the same signature size, e.g. rsa-sha1 and rsa-sha256, so the group index is part of the priority,
+# which makes it unique and the DSP and the message pairs are never compared
+dsp_queue: "queue.PriorityQueue[tuple[int, int, int, Dsp, list[tuple[MsgInfo, MsgInfo]]]]" = queue.PriorityQueue()
 
+# The memory usage of gcd_solver.py is dominated by the two s**e - m terms, which have e times as many bits as the signature.
+# The peak RSS measured for 1024 and 2048 bit signatures with e=65537 is about this many times the size of the two terms,
+# plus the memory usage of the Python interpreter with gmpy2 loaded.
+gcd_memory_factor = 5
+gcd_base_memory = 30 * 1024 * 1024
+max_exponent = 0x10001
 
-def hexdigest(data: bytes, hashfn: str):
-	if hashfn == 'sha256':
-		return hashlib.sha256(data).hexdigest()
-	if hashfn == 'sha512':
-		return hashlib.sha512(data).hexdigest()
-	raise ValueError(f'unsupported hashfn={hashfn}')
+
+def estimate_gcd_memory(signature_size: int) -> int:
+	return gcd_base_memory + gcd_memory_factor * 2 * signature_size * max_exponent
+
+
+def default_memory_budget() -> int:
+	return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+
+
+class MemoryBudget:
+	# admits solver jobs while the sum of their estimated memory usage is within the budget
+	# a job that is larger than the whole budget is admitted when no other job is running
+
+	def __init__(self, budget: int):
+		self.budget = budget
+		self.used = 0
+		self.condition = threading.Condition()
+
+	def acquire(self, amount: int):
+		with self.condition:
+			while self.used > 0 and self.used + amount > self.budget:
+				self.condition.wait()
+			self.used += amount
+
+	def release(self, amount: int):
+		with self.condition:
+			self.used -= amount
+			self.condition.notify_all()
+
+
+memory_budget = MemoryBudget(default_memory_budget())
 
 
 def call_solver_and_process_result(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, loglevel: int) -> str:
@@ -31,25 +68,41 @@ def call_solver_and_process_result(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, logle
 	    "--loglevel",
 	    str(loglevel),
 	]
-	hashfn = 'sha256'
+	hashfn = msg1.hashfn
 	data_parameters = [
-	    hexdigest(msg1.signedData, hashfn),
+	    msg1.hexdigest(hashfn),
 	    base64.b64encode(msg1.signature).decode('utf-8'),
-	    hexdigest(msg2.signedData, hashfn),
+	    msg2.hexdigest(hashfn),
 	    base64.b64encode(msg2.signature).decode('utf-8'),
 	    hashfn,
 	]
 	logging.debug(" ".join(cmd) + ' [... data parameters ...]')
 
-	output = subprocess.check_output(cmd + data_parameters)
+	estimated_memory = estimate_gcd_memory(len(msg1.signature))
+	memory_budget.acquire(estimated_memory)
+	try:
+		with metrics.timer('gcd_solver'):
+			output = subprocess.check_output(cmd + data_parameters)
+	finally:
+		memory_budget.release(estimated_memory)
 	data = json.loads(output)
+	if 'cpu_seconds' in data:
+		metrics.observe('gcd_solver_cpu_seconds', data['cpu_seconds'])
+	if 'peak_rss_bytes' in data:
+		peak_rss = data['peak_rss_bytes']
+		logging.info(f'gcd solver peak RSS: {peak_rss / 2**20:.0f} MB, estimated: {estimated_memory / 2**20:.0f} MB')
+		metrics.observe('gcd_solver_peak_rss_bytes', peak_rss, buckets=tuple(2.0**i for i in range(24, 36)))
+		if peak_rss > estimated_memory:
+			logging.warning(f'gcd solver used more memory than estimated, consider increasing gcd_memory_factor')
 	n = int(data['n_hex'], 16)
 	e = int(data['e_hex'], 16)
 	if (n < 2):
 		logging.info(f'no public key found for {dsp}')
+		metrics.increment('find_public_keys_not_found')
 		return '-'
 	try:
 		logging.info(f'found public key for {dsp}')
+		metrics.increment('find_public_keys_found')
 		rsa_key = RSA.construct((n, e))
 		keyDER = rsa_key.exportKey(format='DER')
 		keyDER_base64 = binascii.b2a_base64(keyDER, newline=False).decode('utf-8')
@@ -59,18 +112,55 @@ def call_solver_and_process_result(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, logle
 		return f'ValueError: {e}'
 
 
-def read_and_resolve_worker(loglevel: int):
+def print_result_row(dsp_index: int, dsp: Dsp, key_result: str, msg1: MsgInfo, msg2: MsgInfo):
+	row_values = [str(dsp_index).zfill(4), dsp.domain, dsp.selector, key_result, msg1.source, msg2.source, msg1.date, msg2.date]
+	print("\t".join(row_values))
+	sys.stdout.flush()
+
+
+def read_and_resolve_worker(loglevel: int, gcd_cache: GcdResultCache | None):
 	while True:
 		logging.info(f'DSPs left: {dsp_queue.qsize()}')
-		dsp_index, dsp, msg_pairs = dsp_queue.get()
+		_signature_size, dsp_index, _group_index, dsp, msg_pairs = dsp_queue.get()
 		for msg1, msg2 in msg_pairs:
 			key_result = call_solver_and_process_result(dsp, msg1, msg2, loglevel)
-			row_values = [str(dsp_index).zfill(4), dsp.domain, dsp.selector, key_result, msg1.source, msg2.source, msg1.date, msg2.date]
-			print("\t".join(row_values))
-			sys.stdout.flush()
+			if gcd_cache is not None and (key_result == '-' or key_result.startswith('k=rsa')):
+				gcd_cache.store(msg1, msg2, key_result)
+			print_result_row(dsp_index, dsp, key_result, msg1, msg2)
 		dsp_queue.task_done()
 
 
+def find_cached_result(gcd_cache: GcdResultCache, dsp_index: int, dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo) -> bool:
+	# output the result of an earlier run for the same pair of signatures, if there is one
+	key_result = gcd_cache.lookup(msg1, msg2)
+	if key_result is None:
+		return False
+	metrics.increment('find_public_keys_cached')
+	print_result_row(dsp_index, dsp, key_result, msg1, msg2)
+	return True
+
+
+def find_known_key(known_keys: KnownKeyIndex, dsp_index: int, dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo) -> bool:
+	# if both messages verify under the same known key, output the key without running the GCD solver
+	key1 = known_keys.find_key(msg1.hexdigest(), msg1.signature, msg1.hashfn, dsp.domain)
+	if key1 is None or not known_keys.verify(key1, msg2.hexdigest(), msg2.signature, msg2.hashfn):
+		return False
+	logging.info(f'found known public key for {dsp}')
+	metrics.increment('find_public_keys_known_key')
+	print_result_row(dsp_index, dsp, f'k=rsa; p={key1.keyData}', msg1, msg2)
+	return True
+
+
+def select_msg_pairs(msg_infos: list[MsgInfo]) -> list[tuple[MsgInfo, MsgInfo]]:
+	if len(msg_infos) == 2:
+		return [(msg_infos[0], msg_infos[1])]
+	elif len(msg_infos) == 3:
+		return [(msg_infos[0], msg_infos[1]), (msg_infos[1], msg_infos[2])]
+	elif len(msg_infos) >= 4:
+		return [(msg_infos[0], msg_infos[1]), (msg_infos[2], msg_infos[3])]
+	return []
+
+
 def include_dsp(dsp: Dsp) -> bool:
 	if dsp.domain == 'mail.messari.io' and dsp.selector == 's1':
 		# 2048 bits
@@ -79,21 +169,33 @@ def include_dsp(dsp: Dsp) -> bool:
 	return True
 
 
-def solve_msg_pairs(signed_messages: dict[Dsp, list[MsgInfo]], threads: int, loglevel: int, sparse_nth: int):
+def solve_msg_pairs(signed_messages: dict[Dsp, list[MsgInfo]],
+                    threads: int,
+                    loglevel: int,
+                    sparse_nth: int,
+                    known_keys: KnownKeyIndex | None = None,
+                    gcd_cache: GcdResultCache | None = None):
 	msg_list = list(signed_messages.items())
 	if sparse_nth > 1:
 		msg_list = msg_list[::sparse_nth]
 	logging.info(f'searching for public key for {len(msg_list)} message pairs')
 	for i, (dsp, msg_infos) in enumerate(msg_list):
-		if len(msg_infos) == 2:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1])]))
-		elif len(msg_infos) == 3:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1]), (msg_infos[1], msg_infos[2])]))
-		elif len(msg_infos) >= 4:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1]), (msg_infos[2], msg_infos[3])]))
+		# pairs are only selected within groups of signatures that can be solved together
+		for group_index, ((hashfn, signature_size), group) in enumerate(group_by_hashfn_and_size(msg_infos).items()):
+			msg_pairs = select_msg_pairs(group)
+			if not msg_pairs:
+				metrics.increment('find_public_keys_unpaired_groups')
+				continue
+			if gcd_cache is not None:
+				msg_pairs = [(msg1, msg2) for msg1, msg2 in msg_pairs if not find_cached_result(gcd_cache, i, dsp, msg1, msg2)]
+			if known_keys is not None:
+				msg_pairs = [(msg1, msg2) for msg1, msg2 in msg_pairs if not find_known_key(known_keys, i, dsp, msg1, msg2)]
+			if msg_pairs:
+				metrics.increment(f'find_public_keys_jobs_{hashfn}_{signature_size * 8}')
+				dsp_queue.put((signature_size, i, group_index, dsp, msg_pairs))
 	logging.info(f'starting {threads} threads')
 	for _i in range(threads):
-		t_in = threading.Thread(target=read_and_resolve_worker, daemon=True, args=(loglevel, ))
+		t_in = threading.Thread(target=read_and_resolve_worker, daemon=True, args=(loglevel, gcd_cache))
 		t_in.start()
 	dsp_queue.join()
 
@@ -106,6 +208,9 @@ class ProgramArgs(argparse.Namespace):
 	threads: int
 	sparse_nth: int
 	display_signed_text: bool
+	known_keys_csv: str | None
+	memory_budget_mb: int | None
+	gcd_cache_file: str
 
 
 def main():
@@ -120,12 +225,28 @@ def main():
 	parser.add_argument('--filter-domain', help='only process messages with this domain', type=str)
 	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO, help='enable debug logging')
 	parser.add_argument('--threads', type=int, default=1, help='number of threads to use for solving')
+	parser.add_argument('--memory-budget-mb',
+	                    type=int,
+	                    help='limit the estimated total memory usage of the solver processes, which run at most --threads at a time. Default: 75%% of the physical memory')
+	parser.add_argument(
+	    '--known-keys-csv',
+	    type=str,
+	    help='CSV file with known RSA moduli, from modulus_extractor.py --extract-moduli --with-dsps. Message pairs that verify under a known key skip the GCD solver')
+	parser.add_argument('--gcd-cache-file',
+	                    type=str,
+	                    default=default_cache_file,
+	                    help='SQLite file with the results of earlier runs, pairs found in it are not solved again. Use an empty string to disable')
 	args = parser.parse_args(namespace=ProgramArgs)
 
 	logging.root.name = os.path.basename(__file__)
 	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
+	metrics.enable_export('find_public_keys')
 
-	signed_data = load_signed_data(args.datasig_files)
+	with metrics.timer('load_signed_data'):
+		signed_data = load_signed_data(args.datasig_files)
+	duplicates = count_duplicates(signed_data)
+	metrics.increment('find_public_keys_signatures', sum(len(msg_infos) for msg_infos in signed_data.values()) + duplicates)
+	metrics.increment('find_public_keys_duplicate_signatures', duplicates)
 	signed_data = {dsp: msg_infos for dsp, msg_infos in signed_data.items() if len(msg_infos) >= 2}
 	if args.filter_domain:
 		signed_data = {dsp: msg_infos for dsp, msg_infos in signed_data.items() if dsp.domain == args.filter_domain}
@@ -135,13 +256,27 @@ def main():
 			print(f'{dsp.domain}\t{dsp.selector}')
 		return
 	if args.display_signed_text:
+		# messages extracted with --hash-only have their signed data in the .datasig.text files, if they were extracted with --signed-text-file
+		signed_texts = load_signed_texts(args.datasig_files)
 		for dsp, msg_infos in signed_data.items():
 			for i, msg_info in enumerate(msg_infos):
 				print(f'signed text for domain: {dsp.domain}, selector: {dsp.selector}, message {i}:')
-				print(msg_info.signedData.decode('utf-8'))
+				signed_text = msg_info.signedData if msg_info.signedData is not None else signed_texts.get(msg_info.digest('sha256'))
+				print(signed_text.decode('utf-8') if signed_text is not None else f'[not stored, sha256 {msg_info.hexdigest("sha256")}]')
 				print()
 		return
-	solve_msg_pairs(signed_data, args.threads, args.loglevel, args.sparse_nth)
+	if args.memory_budget_mb:
+		memory_budget.budget = args.memory_budget_mb * 1024 * 1024
+	logging.info(f'memory budget for solver processes: {memory_budget.budget / 2**20:.0f} MB')
+	known_keys = None
+	if args.known_keys_csv:
+		with open(args.known_keys_csv) as f:
+			known_keys = load_known_keys_from_csv(f)
+	if args.gcd_cache_file:
+		with GcdResultCache(args.gcd_cache_file) as gcd_cache:
+			solve_msg_pairs(signed_data, args.threads, args.loglevel, args.sparse_nth, known_keys, gcd_cache)
+	else:
+		solve_msg_pairs(signed_data, args.threads, args.loglevel, args.sparse_nth, known_keys)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import socket
+from dataclasses import dataclass
+from datetime import timedelta
+from prisma import Prisma
+from common import Dsp, hashfn_from_signing_algorithm
+from email_sigs_gcd import dsp_ids, store_gcd_result, supported_signing_algorithms
+from gcd_solver import find_n
+from known_keys import key_data_from_modulus
+from lib import metrics
+
+# Work queue for running the GCD solver on pairs of EmailSignature rows on several machines, with the GcdJob table.
+#
+# --enqueue creates jobs for pairs of signatures with the same domain, selector, signing algorithm and signature size,
+# for the domain/selector pairs that are not in the DomainSelectorPair table, as email_sigs_gcd.py does.
+# --work runs workers that claim one job at a time with FOR UPDATE SKIP LOCKED, so that concurrent workers never claim the same job.
+# A claimed job is leased to the worker for --lease-seconds, and the lease is renewed while the solver runs.
+# If a worker stops, its lease expires and the job is claimed again by another worker, up to --max-attempts times.
+# The result is committed together with the job status, and only if the worker still holds the lease.
+#
+# The solver of each job runs in its own process, so that the event loop can renew the leases while the GCDs are calculated,
+# and so that a solver process that dies, e.g. when it is killed by the OOM killer, only fails the attempt of its own job.
+
+# timestamps are UTC without time zone, as written by Prisma
+db_now = "(now() AT TIME ZONE 'UTC')"
+
+
+class LeaseLostError(Exception):
+	pass
+
+
+async def run_solver(message_hashes_hex: list[str], signatures: list[bytes], hashfn: str) -> tuple[int, int]:
+	# raises BrokenProcessPool if the solver process dies
+	executor = concurrent.futures.ProcessPoolExecutor(1)
+	try:
+		return await asyncio.get_running_loop().run_in_executor(executor, find_n, message_hashes_hex, signatures, hashfn)
+	finally:
+		executor.shutdown(wait=False)
+
+
+@dataclass
+class ClaimedJob:
+	id: int
+	emailSignatureA_id: int
+	emailSignatureB_id: int
+	attempts: int
+
+
+async def enqueue_jobs(prisma: Prisma, pairs_per_group: int) -> int:
+	# pair the 1st and 2nd, 3rd and 4th, etc. signature of each group, up to pairs_per_group pairs
+	return await prisma.execute_raw(
+	    f'''
+		WITH ranked AS (
+			SELECT s.id, s.domain, s.selector, lower(s."signingAlgorithm") AS algorithm, length(decode(s."dkimSignature", 'base64')) AS size,
+				row_number() OVER (
+					PARTITION BY s.domain, s.selector, lower(s."signingAlgorithm"), length(decode(s."dkimSignature", 'base64')) ORDER BY s.id
+				) AS n
+			FROM "EmailSignature" s
+			WHERE lower(s."signingAlgorithm") = ANY($1::text[])
+			AND NOT EXISTS (SELECT 1 FROM "DomainSelectorPair" d WHERE d.domain = s.domain AND d.selector = s.selector)
+		)
+		INSERT INTO "GcdJob" ("emailSignatureA_id", "emailSignatureB_id", "createdAt")
+		SELECT a.id, b.id, {db_now}
+		FROM ranked a
+		JOIN ranked b ON b.domain = a.domain AND b.selector = a.selector AND b.algorithm = a.algorithm AND b.size = a.size AND b.n = a.n + 1
+		WHERE a.n % 2 = 1 AND a.n < 2 * $2
+		AND NOT EXISTS (
+			SELECT 1 FROM "EmailPairGcdResult" r
+			WHERE (r."emailSignatureA_id" = a.id AND r."emailSignatureB_id" = b.id) OR (r."emailSignatureA_id" = b.id AND r."emailSignatureB_id" = a.id)
+		)
+		ON CONFLICT DO NOTHING
+		''', list(supported_signing_algorithms), pairs_per_group)
+
+
+async def fail_exhausted_jobs(prisma: Prisma, max_attempts: int) -> int:
+	# jobs whose lease expired on the last attempt, e.g. because the solver ran out of memory on every worker
+	return await prisma.execute_raw(
+	    f'''
+		UPDATE "GcdJob" SET status = 'failed', "leaseOwner" = NULL, "leaseExpiresAt" = NULL, "finishedAt" = {db_now},
+			"lastError" = COALESCE("lastError", 'lease expired')
+		WHERE status = 'running' AND "leaseExpiresAt" < {db_now} AND attempts >= $1
+		''', max_attempts)
+
+
+async def claim_job(prisma: Prisma, worker_id: str, lease_seconds: int, max_attempts: int) -> ClaimedJob | None:
+	rows = await prisma.query_raw(
+	    f'''
+		UPDATE "GcdJob" SET status = 'running', "leaseOwner" = $1, "leaseExpiresAt" = {db_now} + $2::int * interval '1 second', attempts = attempts + 1
+		WHERE id = (
+			SELECT id FROM "GcdJob"
+			WHERE attempts < $3 AND (status = 'pending' OR (status = 'running' AND "leaseExpiresAt" < {db_now}))
+			ORDER BY id
+			LIMIT 1
+			FOR UPDATE SKIP LOCKED
+		)
+		RETURNING id, "emailSignatureA_id", "emailSignatureB_id", attempts
+		''', worker_id, lease_seconds, max_attempts)
+	if not rows:
+		return None
+	row = rows[0]
+	return ClaimedJob(row['id'], row['emailSignatureA_id'], row['emailSignatureB_id'], row['attempts'])
+
+
+async def renew_lease(prisma: Prisma, job: ClaimedJob, worker_id: str, lease_seconds: int):
+	while True:
+		await asyncio.sleep(lease_seconds / 3)
+		count = await prisma.execute_raw(
+		    f'''
+			UPDATE "GcdJob" SET "leaseExpiresAt" = {db_now} + $3::int * interval '1 second'
+			WHERE id = $1 AND "leaseOwner" = $2 AND status = 'running'
+			''', job.id, worker_id, lease_seconds)
+		if count == 0:
+			logging.warning(f'lost the lease of job {job.id}')
+			return
+
+
+async def release_job(prisma: Prisma, job: ClaimedJob, worker_id: str, max_attempts: int, error: str):
+	# return the job to the queue after an error, or mark it as failed after the last attempt
+	await prisma.execute_raw(
+	    f'''
+		UPDATE "GcdJob" SET "leaseOwner" = NULL, "leaseExpiresAt" = NULL, "lastError" = $3,
+			status = CASE WHEN attempts >= $4 THEN 'failed'::"GcdJobStatus" ELSE 'pending'::"GcdJobStatus" END,
+			"finishedAt" = CASE WHEN attempts >= $4 THEN {db_now} ELSE NULL END
+		WHERE id = $1 AND "leaseOwner" = $2
+		''', job.id, worker_id, error, max_attempts)
+
+
+async def run_job(prisma: Prisma, job: ClaimedJob, worker_id: str, lease_seconds: int, max_attempts: int):
+	sig1 = await prisma.emailsignature.find_unique(where={'id': job.emailSignatureA_id})
+	sig2 = await prisma.emailsignature.find_unique(where={'id': job.emailSignatureB_id})
+	if sig1 is None or sig2 is None:
+		await release_job(prisma, job, worker_id, 0, 'email signature not found')
+		return
+	dsp = Dsp(sig1.domain, sig1.selector)
+	logging.info(f'job {job.id} (attempt {job.attempts}): run gcd solver for dsp {dsp} and signatures {sig1.id} and {sig2.id}')
+	hashfn = hashfn_from_signing_algorithm(sig1.signingAlgorithm)
+	signatures = [base64.b64decode(sig1.dkimSignature), base64.b64decode(sig2.dkimSignature)]
+	lease_task = asyncio.create_task(renew_lease(prisma, job, worker_id, lease_seconds))
+	try:
+		with metrics.timer('gcd_job'):
+			n, e = await run_solver([sig1.headerHash, sig2.headerHash], signatures, hashfn)
+	except BrokenProcessPool as err:
+		# the solver process of this job died, which counts as a failed attempt, so that a job that always kills its solver is not retried forever
+		logging.error(f'job {job.id}: the solver process died: {err!r}')
+		metrics.increment('gcd_jobs_solver_died')
+		await release_job(prisma, job, worker_id, max_attempts, f'the solver process died: {err!r}')
+		return
+	except Exception as err:
+		logging.error(f'job {job.id}: {err!r}')
+		metrics.increment('gcd_jobs_errors')
+		await release_job(prisma, job, worker_id, max_attempts, repr(err))
+		return
+	finally:
+		lease_task.cancel()
+	p = key_data_from_modulus(n, e) if n > 1 else None
+	# the ids of domain/selector pairs created in the transaction are only shared with the other workers after the commit
+	tx_dsp_ids = dsp_ids.transaction()
+	try:
+		async with prisma.tx(max_wait=timedelta(seconds=10), timeout=timedelta(seconds=60)) as tx:
+			count = await tx.execute_raw(
+			    f'''UPDATE "GcdJob" SET status = 'done', "leaseOwner" = NULL, "leaseExpiresAt" = NULL, "finishedAt" = {db_now}
+				WHERE id = $1 AND "leaseOwner" = $2 AND status = 'running' ''', job.id, worker_id)
+			if count == 0:
+				raise LeaseLostError(f'job {job.id} was claimed by another worker')
+			await store_gcd_result(dsp, sig1, sig2, p, tx, tx_dsp_ids)
+	except LeaseLostError as err:
+		logging.warning(f'discarding the result: {err}')
+		metrics.increment('gcd_jobs_lease_lost')
+		return
+	except Exception as err:
+		# e.g. a result for the pair was stored by email_sigs_gcd.py in the meantime
+		logging.error(f'job {job.id}: storing the result failed: {err!r}')
+		metrics.increment('gcd_jobs_errors')
+		await release_job(prisma, job, worker_id, max_attempts, repr(err))
+		return
+	tx_dsp_ids.commit()
+	metrics.increment('gcd_jobs_found' if p else 'gcd_jobs_not_found')
+
+
+async def worker_loop(prisma: Prisma, worker_id: str, lease_seconds: int, max_attempts: int, poll_interval: float, exit_when_empty: bool):
+	while True:
+		await fail_exhausted_jobs(prisma, max_attempts)
+		job = await claim_job(prisma, worker_id, lease_seconds, max_attempts)
+		if job is None:
+			if exit_when_empty:
+				logging.info(f'{worker_id}: no more jobs')
+				return
+			await asyncio.sleep(poll_interval)
+			continue
+		await run_job(prisma, job, worker_id, lease_seconds, max_attempts)
+
+
+async def print_status(prisma: Prisma):
+	rows = await prisma.query_raw('''SELECT status::text AS status, count(*)::int AS count FROM "GcdJob" GROUP BY status ORDER BY status''')
+	for row in rows:
+		print(f'{row["status"]}\t{row["count"]}')
+
+
+class ProgramArgs(argparse.Namespace):
+	enqueue: bool
+	work: bool
+	status: bool
+	pairs_per_group: int
+	processes: int
+	lease_seconds: int
+	max_attempts: int
+	poll_interval: float
+	exit_when_empty: bool
+
+
+async def main():
+	parser = argparse.ArgumentParser(description='run the GCD solver on pairs of email signatures from the database, on one or more machines')
+	parser.add_argument('--enqueue', action='store_true', help='create jobs for the signature pairs that have not been solved')
+	parser.add_argument('--work', action='store_true', help='claim and solve jobs')
+	parser.add_argument('--status', action='store_true', help='show the number of jobs by status')
+	parser.add_argument('--pairs-per-group', type=int, default=2, help='use together with --enqueue: the number of pairs per domain, selector, algorithm and key size')
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help='use together with --work: the number of jobs that are solved at the same time')
+	parser.add_argument('--lease-seconds', type=int, default=300, help='use together with --work: the time after which a job of a worker that stopped is claimed again')
+	parser.add_argument('--max-attempts', type=int, default=3)
+	parser.add_argument('--poll-interval', type=float, default=60, help='use together with --work: seconds to wait when there are no jobs')
+	parser.add_argument('--exit-when-empty', action='store_true', help='use together with --work: exit when there are no jobs, instead of waiting for new jobs')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.getLogger("httpx").setLevel(logging.WARNING)
+	logging.basicConfig(level=logging.INFO, format='%(name)s: %(levelname)s: %(message)s')
+	metrics.enable_export('gcd_job_worker')
+
+	prisma = Prisma()
+	await prisma.connect()
+	if args.enqueue:
+		logging.info(f'created {await enqueue_jobs(prisma, args.pairs_per_group)} jobs')
+	if args.work:
+		host = socket.gethostname()
+		await asyncio.gather(*(worker_loop(prisma, f'{host}:{os.getpid()}:{i}', args.lease_seconds, args.max_attempts, args.poll_interval, args.exit_when_empty)
+		                       for i in range(args.processes)))
+	if args.status:
+		await print_status(prisma)
+	await prisma.disconnect()
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
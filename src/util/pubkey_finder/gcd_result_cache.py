@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from common import MsgInfo
+
+# Results of the GCD solver for message pairs, kept in an SQLite database between runs of find_public_keys.py,
+# so that a rerun on overlapping .datasig files only solves the pairs that have not been solved before.
+# A pair is identified by the hashes of its two signatures (the signature and the hash of the signed data) and the hash function,
+# in sorted order, so the same pair found in another file or in the other order has the same key.
+# The result is the key_result column of find_public_keys.py: "k=rsa; p=..." or "-" if no key was found.
+
+default_cache_file = 'gcd_results.sqlite3'
+
+
+@dataclass
+class GcdCacheStats:
+	hits: int = 0
+	misses: int = 0
+	stores: int = 0
+
+
+def signature_hash(msg_info: MsgInfo) -> str:
+	return hashlib.sha256(msg_info.signature + msg_info.digest()).hexdigest()
+
+
+def pair_key(msg1: MsgInfo, msg2: MsgInfo) -> tuple[str, str, str]:
+	hash1, hash2 = sorted((signature_hash(msg1), signature_hash(msg2)))
+	return hash1, hash2, msg1.hashfn
+
+
+class GcdResultCache:
+	def __init__(self, filename: str):
+		self.stats = GcdCacheStats()
+		# results are stored from the solver threads
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('''CREATE TABLE IF NOT EXISTS gcd_results (
+			signature_a TEXT NOT NULL,
+			signature_b TEXT NOT NULL,
+			hashfn TEXT NOT NULL,
+			key_result TEXT NOT NULL,
+			solved_at REAL NOT NULL,
+			PRIMARY KEY (signature_a, signature_b, hashfn)
+		)''')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_args: object):
+		self.close()
+
+	def close(self):
+		with self.lock:
+			self.db.commit()
+			self.db.close()
+		logging.info(f'gcd result cache: {self.stats}')
+
+	def lookup(self, msg1: MsgInfo, msg2: MsgInfo) -> str | None:
+		with self.lock:
+			row = self.db.execute('SELECT key_result FROM gcd_results WHERE signature_a = ? AND signature_b = ? AND hashfn = ?', pair_key(msg1, msg2)).fetchone()
+			if row is None:
+				self.stats.misses += 1
+				return None
+			self.stats.hits += 1
+			return row[0]
+
+	def store(self, msg1: MsgInfo, msg2: MsgInfo, key_result: str):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO gcd_results (signature_a, signature_b, hashfn, key_result, solved_at) VALUES (?, ?, ?, ?, ?)',
+			                (*pair_key(msg1, msg2), key_result, time.time()))
+			# each result took seconds of CPU time to calculate, so it is committed right away
+			self.db.commit()
+			self.stats.stores += 1
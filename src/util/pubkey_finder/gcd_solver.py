@@ -2,19 +2,22 @@ import binascii
 import json
 import logging
 import os
+import resource
 import time
 from typing import Any
 from common import first_n_primes
+from lib import metrics
 import gmpy2  # type: ignore
 
 gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
 gmpy2_gcd: Any = gmpy2.gcd  # type: ignore
+gmpy2_powmod: Any = gmpy2.powmod  # type: ignore
 
 # https://blog.ploetzli.ch/2018/calculating-an-rsa-public-key-from-two-signatures/
 
 
 def pkcs1_padding(size_bytes: int, hash_hex: str, hashfn: str):
-	oid = {'sha256': '608648016503040201', 'sha512': '608648016503040203'}[hashfn]
+	oid = {'sha1': '2b0e03021a', 'sha256': '608648016503040201', 'sha512': '608648016503040203'}[hashfn]
 	result = '06' + ("%02X" % (len(oid) // 2)) + oid + '05' + '00'
 	result = '30' + ("%02X" % (len(result) // 2)) + result
 
@@ -40,6 +43,10 @@ def remove_small_prime_factors(n: Any):
 
 
 def find_n(message_hashes_hex: list[str], signatures: list[bytes], hashfn: str) -> tuple[int, int]:
+	if len(signatures) < 2:
+		logging.error(f"at least two signatures are needed")
+		return 0, 0
+
 	size_bytes = len(signatures[0])
 	if any(len(s) != size_bytes for s in signatures):
 		logging.error(f"all signature sizes must be identical")
@@ -53,11 +60,18 @@ def find_n(message_hashes_hex: list[str], signatures: list[bytes], hashfn: str)
 		pairs = [message_sig_pair(size_bytes, m, s, hashfn) for (m, s) in zip(message_hashes_hex, signatures)]
 		for e in [0x10001, 3, 17]:
 			logging.debug(f'solving for hashfn={hashfn}, e={e}')
-			gcd_input = [(s**e - m) for (m, s) in pairs]
-
 			start_time = time.process_time()
-			n: Any = gmpy2_gcd(*gcd_input)
-			logging.info(f'gcd cpu time={time.process_time() - start_time}')
+			# s**e - m has e times as many bits as the signature, so only the first two are materialized,
+			# and the remaining signatures are reduced modulo the gcd so far, which is much smaller
+			(m1, s1), (m2, s2) = pairs[0], pairs[1]
+			n: Any = gmpy2_gcd(s1**e - m1, s2**e - m2)
+			for (m, s) in pairs[2:]:
+				if n <= 1:
+					break
+				n = gmpy2_gcd(n, gmpy2_powmod(s, e, n) - m)
+			gcd_cpu_time = time.process_time() - start_time
+			logging.info(f'gcd cpu time={gcd_cpu_time}')
+			metrics.observe('gcd_cpu_seconds', gcd_cpu_time)
 
 			if n.bit_length() > 10000:
 				logging.error(f'skip n with > 10000 bits')
@@ -79,7 +93,7 @@ if __name__ == '__main__':
 	parser.add_argument('signature1_base64')
 	parser.add_argument('msg2_hash_hex')
 	parser.add_argument('signature2_base64')
-	parser.add_argument('hashfn', choices=['sha256', 'sha512'])
+	parser.add_argument('hashfn', choices=['sha1', 'sha256', 'sha512'])
 	parser.add_argument('--loglevel', type=int, default=logging.INFO)
 	args = parser.parse_args()
 	msg1_hash_hex = args.msg1_hash_hex
@@ -90,4 +104,6 @@ if __name__ == '__main__':
 	logging.root.name = os.path.basename(__file__)
 	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
 	n, e = find_n([msg1_hash_hex, msg2_hash_hex], [signature1, signature2], hashfn)
-	print(json.dumps({'n_hex': hex(n), 'e_hex': hex(e)}))
+	# the caller runs one process per message pair, so the cpu time is reported in the output instead of in a metrics export
+	peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	print(json.dumps({'n_hex': hex(n), 'e_hex': hex(e), 'cpu_seconds': time.process_time(), 'peak_rss_bytes': peak_rss_bytes}))
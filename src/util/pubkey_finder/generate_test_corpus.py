@@ -0,0 +1,190 @@
+import argparse
+import base64
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+from dataclasses import dataclass
+from Crypto.Hash import SHA1, SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+sys.path.insert(0, "dkimpy")
+import dkimpy.dkim as dkim
+from dkimpy.dkim.canonicalization import CanonicalizationPolicy
+
+# Generates an mbox file with DKIM signed messages, for measuring extract_signed_data.py, find_public_keys.py
+# and gcd_solver.py without a private mailbox. The messages are signed with locally generated RSA keys,
+# and the public keys are written to truth_keys.tsv, so that the keys found by find_public_keys.py can be checked.
+# The signed data is computed with the canonicalization and header hashing code of the vendored dkimpy fork,
+# which is the same code that extract_signed_data.py uses.
+
+signed_headers = [b'from', b'to', b'subject', b'date', b'message-id', b'mime-version', b'content-type']
+
+words = ('the', 'key', 'message', 'archive', 'domain', 'selector', 'signature', 'mail', 'server', 'report', 'weekly', 'update', 'account', 'invoice', 'meeting', 'project',
+         'release', 'notes', 'thanks', 'regards', 'please', 'review', 'attached', 'schedule', 'tomorrow', 'question')
+
+
+@dataclass
+class SigningKey:
+	domain: str
+	selector: str
+	key: RSA.RsaKey
+	canonicalization: str
+	algorithm: str = 'rsa-sha256'
+
+	def hashfn(self):
+		return hashlib.sha1 if self.algorithm == 'rsa-sha1' else hashlib.sha256
+
+	def public_key_tvl(self) -> str:
+		keyDER = self.key.publickey().export_key(format='DER')
+		return f'k=rsa; p={base64.b64encode(keyDER).decode()}'
+
+
+def random_text(rng: random.Random, lines: int) -> str:
+	result: list[str] = []
+	for _ in range(lines):
+		line = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+		if rng.random() < 0.1:
+			# whitespace that is changed by relaxed body canonicalization
+			line = line.replace(' ', '  ', 1) + ' '
+		result.append(line.capitalize())
+	return '\n'.join(result) + '\n'
+
+
+def message_body(rng: random.Random, attachment_size: int, boundary: str) -> tuple[str, str]:
+	# returns the Content-Type header field value and the body
+	text = random_text(rng, rng.randint(2, 30))
+	if attachment_size <= 0:
+		return 'text/plain; charset="us-ascii"', text
+	attachment = base64.encodebytes(rng.randbytes(attachment_size)).decode()
+	parts = [
+	    f'--{boundary}\nContent-Type: text/plain; charset="us-ascii"\n\n{text}',
+	    f'--{boundary}\nContent-Type: application/octet-stream; name="data.bin"\nContent-Transfer-Encoding: base64\n'
+	    f'Content-Disposition: attachment; filename="data.bin"\n\n{attachment}',
+	    f'--{boundary}--\n',
+	]
+	return f'multipart/mixed; boundary="{boundary}"', '\n'.join(parts)
+
+
+def dkim_signature_header(signing_key: SigningKey, headers: list[list[bytes]], body: bytes, timestamp: int) -> bytes:
+	# returns a "DKIM-Signature: ..." header field, for a message parsed with dkim.rfc822_parse
+	canon_policy = CanonicalizationPolicy.from_c_value(signing_key.canonicalization.encode())
+	body_hash = base64.b64encode(signing_key.hashfn()(canon_policy.canonicalize_body(body)).digest()).decode()
+	tags = (f' v=1; a={signing_key.algorithm}; c={signing_key.canonicalization}; d={signing_key.domain}; s={signing_key.selector};\r\n'
+	        f'\tt={timestamp}; h={":".join(h.decode() for h in signed_headers)};\r\n'
+	        f'\tbh={body_hash};\r\n'
+	        f'\tb=')
+	sig_header = (b'DKIM-Signature', tags.encode() + b'\r\n')
+	# the same steps as in DomainSigner.verify_sig_process
+	hasher = dkim.HashThrough(signing_key.hashfn()(), True)
+	canonicalized_headers = canon_policy.canonicalize_headers(headers)
+	dkim.hash_headers(hasher, canon_policy, canonicalized_headers, signed_headers, sig_header, {})
+	digest = SHA1.new(hasher.hashed()) if signing_key.algorithm == 'rsa-sha1' else SHA256.new(hasher.hashed())
+	signature = pkcs1_15.new(signing_key.key).sign(digest)
+	return b'DKIM-Signature:' + tags.encode() + base64.b64encode(signature)
+
+
+def generate_message(rng: random.Random, index: int, signing_keys: list[SigningKey], attachment_size: int) -> bytes:
+	# returns the message with LF line endings, with DKIM-Signature header fields for each of the signing keys
+	domain = signing_keys[0].domain
+	timestamp = 1672531200 + rng.randint(0, 365 * 24 * 3600)
+	content_type, body = message_body(rng, attachment_size, f'boundary-{index}')
+	header_lines = [
+	    f'From: Sender {index} <sender{index % 100}@{domain}>',
+	    f'To: recipient@example.org',
+	    f'Subject: {random_text(rng, 1).strip()}',
+	    f'Date: {email.utils.formatdate(timestamp, usegmt=True)}',
+	    f'Message-ID: <{index}.{rng.getrandbits(64):016x}@{domain}>',
+	    'MIME-Version: 1.0',
+	    f'Content-Type: {content_type}',
+	]
+	message = ('\n'.join(header_lines) + '\n\n' + body).encode()
+	headers, crlf_body = dkim.rfc822_parse(message)
+	signatures = [dkim_signature_header(signing_key, headers, crlf_body, timestamp) for signing_key in signing_keys]
+	return b'\n'.join(s.replace(b'\r\n', b'\n') for s in signatures) + b'\n' + message
+
+
+def generate_keys(domains: int, selectors_per_domain: int, key_sizes: list[int], canonicalizations: list[str], algorithms: list[str]) -> list[SigningKey]:
+	signing_keys: list[SigningKey] = []
+	for d in range(domains):
+		for s in range(selectors_per_domain):
+			i = len(signing_keys)
+			key = RSA.generate(key_sizes[i % len(key_sizes)])
+			signing_keys.append(SigningKey(f'domain{d}.example.com', f'selector{s}', key, canonicalizations[i % len(canonicalizations)], algorithms[i % len(algorithms)]))
+		logging.info(f'generated keys for {d + 1}/{domains} domains')
+	return signing_keys
+
+
+def generate_corpus(output_dir: str, signing_keys: list[SigningKey], messages_per_selector: int, signatures_per_message: int, attachment_size: int, seed: int):
+	rng = random.Random(seed)
+	os.makedirs(output_dir, exist_ok=True)
+	mbox_file = os.path.join(output_dir, 'corpus.mbox')
+	messages = 0
+	with open(mbox_file, 'wb') as f:
+		for signing_key in signing_keys:
+			for _ in range(messages_per_selector):
+				others = rng.sample([k for k in signing_keys if k is not signing_key], min(signatures_per_message - 1, len(signing_keys) - 1))
+				message = generate_message(rng, messages, [signing_key] + others, attachment_size)
+				f.write(f'From generator@localhost {email.utils.formatdate(usegmt=True)}\n'.encode() + message + b'\n')
+				messages += 1
+	with open(os.path.join(output_dir, 'truth_keys.tsv'), 'w') as f:
+		for signing_key in signing_keys:
+			print(f'{signing_key.domain}\t{signing_key.selector}\t{signing_key.key.size_in_bits()}\t{signing_key.public_key_tvl()}', file=f)
+	manifest = {
+	    'messages': messages,
+	    'signatures': messages * min(signatures_per_message, len(signing_keys)),
+	    'domain_selector_pairs': len(signing_keys),
+	    'key_sizes': sorted(set(k.key.size_in_bits() for k in signing_keys)),
+	    'canonicalizations': sorted(set(k.canonicalization for k in signing_keys)),
+	    'signing_algorithms': sorted(set(k.algorithm for k in signing_keys)),
+	    'attachment_size': attachment_size,
+	}
+	with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+		json.dump(manifest, f, indent=2)
+	logging.info(f'wrote {messages} messages to {mbox_file}')
+
+
+class ProgramArgs(argparse.Namespace):
+	output_dir: str
+	domains: int
+	selectors_per_domain: int
+	messages_per_selector: int
+	key_sizes: list[int]
+	canonicalizations: list[str]
+	signing_algorithms: list[str]
+	signatures_per_message: int
+	attachment_size: int
+	seed: int
+
+
+def main():
+	parser = argparse.ArgumentParser(description='generate an mbox file with DKIM signed messages and the corresponding public keys, for testing and benchmarks')
+	parser.add_argument('--output-dir', type=str, required=True, help='the directory for corpus.mbox, truth_keys.tsv and manifest.json')
+	parser.add_argument('--domains', type=int, default=10)
+	parser.add_argument('--selectors-per-domain', type=int, default=2)
+	parser.add_argument('--messages-per-selector', type=int, default=4)
+	parser.add_argument('--key-sizes', type=int, nargs='+', default=[1024, 2048], choices=[1024, 2048, 4096])
+	parser.add_argument('--canonicalizations',
+	                    type=str,
+	                    nargs='+',
+	                    default=['relaxed/relaxed', 'simple/simple'],
+	                    choices=['relaxed/relaxed', 'relaxed/simple', 'simple/relaxed', 'simple/simple'])
+	parser.add_argument('--signing-algorithms', type=str, nargs='+', default=['rsa-sha256'], choices=['rsa-sha256', 'rsa-sha1'])
+	parser.add_argument('--signatures-per-message', type=int, default=1, help='sign each message with this many different keys')
+	parser.add_argument('--attachment-size', type=int, default=0, help='add a binary attachment of this many bytes to each message')
+	parser.add_argument('--seed', type=int, default=0, help='seed for the message contents, the keys are always random')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.basicConfig(level=logging.INFO, format='%(name)s: %(levelname)s: %(message)s')
+
+	signing_keys = generate_keys(args.domains, args.selectors_per_domain, args.key_sizes, args.canonicalizations, args.signing_algorithms)
+	generate_corpus(args.output_dir, signing_keys, args.messages_per_selector, args.signatures_per_message, args.attachment_size, args.seed)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,143 @@
+import base64
+import binascii
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Iterable
+from Crypto.PublicKey import RSA
+from gcd_solver import pkcs1_padding
+import gmpy2  # type: ignore
+
+if TYPE_CHECKING:
+	from prisma import Prisma
+
+gmpy2_powmod: Any = gmpy2.powmod  # type: ignore
+
+# Index of RSA public keys that are already known, such as the keys in the DkimRecord table.
+# A signature that verifies under a known key does not need a GCD calculation to find its key:
+# a verification is a single modular exponentiation, while a GCD takes seconds of CPU time.
+# A 2048 bit verification takes about 40 µs, so checking a signature against every known key of its size costs as much as
+# a GCD with about 100k known keys. The candidates for a signature are therefore narrowed down to the keys of the same domain,
+# and the keys that are shared by several domain/selector pairs, which are the keys that are likely to be reused.
+# Keys without known domain/selector pairs, e.g. from a CSV file with only moduli, are only checked if there are few of them.
+
+# the maximum number of keys of one size without domain/selector pairs that are checked for every signature
+max_unattributed_keys = 1000
+
+
+@dataclass
+class KnownKey:
+	n: int
+	e: int
+	keyData: str  # base64 encoded DER, as in DkimRecord.keyData
+	dsps: set[tuple[str, str]] = field(default_factory=set)  # the (domain, selector) pairs that the key is known for
+
+	@property
+	def size(self) -> int:
+		return (self.n.bit_length() + 7) // 8
+
+
+def key_data_from_modulus(n: int, e: int) -> str:
+	keyDER = RSA.construct((n, e)).export_key(format='DER')
+	return binascii.b2a_base64(keyDER, newline=False).decode('utf-8')
+
+
+def signature_and_padded_hash(hash_hex: str, signature: bytes, hashfn: str) -> tuple[Any, Any]:
+	s = gmpy2.mpz(int.from_bytes(signature, 'big'))  # type: ignore
+	m = gmpy2.mpz(int(pkcs1_padding(len(signature), hash_hex, hashfn), 16))  # type: ignore
+	return s, m
+
+
+class KnownKeyIndex:
+	def __init__(self):
+		self.keys: dict[int, KnownKey] = {}  # by modulus
+		self.keys_by_domain: dict[str, list[KnownKey]] = {}
+		# keys by modulus size in bytes, which is the size of the signatures that they produce
+		self.shared_keys_by_size: dict[int, list[KnownKey]] = {}
+		self.unattributed_keys_by_size: dict[int, list[KnownKey]] = {}
+
+	def __len__(self):
+		return len(self.keys)
+
+	def add_key(self, n: int, e: int, keyData: str | None = None, dsp: tuple[str, str] | None = None):
+		key = self.keys.get(n)
+		if key is None:
+			key = self.keys[n] = KnownKey(n, e, keyData or key_data_from_modulus(n, e))
+			if dsp is None:
+				self.unattributed_keys_by_size.setdefault(key.size, []).append(key)
+		if dsp is None or dsp in key.dsps:
+			return
+		if not any(domain == dsp[0] for domain, _ in key.dsps):
+			self.keys_by_domain.setdefault(dsp[0], []).append(key)
+		key.dsps.add(dsp)
+		if len(key.dsps) == 2:
+			self.shared_keys_by_size.setdefault(key.size, []).append(key)
+
+	def add_key_data(self, keyData: str, dsp: tuple[str, str] | None = None):
+		try:
+			key = RSA.import_key(base64.b64decode(keyData))
+		except (ValueError, IndexError, TypeError, binascii.Error):
+			logging.debug(f'skipping invalid key data {keyData[:20]}...')
+			return
+		self.add_key(int(key.n), int(key.e), keyData, dsp)
+
+	def candidates(self, size: int, domain: str) -> list[KnownKey]:
+		# the keys of the given size that a signature of the domain is checked against, see the comment at the top
+		keys = [key for key in self.keys_by_domain.get(domain, ()) if key.size == size]
+		keys += self.shared_keys_by_size.get(size, ())
+		unattributed = [key for key in self.unattributed_keys_by_size.get(size, ()) if not key.dsps]
+		if len(unattributed) <= max_unattributed_keys:
+			keys += unattributed
+		return list({key.n: key for key in keys}.values())
+
+	def verify(self, key: KnownKey, hash_hex: str, signature: bytes, hashfn: str) -> bool:
+		if len(signature) != key.size:
+			return False
+		s, m = signature_and_padded_hash(hash_hex, signature, hashfn)
+		return s < key.n and gmpy2_powmod(s, key.e, key.n) == m
+
+	def find_key(self, hash_hex: str, signature: bytes, hashfn: str, domain: str) -> KnownKey | None:
+		# return the candidate key that the signature verifies under, if any
+		keys = self.candidates(len(signature), domain)
+		if not keys:
+			return None
+		s, m = signature_and_padded_hash(hash_hex, signature, hashfn)
+		for key in keys:
+			if s < key.n and gmpy2_powmod(s, key.e, key.n) == m:
+				return key
+		return None
+
+
+def load_known_keys_from_csv(lines: Iterable[str]) -> KnownKeyIndex:
+	# load the output of modulus_extractor.py, with the columns: id, modulus (hex), and with --with-dsps: domain, selector
+	# the public exponent is not included in the output, DKIM keys in practice use 65537
+	index = KnownKeyIndex()
+	for line in lines:
+		parts = line.strip().split(',')
+		if len(parts) < 2:
+			continue
+		dsp = (parts[2].lower(), parts[3].lower()) if len(parts) >= 4 else None
+		index.add_key(int(parts[1], 16), 0x10001, dsp=dsp)
+	log_index_size(index)
+	return index
+
+
+def log_index_size(index: KnownKeyIndex):
+	shared = sum(len(keys) for keys in index.shared_keys_by_size.values())
+	logging.info(f'loaded {len(index)} known keys, {shared} shared by several domain/selector pairs')
+	for size, keys in index.unattributed_keys_by_size.items():
+		unattributed = sum(1 for key in keys if not key.dsps)
+		if unattributed > max_unattributed_keys:
+			logging.warning(f'{unattributed} {size * 8} bit keys without domain/selector pairs are not used, see modulus_extractor.py --with-dsps')
+
+
+async def load_known_keys_from_db(prisma: 'Prisma') -> KnownKeyIndex:
+	index = KnownKeyIndex()
+	rows = await prisma.query_raw('''
+		SELECT DISTINCT r."keyData", d.domain, d.selector
+		FROM "DkimRecord" r JOIN "DomainSelectorPair" d ON d.id = r."domainSelectorPairId"
+		WHERE r."keyType" = 'RSA' AND r."keyData" IS NOT NULL AND r."keyData" NOT IN ('', '-')
+		''')
+	for row in rows:
+		index.add_key_data(row['keyData'], (row['domain'].lower(), row['selector'].lower()))
+	log_index_size(index)
+	return index
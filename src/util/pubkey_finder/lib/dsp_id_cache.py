@@ -0,0 +1,105 @@
+import logging
+from typing import Iterable
+from prisma import Prisma
+
+# Ids of DomainSelectorPair rows by domain and selector, for the importers that look up or create a domain/selector pair
+# for each signature or key. The ids are loaded and created in batches with one query per batch, relying on the unique index
+# on (domain, selector), instead of one or two queries per domain/selector pair.
+# The pairs that were not found are remembered too, until they are created with get_or_create_ids.
+# Pairs that are created in a transaction are kept in a TransactionDspIds until the transaction is committed,
+# so that concurrent transactions do not use the id of a row that they can not see, or that is rolled back.
+# The pairs are (domain, selector) tuples, in lower case like common.Dsp, so that the cache can be used both from the scripts
+# in this directory and from the scripts in the parent directory, which import common.Dsp as different classes.
+
+# number of domain/selector pairs per query
+batch_size = 10000
+
+DspKey = tuple[str, str]
+
+
+def batches(dsps: list[DspKey]) -> Iterable[tuple[list[str], list[str]]]:
+	for i in range(0, len(dsps), batch_size):
+		batch = dsps[i:i + batch_size]
+		yield [domain for domain, _ in batch], [selector for _, selector in batch]
+
+
+class DspIdCache:
+	def __init__(self):
+		self.ids: dict[DspKey, int] = {}
+		self.missing: set[DspKey] = set()
+
+	def __len__(self):
+		return len(self.ids)
+
+	def transaction(self) -> 'TransactionDspIds':
+		return TransactionDspIds(self)
+
+	async def fetch(self, prisma: Prisma, dsps: list[DspKey]):
+		for domains, selectors in batches(dsps):
+			rows = await prisma.query_raw(
+			    '''
+				SELECT d.id, d.domain, d.selector
+				FROM "DomainSelectorPair" d
+				JOIN unnest($1::text[], $2::text[]) AS t(domain, selector) ON d.domain = t.domain AND d.selector = t.selector
+				''', domains, selectors)
+			for row in rows:
+				self.ids[(row['domain'], row['selector'])] = row['id']
+		self.missing.update(dsp for dsp in dsps if dsp not in self.ids)
+
+	async def get_ids(self, prisma: Prisma, dsps: Iterable[DspKey]) -> dict[DspKey, int]:
+		# the ids of the domain/selector pairs that exist, the pairs that are not cached are looked up with one query per batch
+		dsps = list(dict.fromkeys(dsps))
+		unknown = [dsp for dsp in dsps if dsp not in self.ids and dsp not in self.missing]
+		if unknown:
+			await self.fetch(prisma, unknown)
+		return {dsp: self.ids[dsp] for dsp in dsps if dsp in self.ids}
+
+	async def get_id(self, prisma: Prisma, dsp: DspKey) -> int | None:
+		return (await self.get_ids(prisma, [dsp])).get(dsp)
+
+	async def get_or_create_ids(self, prisma: Prisma, dsps: Iterable[DspKey], source_identifier: str, created: dict[DspKey, int] | None = None) -> dict[DspKey, int]:
+		# the ids of the domain/selector pairs, the pairs that do not exist are created with one query per batch
+		# the ids of the created pairs are added to created instead of the cache if it is set, see TransactionDspIds
+		dsps = list(dict.fromkeys(dsps))
+		await self.get_ids(prisma, dsps)
+		created_ids = self.ids if created is None else created
+		to_create = [dsp for dsp in dsps if dsp not in self.ids]
+		for domains, selectors in batches(to_create):
+			# pairs that were created by another process in the meantime are not returned, and are looked up below
+			rows = await prisma.query_raw(
+			    '''
+				INSERT INTO "DomainSelectorPair" (domain, selector, "sourceIdentifier")
+				SELECT domain, selector, $3 FROM unnest($1::text[], $2::text[]) AS t(domain, selector)
+				ON CONFLICT (domain, selector) DO NOTHING
+				RETURNING id, domain, selector
+				''', domains, selectors, source_identifier)
+			for row in rows:
+				created_ids[(row['domain'], row['selector'])] = row['id']
+			if rows:
+				logging.info(f'created {len(rows)} domain/selector pairs')
+		self.missing.difference_update(to_create)
+		not_created = [dsp for dsp in to_create if dsp not in created_ids]
+		if not_created:
+			await self.fetch(prisma, not_created)
+		return {dsp: self.ids.get(dsp) or created_ids[dsp] for dsp in dsps if dsp in self.ids or dsp in created_ids}
+
+	async def get_or_create_id(self, prisma: Prisma, dsp: DspKey, source_identifier: str) -> int:
+		return (await self.get_or_create_ids(prisma, [dsp], source_identifier))[dsp]
+
+
+class TransactionDspIds:
+	# the ids of the domain/selector pairs that were created in one transaction, which are added to the cache by commit,
+	# after the transaction was committed
+
+	def __init__(self, cache: DspIdCache):
+		self.cache = cache
+		self.created: dict[DspKey, int] = {}
+
+	async def get_or_create_id(self, prisma: Prisma, dsp: DspKey, source_identifier: str) -> int:
+		if dsp in self.created:
+			return self.created[dsp]
+		return (await self.cache.get_or_create_ids(prisma, [dsp], source_identifier, self.created))[dsp]
+
+	def commit(self):
+		self.cache.ids.update(self.created)
+		self.created = {}
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import mmap
+import os
+from dataclasses import dataclass, field
+
+# Sidecar index of the messages in an mbox file that have already been extracted to a .datasig file,
+# so that an append-only mbox file can be processed incrementally.
+#
+# The index is a tab separated file with one line per processed message:
+#   <offset of the message data after the "From " line> <length> <content hash> <Message-ID>
+# followed by a checkpoint line after each run:
+#   #checkpoint <end offset> <.datasig file size> <number of messages>
+# Lines after the last checkpoint are from an interrupted run and are ignored. The .datasig file is truncated to the
+# size in the checkpoint before new results are appended, so an interrupted run does not leave duplicate results.
+
+checkpoint_prefix = '#checkpoint'
+
+
+@dataclass(slots=True)
+class IndexEntry:
+	offset: int
+	length: int
+	contentHash: str
+	messageId: str
+
+
+@dataclass
+class MboxIndex:
+	entries: list[IndexEntry] = field(default_factory=list)
+	endOffset: int = 0  # the end of the last processed message, where the next run starts scanning
+	datasigSize: int = 0
+	indexSize: int = 0  # the size of the index file up to the last checkpoint
+
+	def content_hashes(self) -> set[str]:
+		return {entry.contentHash for entry in self.entries}
+
+
+def content_hash(raw_message: bytes) -> str:
+	return hashlib.sha256(raw_message).hexdigest()[:32]
+
+
+def normalize_message_id(message_id: object) -> str:
+	return ' '.join(str(message_id).split()) if message_id else '-'
+
+
+def load_index(index_file: str) -> MboxIndex | None:
+	if not os.path.exists(index_file):
+		return None
+	index = MboxIndex()
+	pending: list[IndexEntry] = []
+	position = 0
+	with open(index_file, 'rb') as f:
+		for line in f:
+			position += len(line)
+			if not line.endswith(b'\n'):
+				break
+			parts = line.decode('utf-8', 'replace').rstrip('\n').split('\t')
+			if parts[0] == checkpoint_prefix:
+				index.entries.extend(pending)
+				pending = []
+				index.endOffset, index.datasigSize = int(parts[1]), int(parts[2])
+				index.indexSize = position
+				if int(parts[3]) != len(index.entries):
+					logging.warning(f'{index_file}: checkpoint with {parts[3]} messages after {len(index.entries)} entries, ignoring the index')
+					return None
+			else:
+				pending.append(IndexEntry(int(parts[0]), int(parts[1]), parts[2], parts[3]))
+	if index.indexSize == 0:
+		return None
+	return index
+
+
+def index_matches(index: MboxIndex, data: mmap.mmap | bytes, datasig_size: int) -> bool:
+	# check that the mbox file has only been appended to since the index was written, by comparing the first and the last
+	# indexed message, and that the .datasig file contains the results up to the checkpoint
+	if len(data) < index.endOffset or datasig_size < index.datasigSize:
+		return False
+	for entry in index.entries[:1] + index.entries[-1:]:
+		if content_hash(data[entry.offset:entry.offset + entry.length]) != entry.contentHash:
+			return False
+	return True
+
+
+def append_to_index(index_file: str, index: MboxIndex | None, entries: list[IndexEntry], end_offset: int, datasig_size: int):
+	# start a new index file if index is None, otherwise drop the lines after the last checkpoint and append to it
+	mode = 'wb' if index is None else 'r+b'
+	messages = len(entries) if index is None else len(index.entries) + len(entries)
+	with open(index_file, mode) as f:
+		if index is not None:
+			f.seek(index.indexSize)
+			f.truncate()
+		for entry in entries:
+			f.write(f'{entry.offset}\t{entry.length}\t{entry.contentHash}\t{entry.messageId}\n'.encode('utf-8', 'replace'))
+		f.write(f'{checkpoint_prefix}\t{end_offset}\t{datasig_size}\t{messages}\n'.encode())
+		f.flush()
+		os.fsync(f.fileno())
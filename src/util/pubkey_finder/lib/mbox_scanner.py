@@ -0,0 +1,119 @@
+import email.message
+import email.parser
+import logging
+import mmap
+import multiprocessing
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+# Memory-mapped mbox scanner which reads each mbox file once and fans out every message to a set of collectors,
+# so that several reports can be produced from one pass over the files.
+# Large files are split into chunks at message boundaries, and files and chunks are scanned in parallel.
+
+# the size of the byte ranges that are scanned by each process
+default_chunk_size = 256 * 1024 * 1024
+
+
+@dataclass(slots=True)
+class ScannedMessage:
+	mboxFile: str
+	offset: int  # byte offset of the "From " line of the message
+	start: int  # byte offset of the message data, after the "From " line
+	end: int
+	headers: email.message.Message
+	data: mmap.mmap | bytes  # bytes for empty files, which can not be memory-mapped
+
+	def raw(self) -> bytes:
+		# the message as returned by mailbox.mbox.get_bytes
+		return self.data[self.start:self.end]
+
+
+class Collector(ABC):
+	# base class for collectors, which must be picklable so that they can be returned from the worker processes
+
+	@abstractmethod
+	def collect(self, msg: ScannedMessage):
+		...
+
+	@abstractmethod
+	def merge(self, other: Any):
+		...
+
+
+CollectorFactory = Callable[[], Collector]
+
+
+def find_message_start(data: mmap.mmap | bytes, pos: int, stop: int) -> int:
+	# find the first "From " line that starts at or after pos and before stop, or return -1
+	if pos == 0 and data[:5] == b'From ':
+		return 0
+	i = data.find(b'\nFrom ', max(pos - 1, 0), stop + 5)
+	return i + 1 if i >= 0 and i + 1 < stop else -1
+
+
+def find_header_end(data: mmap.mmap | bytes, start: int, end: int) -> int:
+	ends = [i for i in (data.find(b'\n\n', start, end), data.find(b'\r\n\r\n', start, end)) if i >= 0]
+	return min(ends) + 1 if ends else end
+
+
+def iter_mbox_messages(mboxFile: str, data: mmap.mmap | bytes, rangeStart: int = 0, rangeStop: int | None = None) -> Iterator[ScannedMessage]:
+	# yield the messages whose "From " line starts in [rangeStart, rangeStop)
+	if rangeStop is None:
+		rangeStop = len(data)
+	parser = email.parser.BytesHeaderParser()
+	offset = find_message_start(data, rangeStart, rangeStop)
+	while offset >= 0:
+		start = data.find(b'\n', offset) + 1
+		if start == 0:
+			return
+		next_offset = find_message_start(data, start, len(data))
+		end = len(data) if next_offset < 0 else next_offset
+		if data[end - 2:end] == b'\n\n':
+			end -= 1  # the empty line before the next "From " line (or at the end of the file) is not part of the message
+		headers = parser.parsebytes(data[start:find_header_end(data, start, end)])
+		yield ScannedMessage(mboxFile, offset, start, end, headers, data)
+		offset = next_offset if next_offset < rangeStop else -1
+
+
+def iter_mbox_file(mboxFile: str) -> Iterator[ScannedMessage]:
+	with open(mboxFile, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			yield from iter_mbox_messages(mboxFile, data)
+
+
+def scan_range(mboxFile: str, rangeStart: int, rangeStop: int, collectorFactories: list[CollectorFactory]) -> list[Collector]:
+	collectors = [factory() for factory in collectorFactories]
+	with open(mboxFile, 'rb') as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			for msg in iter_mbox_messages(mboxFile, data, rangeStart, rangeStop):
+				for collector in collectors:
+					collector.collect(msg)
+	return collectors
+
+
+def scan_range_star(args: tuple[str, int, int, list[CollectorFactory]]) -> list[Collector]:
+	return scan_range(*args)
+
+
+def split_into_ranges(mboxFiles: list[str], chunkSize: int) -> list[tuple[str, int, int]]:
+	ranges: list[tuple[str, int, int]] = []
+	for mboxFile in mboxFiles:
+		size = os.path.getsize(mboxFile)
+		ranges.extend((mboxFile, start, min(start + chunkSize, size)) for start in range(0, size, chunkSize))
+	return ranges
+
+
+def scan_mbox_files(mboxFiles: list[str], collectorFactories: list[CollectorFactory], processes: int | None = None, chunkSize: int = default_chunk_size) -> list[Collector]:
+	# return one collector per factory, with the merged results for all messages in all files
+	results = [factory() for factory in collectorFactories]
+	ranges = split_into_ranges(mboxFiles, chunkSize)
+	logging.info(f'scanning {len(mboxFiles)} mbox files in {len(ranges)} chunks')
+	with multiprocessing.Pool(processes) as pool:
+		for collectors in pool.imap_unordered(scan_range_star, [(mboxFile, start, stop, collectorFactories) for mboxFile, start, stop in ranges]):
+			for result, collector in zip(results, collectors):
+				result.merge(collector)
+	return results
@@ -0,0 +1,146 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator
+
+# Process-wide counters, timers and histograms for the batch tools.
+#
+# The metrics are always collected, and are written at exit if the job calls enable_export() and the UTIL_METRICS_DIR
+# environment variable is set (or a directory is passed to enable_export), as:
+#   <dir>/<job>.prom  - Prometheus text format, for the node_exporter textfile collector
+#   <dir>/<job>.json  - JSON summary
+# Timers are histograms of durations in seconds, named <name>_seconds.
+# Metrics are not shared between processes: tools that run worker processes only record what happens in the main process.
+
+metrics_dir_env = 'UTIL_METRICS_DIR'
+metric_prefix = 'dkim_util_'
+
+default_buckets = (0.001, 0.01, 0.1, 1, 10, 100, 1000, 10000)
+
+
+@dataclass
+class Histogram:
+	buckets: tuple[float, ...]
+	counts: list[int] = field(default_factory=list)
+	sum: float = 0
+	count: int = 0
+	min: float | None = None
+	max: float | None = None
+
+	def __post_init__(self):
+		if not self.counts:
+			self.counts = [0] * len(self.buckets)
+
+	def observe(self, value: float):
+		i = bisect.bisect_left(self.buckets, value)
+		if i < len(self.buckets):
+			self.counts[i] += 1
+		self.sum += value
+		self.count += 1
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+
+
+lock = threading.Lock()
+counters: dict[str, float] = {}
+histograms: dict[str, Histogram] = {}
+start_time = time.time()
+
+
+def increment(name: str, value: float = 1):
+	with lock:
+		counters[name] = counters.get(name, 0) + value
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...] = default_buckets):
+	with lock:
+		histogram = histograms.get(name)
+		if histogram is None:
+			histogram = histograms[name] = Histogram(buckets)
+		histogram.observe(value)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		observe(f'{name}_seconds', time.perf_counter() - start)
+
+
+def summary(job: str) -> dict[str, object]:
+	with lock:
+		return {
+		    'job': job,
+		    'start_time': start_time,
+		    'duration_seconds': time.time() - start_time,
+		    'counters': dict(sorted(counters.items())),
+		    'histograms': {
+		        name: {
+		            'count': h.count,
+		            'sum': h.sum,
+		            'min': h.min,
+		            'max': h.max,
+		            'mean': h.sum / h.count if h.count else None,
+		            'buckets': dict(zip(map(str, h.buckets), h.counts)),
+		        }
+		        for name, h in sorted(histograms.items())
+		    },
+		}
+
+
+def metric_name(name: str) -> str:
+	return metric_prefix + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def to_prometheus(job: str) -> str:
+	labels = f'job="{job}"'
+	lines: list[str] = []
+	with lock:
+		lines.append(f'# TYPE {metric_name("duration_seconds")} gauge')
+		lines.append(f'{metric_name("duration_seconds")}{{{labels}}} {time.time() - start_time}')
+		lines.append(f'# TYPE {metric_name("last_run_timestamp_seconds")} gauge')
+		lines.append(f'{metric_name("last_run_timestamp_seconds")}{{{labels}}} {time.time()}')
+		for name, value in sorted(counters.items()):
+			lines.append(f'# TYPE {metric_name(name)}_total counter')
+			lines.append(f'{metric_name(name)}_total{{{labels}}} {value}')
+		for name, h in sorted(histograms.items()):
+			lines.append(f'# TYPE {metric_name(name)} histogram')
+			cumulative = 0
+			for bucket, count in zip(h.buckets, h.counts):
+				cumulative += count
+				lines.append(f'{metric_name(name)}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+			lines.append(f'{metric_name(name)}_bucket{{{labels},le="+Inf"}} {h.count}')
+			lines.append(f'{metric_name(name)}_sum{{{labels}}} {h.sum}')
+			lines.append(f'{metric_name(name)}_count{{{labels}}} {h.count}')
+	return '\n'.join(lines) + '\n'
+
+
+def write_atomically(filename: str, data: str):
+	# the textfile collector may read the file at any time, so it is replaced rather than rewritten in place
+	tmp_filename = f'{filename}.tmp'
+	with open(tmp_filename, 'w') as f:
+		f.write(data)
+	os.replace(tmp_filename, filename)
+
+
+def export(job: str, directory: str):
+	os.makedirs(directory, exist_ok=True)
+	write_atomically(os.path.join(directory, f'{job}.prom'), to_prometheus(job))
+	write_atomically(os.path.join(directory, f'{job}.json'), json.dumps(summary(job), indent=2) + '\n')
+	logging.info(f'metrics written to {directory}/{job}.prom and {job}.json')
+
+
+def enable_export(job: str, directory: str | None = None):
+	directory = directory or os.environ.get(metrics_dir_env)
+	if not directory:
+		return
+	atexit.register(export, job, directory)
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import sys
 import time
+from typing import TextIO
 
 
 @dataclass
@@ -7,10 +9,13 @@ class ProgressReporter:
 	total: int
 	current: int
 	last_printed_time: float = 0
+	file: TextIO = sys.stdout
+	start_time: float = field(default_factory=time.time)
 
-	def increment(self):
-		self.current += 1
+	def increment(self, count: int = 1):
+		self.current += count
 		if time.time() - self.last_printed_time < 0.2:
 			return
 		self.last_printed_time = time.time()
-		print(f'\r{self.current}/{self.total}', end='', flush=True)
+		rate = self.current / max(self.last_printed_time - self.start_time, 1e-6)
+		print(f'\r{self.current}/{self.total} ({rate:.0f}/s)', end='', file=self.file, flush=True)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import base64
+import binascii
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+from Crypto.PublicKey import RSA
+from prisma import Prisma
+from prisma.enums import KeyType
+from dkim_util import DecodeTvlException, decode_dkim_tag_value_list
+from dns_cache import TxtRecords, query_txt_async
+from populate_key_columns import KeyInfo, TagsNotPresentException, str_to_key_type
+from pubkey_finder.lib import metrics
+
+# Refreshes the DKIM records of all stale domain/selector pairs from DNS, the same way as /api/batch_update,
+# but for many pairs at a time instead of a small batch per request:
+#
+# - the pairs whose lastRecordUpdate is older than --max-age-hours (or not set) are selected in pages ordered by id
+# - the TXT records of each page are resolved concurrently
+# - each TXT record is compared with the existing DkimRecord values of the pair: for a known value, lastSeenAt is set
+#   to the time of the lookup, otherwise a new record is created
+# - the new records and the lastSeenAt and lastRecordUpdate updates of a page are written in one transaction
+#
+# A pair is only marked as updated when the lookup succeeded or returned no records; after a timeout or a server failure,
+# it is selected again on the next run.
+# Unlike the API, no provenance witness is generated for new records, they are created with provenanceVerified = false.
+
+
+@dataclass
+class Dsp:
+	id: int
+	domain: str
+	selector: str
+
+
+@dataclass
+class NewRecord:
+	dspId: int
+	value: str
+	keyType: KeyType
+	keyData: str | None
+
+
+@dataclass
+class PageUpdate:
+	updated_dsp_ids: list[int] = field(default_factory=list)
+	seen_record_ids: list[int] = field(default_factory=list)
+	new_records: list[NewRecord] = field(default_factory=list)
+
+
+@dataclass
+class RefreshCounts:
+	dsps: int = 0
+	dns_errors: int = 0
+	no_records: int = 0
+	created_records: int = 0
+	seen_records: int = 0
+	invalid_records: int = 0
+
+	def log(self, start_time: float):
+		elapsed = time.time() - start_time
+		logging.info(f'{self.dsps} domain/selector pairs in {elapsed:.0f} s ({self.dsps / max(elapsed, 1e-9):.1f}/s), '
+		             f'created records: {self.created_records}, seen records: {self.seen_records}, invalid records: {self.invalid_records}, '
+		             f'no records: {self.no_records}, dns errors: {self.dns_errors}')
+
+
+def decode_key_info(tvl: str) -> KeyInfo:
+	# like decodeKeyInfo in src/lib/utils_server.ts: the RSA key is validated with pycryptodome instead of openssl asn1parse,
+	# to avoid two process launches per record
+	values = decode_dkim_tag_value_list(tvl)
+	key_type = str_to_key_type(values.get('k'))
+	if 'p' not in values:
+		raise TagsNotPresentException(f'No p= tag in DKIM tag-value-list: {tvl}')
+	p_base64 = values['p'].strip()
+	if p_base64 == '':
+		# an empty p= tag is allowed and means that the key is revoked, see https://datatracker.ietf.org/doc/html/rfc6376#section-3.6.1
+		return KeyInfo(key_type, '')
+	if key_type != KeyType.RSA:
+		return KeyInfo(key_type, None)
+	p_binary = base64.b64decode(p_base64)
+	RSA.import_key(p_binary)
+	return KeyInfo(key_type, base64.b64encode(p_binary).decode('utf-8'))
+
+
+async def fetch_stale_dsps(prisma: Prisma, after_id: int, stale_before: datetime, page_size: int) -> list[Dsp]:
+	rows = await prisma.query_raw(
+	    '''
+		SELECT id, domain, selector FROM "DomainSelectorPair"
+		WHERE id > $1 AND ("lastRecordUpdate" IS NULL OR "lastRecordUpdate" < $2::timestamp)
+		ORDER BY id
+		LIMIT $3
+		''', after_id, stale_before.isoformat(), page_size)
+	return [Dsp(row['id'], row['domain'], row['selector']) for row in rows]
+
+
+async def fetch_record_values(prisma: Prisma, dsp_ids: list[int]) -> dict[tuple[int, str], int]:
+	# the id of the latest record for each domain/selector pair and value
+	rows = await prisma.query_raw(
+	    '''
+		SELECT DISTINCT ON ("domainSelectorPairId", value) id, "domainSelectorPairId", value
+		FROM "DkimRecord"
+		WHERE "domainSelectorPairId" = ANY($1::int[])
+		ORDER BY "domainSelectorPairId", value, id DESC
+		''', dsp_ids)
+	return {(row['domainSelectorPairId'], row['value']): row['id'] for row in rows}
+
+
+async def resolve_dsp(resolver: dns.asyncresolver.Resolver, semaphore: asyncio.Semaphore, dsp: Dsp) -> TxtRecords | None | Exception:
+	# returns the TXT records, None if there are none, or the exception on a transient error
+	qname = f'{dsp.selector}._domainkey.{dsp.domain}'
+	async with semaphore:
+		try:
+			with metrics.timer('dns_query'):
+				records, _ttl = await query_txt_async(resolver, qname)
+			return records
+		except (dns.resolver.NoNameservers, dns.exception.Timeout) as e:
+			return e
+		except dns.exception.DNSException as e:
+			# e.g. an invalid name, which will not resolve on the next run either
+			logging.debug(f'{qname}: {e!r}')
+			return None
+
+
+def diff_page(dsps: list[Dsp], results: list[TxtRecords | None | Exception], existing: dict[tuple[int, str], int], counts: RefreshCounts) -> PageUpdate:
+	update = PageUpdate()
+	created: set[tuple[int, str]] = set()
+	for dsp, records in zip(dsps, results):
+		if isinstance(records, Exception):
+			logging.debug(f'{dsp.selector}._domainkey.{dsp.domain}: {records!r}')
+			counts.dns_errors += 1
+			continue
+		update.updated_dsp_ids.append(dsp.id)
+		if not records:
+			counts.no_records += 1
+			continue
+		for record in records:
+			try:
+				value = record.decode('utf-8')
+			except UnicodeDecodeError:
+				counts.invalid_records += 1
+				continue
+			if (dsp.id, value) in created:
+				# the same value may be returned twice for a name
+				continue
+			record_id = existing.get((dsp.id, value))
+			if record_id is not None:
+				update.seen_record_ids.append(record_id)
+				continue
+			try:
+				key_info = decode_key_info(value)
+			except (DecodeTvlException, TagsNotPresentException, ValueError, IndexError, TypeError, binascii.Error) as e:
+				logging.debug(f'{dsp.selector}._domainkey.{dsp.domain}: invalid record {value[:50]}: {e}')
+				counts.invalid_records += 1
+				continue
+			update.new_records.append(NewRecord(dsp.id, value, key_info.key_type, key_info.key_data_base64))
+			created.add((dsp.id, value))
+	return update
+
+
+async def write_page(prisma: Prisma, update: PageUpdate, timestamp: datetime):
+	ts = timestamp.isoformat()
+	async with prisma.tx(max_wait=timedelta(seconds=10), timeout=timedelta(minutes=5)) as tx:
+		if update.new_records:
+			columns: list[list[Any]] = [
+			    [r.dspId for r in update.new_records],
+			    [r.value for r in update.new_records],
+			    [r.keyType.value for r in update.new_records],
+			    [r.keyData for r in update.new_records],
+			]
+			await tx.execute_raw(
+			    '''
+				INSERT INTO "DkimRecord" ("domainSelectorPairId", "firstSeenAt", "lastSeenAt", "provenanceVerified", value, "keyType", "keyData")
+				SELECT dsp_id, $5::timestamp, $5::timestamp, false, value, key_type::"KeyType", key_data
+				FROM unnest($1::int[], $2::text[], $3::text[], $4::text[]) AS t(dsp_id, value, key_type, key_data)
+				''', *columns, ts)
+		if update.seen_record_ids:
+			await tx.execute_raw('''UPDATE "DkimRecord" SET "lastSeenAt" = $2::timestamp WHERE id = ANY($1::int[])''', update.seen_record_ids, ts)
+		if update.updated_dsp_ids:
+			await tx.execute_raw('''UPDATE "DomainSelectorPair" SET "lastRecordUpdate" = $2::timestamp WHERE id = ANY($1::int[])''', update.updated_dsp_ids, ts)
+
+
+async def refresh_dkim_records(prisma: Prisma, resolver: dns.asyncresolver.Resolver, max_age: timedelta, page_size: int, concurrency: int, max_dsps: int | None) -> RefreshCounts:
+	counts = RefreshCounts()
+	semaphore = asyncio.Semaphore(concurrency)
+	# the timestamp columns are UTC without time zone
+	stale_before = datetime.now(timezone.utc).replace(tzinfo=None) - max_age
+	start_time = time.time()
+	after_id = 0
+	while max_dsps is None or counts.dsps < max_dsps:
+		limit = page_size if max_dsps is None else min(page_size, max_dsps - counts.dsps)
+		dsps = await fetch_stale_dsps(prisma, after_id, stale_before, limit)
+		if not dsps:
+			break
+		after_id = dsps[-1].id
+		timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+		with metrics.timer('refresh_dkim_records_resolve_page'):
+			results = await asyncio.gather(*(resolve_dsp(resolver, semaphore, dsp) for dsp in dsps))
+		existing = await fetch_record_values(prisma, [dsp.id for dsp in dsps])
+		page_counts = RefreshCounts(dsps=len(dsps))
+		update = diff_page(dsps, results, existing, page_counts)
+		with metrics.timer('refresh_dkim_records_write_page'):
+			await write_page(prisma, update, timestamp)
+		page_counts.created_records = len(update.new_records)
+		page_counts.seen_records = len(update.seen_record_ids)
+		for name, value in vars(page_counts).items():
+			setattr(counts, name, getattr(counts, name) + value)
+			metrics.increment(f'refresh_dkim_records_{name}', value)
+		counts.log(start_time)
+	return counts
+
+
+class ProgramArgs(argparse.Namespace):
+	max_age_hours: float
+	page_size: int
+	concurrency: int
+	timeout: float
+	max_dsps: int | None
+
+
+async def main():
+	parser = argparse.ArgumentParser(description='refresh the DKIM records of stale domain/selector pairs from DNS')
+	parser.add_argument('--max-age-hours', type=float, default=24, help='refresh the pairs whose records were last updated longer ago than this')
+	parser.add_argument('--page-size', type=int, default=1000, help='the number of pairs that are resolved and written per transaction')
+	parser.add_argument('--concurrency', type=int, default=200, help='the number of DNS queries in flight at the same time')
+	parser.add_argument('--timeout', type=float, default=5, help='DNS query timeout in seconds')
+	parser.add_argument('--max-dsps', type=int, help='stop after this many pairs')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.basicConfig(level=logging.INFO)
+	logging.getLogger("httpx").setLevel(logging.WARNING)
+	metrics.enable_export('refresh_dkim_records')
+
+	resolver = dns.asyncresolver.Resolver()
+	resolver.timeout = args.timeout
+	resolver.lifetime = args.timeout
+
+	prisma = Prisma()
+	await prisma.connect()
+	counts = await refresh_dkim_records(prisma, resolver, timedelta(hours=args.max_age_hours), args.page_size, args.concurrency, args.max_dsps)
+	await prisma.disconnect()
+	logging.info(f'done: {counts}')
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -1,99 +1,145 @@
 #!/usr/bin/env python
 
+import asyncio
 import collections
+import heapq
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from itertools import chain
 import logging
-import mailbox
+import multiprocessing
+import os
 import re
 import sys
+import time
+import email.message
+import email.parser
 import email.utils
 import argparse
-from typing import TextIO
+from functools import partial
+from typing import TYPE_CHECKING, Iterable, Iterator, TextIO
 from tqdm import tqdm
 from dkim_util import DecodeTvlException, decode_dkim_tag_value_list
-import dns.exception
-import dns.resolver
-import dns.rdatatype
-from db_util import load_dkim_records_with_dsps
+from dns_cache import DnsCache, default_cache_file, normalize_qname
+from db_util import iter_dkim_records_with_dsps
+from pubkey_finder.lib import metrics
+from pubkey_finder.lib.mbox_scanner import Collector, CollectorFactory, ScannedMessage, iter_mbox_file, scan_mbox_files
 import dkim  # type: ignore
-from dkim.dnsplug import get_txt_dnspython  # type: ignore
 import pickle
-import xml.etree.ElementTree as ET
-
-
-def domain_statistics(mboxFile: str):
-	totalMsgCount = 0
-	fromAndDkimDomainSameCount = 0
-	fromAndDkimDomainDifferentCount = 0
-	totalWithDkimSigCount = 0
-	dkimDomains: set[str] = set()
-	fromDomains: set[str] = set()
-	for message in mailbox.mbox(mboxFile):
-		totalMsgCount += 1
+from xml.sax.saxutils import escape as xml_escape
+
+if TYPE_CHECKING:
+	from prisma import Prisma
+
+
+@dataclass
+class DomainStatisticsCollector(Collector):
+	totalMsgCount: int = 0
+	fromAndDkimDomainSameCount: int = 0
+	fromAndDkimDomainDifferentCount: int = 0
+	totalWithDkimSigCount: int = 0
+	dkimDomains: set[str] = field(default_factory=set)
+	fromDomains: set[str] = field(default_factory=set)
+
+	def collect(self, msg: ScannedMessage):
+		message = msg.headers
+		self.totalMsgCount += 1
 		dkimSignature = message['DKIM-Signature']
 		if not dkimSignature:
-			continue
-		totalWithDkimSigCount += 1
+			return
+		self.totalWithDkimSigCount += 1
 		fromAddress = message['From']
 		if (type(fromAddress) != str):
 			logging.debug(f'warning: invalid From header {fromAddress}')
-			continue
+			return
 		fromAddress = email.utils.parseaddr(fromAddress)[1]
 		if not fromAddress:
 			logging.debug(f'warning: invalid From header {fromAddress}')
-			continue
+			return
 		fromDomain = fromAddress.rpartition('@')[2]
 		dkimRecord = decode_dkim_tag_value_list(dkimSignature)
 		dkimDomain = dkimRecord['d']
-		dkimDomains.add(dkimDomain)
-		fromDomains.add(fromDomain)
+		self.dkimDomains.add(dkimDomain)
+		self.fromDomains.add(fromDomain)
 		if fromDomain != dkimDomain:
-			fromAndDkimDomainDifferentCount += 1
+			self.fromAndDkimDomainDifferentCount += 1
 		else:
-			fromAndDkimDomainSameCount += 1
-
-	print(f'total messages: {totalMsgCount}')
-	print(f'total messages with dkim signature: {totalWithDkimSigCount}')
-	print(f'from domain and dkim domain are the same: {fromAndDkimDomainSameCount} ({fromAndDkimDomainSameCount / totalWithDkimSigCount * 100:.2f}%)')
-	print(f'from domain and dkim domain are different: {fromAndDkimDomainDifferentCount} ({fromAndDkimDomainDifferentCount / totalWithDkimSigCount * 100:.2f}%)')
+			self.fromAndDkimDomainSameCount += 1
+
+	def merge(self, other: 'DomainStatisticsCollector'):
+		self.totalMsgCount += other.totalMsgCount
+		self.fromAndDkimDomainSameCount += other.fromAndDkimDomainSameCount
+		self.fromAndDkimDomainDifferentCount += other.fromAndDkimDomainDifferentCount
+		self.totalWithDkimSigCount += other.totalWithDkimSigCount
+		self.dkimDomains |= other.dkimDomains
+		self.fromDomains |= other.fromDomains
+
+
+def domain_statistics(stats: DomainStatisticsCollector):
+	print(f'total messages: {stats.totalMsgCount}')
+	print(f'total messages with dkim signature: {stats.totalWithDkimSigCount}')
+	print(f'from domain and dkim domain are the same: {stats.fromAndDkimDomainSameCount} ({stats.fromAndDkimDomainSameCount / stats.totalWithDkimSigCount * 100:.2f}%)')
+	print(f'from domain and dkim domain are different: {stats.fromAndDkimDomainDifferentCount} ({stats.fromAndDkimDomainDifferentCount / stats.totalWithDkimSigCount * 100:.2f}%)')
 	print()
-	print(f'dkim domains: {len(dkimDomains)}')
-	for dkimDomain in sorted(dkimDomains):
+	print(f'dkim domains: {len(stats.dkimDomains)}')
+	for dkimDomain in sorted(stats.dkimDomains):
 		print(dkimDomain)
 	print()
-	print(f'from domains: {len(fromDomains)}')
-	for fromDomain in sorted(fromDomains):
+	print(f'from domains: {len(stats.fromDomains)}')
+	for fromDomain in sorted(stats.fromDomains):
 		print(fromDomain)
 
 
-def dsp_exists_on_dns(qname: str) -> bool:
+def dkim_txt_data_has_key(qname: str, txtData: str) -> bool:
 	try:
-		response = dns.resolver.resolve(qname, dns.rdatatype.TXT)
-		if len(response) == 0:
-			logging.debug(f'no records found for {qname}')
-			return False
-		txtData = ""
-		for i in range(len(response)):
-			txtData += b''.join(response[i].strings).decode()  # type: ignore
-			txtData += ";"
-		try:
-			tags = decode_dkim_tag_value_list(txtData)
-		except DecodeTvlException as e:
-			logging.debug(f'error decoding DKIM tag-value pair: {e}')
-			return False
-		if 'p' not in tags:
-			logging.debug(f'no p= tag found for {qname}, {txtData}')
-			return False
-		p = tags['p']
-		if not p:
-			logging.debug(f'empty p= tag found for {qname}, {txtData}')
-			return False
-		return True
-	except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers, dns.exception.Timeout) as e:
-		logging.debug(f'dns resolver error: {e}')
+		tags = decode_dkim_tag_value_list(txtData)
+	except DecodeTvlException as e:
+		logging.debug(f'error decoding DKIM tag-value pair: {e}')
+		return False
+	if 'p' not in tags:
+		logging.debug(f'no p= tag found for {qname}, {txtData}')
+		return False
+	p = tags['p']
+	if not p:
+		logging.debug(f'empty p= tag found for {qname}, {txtData}')
 		return False
+	return True
+
+
+def txt_records_to_str(records: list[bytes]) -> str:
+	return ''.join(f'{record.decode()};' for record in records)
+
+
+def dsp_exists_on_dns(qname: str, dnsCache: DnsCache) -> bool:
+	records = dnsCache.resolve_txt(qname)
+	if not records:
+		logging.debug(f'no records found for {qname}')
+		return False
+	return dkim_txt_data_has_key(qname, txt_records_to_str(records))
+
+
+async def dsp_exists_on_dns_async(qname: str, dnsCache: DnsCache, semaphore: asyncio.Semaphore) -> bool:
+	async with semaphore:
+		records = await dnsCache.resolve_txt_async(qname)
+	if not records:
+		logging.debug(f'no records found for {qname}')
+		return False
+	return dkim_txt_data_has_key(qname, txt_records_to_str(records))
+
+
+async def find_active_qnames(qnames: set[str], dnsCache: DnsCache, concurrency: int) -> set[str]:
+	# resolve all qnames concurrently, with at most `concurrency` queries in flight at the same time
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def check_qname(qname: str) -> tuple[str, bool]:
+		return qname, await dsp_exists_on_dns_async(qname, dnsCache, semaphore)
+
+	active_qnames: set[str] = set()
+	tasks = [check_qname(qname) for qname in qnames]
+	for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+		qname, exists = await task
+		if exists:
+			active_qnames.add(qname)
+	return active_qnames
 
 
 def date_to_time_slot(date: datetime) -> str:
@@ -107,30 +153,94 @@ class QnameBucket:
 	active_qnames: set[str] = field(default_factory=set)
 
 
-# probabilistically classify whether a selector, based on its name, is likely bound to a specific public key (the key will not change for the same selector name)
-# examples: 2008, dk20170101, s2017-01, 201701, zj3gqqrotrgjg2t237hfixaqkmvmvwwi
-def is_keybound_selector_name(s: str):
-	m = re.match(r".*20(\d\d).*", s)
-	if m:
-		yy = int(m.group(1))
-		if yy >= 5 and yy <= datetime.now().year + 1 % 100:
+class KeyboundSelectorClassifier:
+	# probabilistically classify whether a selector, based on its name, is likely bound to a specific public key (the key will not change for the same selector name)
+	# examples: 2008, dk20170101, s2017-01, 201701, zj3gqqrotrgjg2t237hfixaqkmvmvwwi
+	# The classifier is called for every message, for a much smaller number of distinct selectors, so the results are memoized.
+
+	year_re = re.compile(r".*20(\d\d)")
+	scph_re = re.compile(r"scph\d\d\d\d")
+
+	def __init__(self, max_cache_size: int = 1000000):
+		# the last two digits of the latest year that is accepted in a selector name
+		self.max_yy = (datetime.now().year + 1) % 100
+		self.max_cache_size = max_cache_size
+		self.cache: dict[str, bool] = {}
+
+	def classify_uncached(self, s: str) -> bool:
+		m = self.year_re.match(s)
+		if m:
+			yy = int(m.group(1))
+			if yy >= 5 and yy <= self.max_yy:
+				return True
+		if self.scph_re.match(s):
 			return True
-	if re.match(r"scph\d\d\d\d", s):
-		return True
-	if (len(s) == 32 and s.isalnum()):
-		return True
-	return False
-
-
-def test_keybound_selector_classifier(selectorList: TextIO):
-	keybound_selectors: set[str] = set()
-	non_keybound_selectors: set[str] = set()
-	for line in selectorList:
-		selector = line.strip()
-		if is_keybound_selector_name(selector):
-			keybound_selectors.add(selector)
-		else:
-			non_keybound_selectors.add(selector)
+		if (len(s) == 32 and s.isalnum()):
+			return True
+		return False
+
+	def classify(self, s: str) -> bool:
+		result = self.cache.get(s)
+		if result is None:
+			if len(self.cache) >= self.max_cache_size:
+				self.cache.clear()
+			result = self.cache[s] = self.classify_uncached(s)
+		return result
+
+	def classify_many(self, selectors: Iterable[str]) -> dict[str, bool]:
+		return {s: self.classify(s) for s in set(selectors)}
+
+
+keybound_selector_classifier = KeyboundSelectorClassifier()
+
+
+def is_keybound_selector_name(s: str) -> bool:
+	return keybound_selector_classifier.classify(s)
+
+
+def read_selector_list(filename: str) -> list[str]:
+	with open(filename) as f:
+		return [line.strip() for line in f if line.strip()]
+
+
+def benchmark_keybound_selector_classifier(selectors: list[str], repeat: int = 10):
+	# the classifier is called once per message, so the selectors are classified several times to include the cached calls
+	classifier = KeyboundSelectorClassifier()
+	start = time.perf_counter()
+	for s in selectors:
+		classifier.classify_uncached(s)
+	uncached_seconds = time.perf_counter() - start
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for s in selectors:
+			classifier.classify(s)
+	cached_seconds = time.perf_counter() - start
+	logging.info(f'classified {len(selectors)} selectors in {uncached_seconds:.3f} s without the cache ({len(selectors) / max(uncached_seconds, 1e-9):.0f}/s), '
+	             f'{len(selectors) * repeat} times in {cached_seconds:.3f} s with the cache ({len(selectors) * repeat / max(cached_seconds, 1e-9):.0f}/s)')
+
+
+def check_keybound_selector_accuracy(results: dict[str, bool], referenceDir: str):
+	# compare with the keybound_selectors.txt and non_keybound_selectors.txt files in referenceDir, e.g. from an earlier run
+	expected: dict[str, bool] = {}
+	for filename, keybound in (('keybound_selectors.txt', True), ('non_keybound_selectors.txt', False)):
+		for selector in read_selector_list(os.path.join(referenceDir, filename)):
+			expected[selector] = keybound
+	compared = [s for s in results if s in expected]
+	mismatches = sorted(s for s in compared if results[s] != expected[s])
+	accuracy = 1 - len(mismatches) / len(compared) if compared else 0
+	logging.info(f'{len(compared)} selectors found in {referenceDir}, accuracy {accuracy:.2%}, {len(mismatches)} mismatches')
+	for s in mismatches[:20]:
+		logging.info(f'mismatch: {s}: classified as {"keybound" if results[s] else "non-keybound"}')
+
+
+def test_keybound_selector_classifier(selectorList: TextIO, referenceDir: str | None = None):
+	selectors = [line.strip() for line in selectorList if line.strip()]
+	benchmark_keybound_selector_classifier(selectors)
+	results = keybound_selector_classifier.classify_many(selectors)
+	if referenceDir:
+		check_keybound_selector_accuracy(results, referenceDir)
+	keybound_selectors = [s for s, keybound in results.items() if keybound]
+	non_keybound_selectors = [s for s, keybound in results.items() if not keybound]
 	with open('tmp/keybound_selectors.txt', 'w') as f:
 		for selector in sorted(keybound_selectors):
 			f.write(f'{selector}\n')
@@ -141,16 +251,6 @@ def test_keybound_selector_classifier(selectorList: TextIO):
 	logging.info(f'wrote {len(non_keybound_selectors)} non-keybound selectors to tmp/non_keybound_selectors.txt')
 
 
-def load_mbox_files(mboxFiles: list[str]) -> list[mailbox.mbox]:
-	loaded_mbox_files: list[mailbox.mbox] = []
-	for mboxFile in mboxFiles:
-		logging.info(f'loading {mboxFile}')
-		mb = mailbox.mbox(mboxFile)
-		len(mb)  # preload all messages
-		loaded_mbox_files.append(mb)
-	return loaded_mbox_files
-
-
 @dataclass
 class MsgInfo:
 	date: datetime
@@ -159,7 +259,11 @@ class MsgInfo:
 	messageData: str | None = None
 
 
-def extract_mbox_msg_info(message: mailbox.mboxMessage, include_RFC822_text: bool = False) -> MsgInfo | None:
+def msg_info_qname(mi: MsgInfo) -> str:
+	return f"{mi.dkimSelector}._domainkey.{mi.dkimDomain}"
+
+
+def extract_mbox_msg_info(message: email.message.Message, include_RFC822_text: bool = False) -> MsgInfo | None:
 	date = message['Date']
 	if (type(date) != str):
 		logging.debug(f'invalid Date header {date}')
@@ -188,27 +292,33 @@ def extract_mbox_msg_info(message: mailbox.mboxMessage, include_RFC822_text: boo
 	return MsgInfo(date, dkimDomain, dkimSelector, data)
 
 
-def dkim_dns_statistics(mboxFiles: list[str], includeOnlyKeyboundSelectors: bool):
-	buckets: dict[str, QnameBucket] = collections.defaultdict(QnameBucket)
-	loaded_mbox_files = load_mbox_files(mboxFiles)
+@dataclass
+class TimeSlotQnameCollector(Collector):
+	includeOnlyKeyboundSelectors: bool = False
+	buckets: dict[str, QnameBucket] = field(default_factory=lambda: collections.defaultdict(QnameBucket))
 
-	logging.info('processing messages')
-	for mboxMsg in tqdm(chain(*loaded_mbox_files), total=sum(len(mbox) for mbox in loaded_mbox_files)):
-		mi = extract_mbox_msg_info(mboxMsg, include_RFC822_text=False)
+	def collect(self, msg: ScannedMessage):
+		mi = extract_mbox_msg_info(msg.headers, include_RFC822_text=False)
 		if not mi:
-			continue
-		if includeOnlyKeyboundSelectors and not is_keybound_selector_name(mi.dkimSelector):
-			continue
-
+			return
+		if self.includeOnlyKeyboundSelectors and not is_keybound_selector_name(mi.dkimSelector):
+			return
 		time_slot_key = date_to_time_slot(mi.date)
-		bucket = buckets[time_slot_key]
-		bucket.qnames.add(f"{mi.dkimSelector}._domainkey.{mi.dkimDomain}")
+		self.buckets[time_slot_key].qnames.add(msg_info_qname(mi))
+
+	def merge(self, other: 'TimeSlotQnameCollector'):
+		for key, bucket in other.buckets.items():
+			self.buckets[key].qnames |= bucket.qnames
 
-	for key, bucket in sorted(buckets.items()):
-		logging.info(f'checking {len(bucket.qnames)} qnames for {key}')
-		for qname in tqdm(bucket.qnames):
-			if dsp_exists_on_dns(qname):
-				bucket.active_qnames.add(qname)
+
+def dkim_dns_statistics(collector: TimeSlotQnameCollector, dnsCache: DnsCache, dnsConcurrency: int):
+	buckets = collector.buckets
+	# a qname is often present in several time slots, so each unique qname is resolved only once
+	all_qnames: set[str] = set().union(*(bucket.qnames for bucket in buckets.values()))
+	logging.info(f'checking {len(all_qnames)} unique qnames, {sum(len(bucket.qnames) for bucket in buckets.values())} in total for all time slots')
+	active_qnames = asyncio.run(find_active_qnames(all_qnames, dnsCache, dnsConcurrency))
+	for bucket in buckets.values():
+		bucket.active_qnames = bucket.qnames & active_qnames
 
 	for key, bucket in sorted(buckets.items()):
 		active = len(bucket.active_qnames)
@@ -216,24 +326,6 @@ def dkim_dns_statistics(mboxFiles: list[str], includeOnlyKeyboundSelectors: bool
 		print(f'{key}: {active} active domainkeys of total {total} ({active / total * 100:.2f}%)')
 
 
-class CachedDnsResolver:
-	results: dict[str, bytes | None] = {}
-
-	def __init__(self):
-		self.resolver = dns.resolver.Resolver()
-		self.resolver.timeout = 5
-		self.resolver.lifetime = 5
-
-	def resolve(self, qname: bytes, timeout: int = 5) -> bytes | None:
-		qnameStr = qname.decode()
-		try:
-			return self.results[qnameStr]
-		except KeyError:
-			result = get_txt_dnspython(qnameStr, timeout)
-			self.results[qnameStr] = result
-			return result
-
-
 @dataclass
 class VerificationResult:
 	msgInfo: MsgInfo
@@ -241,84 +333,169 @@ class VerificationResult:
 	errors: list[str]
 
 
-def verify_message(mi: MsgInfo, dnsResolver: CachedDnsResolver) -> VerificationResult:
+def header_block(messageData: bytes) -> bytes:
+	ends = [i for i in (messageData.find(b'\n\n'), messageData.find(b'\r\n\r\n')) if i >= 0]
+	return messageData[:min(ends)] if ends else messageData
+
+
+def extract_msg_info_from_bytes(messageData: bytes) -> MsgInfo | None:
+	message = email.parser.BytesHeaderParser().parsebytes(header_block(messageData))
+	return extract_mbox_msg_info(message, include_RFC822_text=False)
+
+
+def iter_mbox_message_data(mboxFiles: list[str]) -> Iterator[bytes]:
+	# stream the raw messages one mbox file at a time
+	for mboxFile in mboxFiles:
+		logging.info(f'processing {mboxFile}')
+		for msg in iter_mbox_file(mboxFile):
+			yield msg.raw()
+
+
+@dataclass
+class QnameCollector(Collector):
+	excludeKeyboundSelectors: bool = False
+	qnames: set[str] = field(default_factory=set)
+
+	def collect(self, msg: ScannedMessage):
+		mi = extract_mbox_msg_info(msg.headers, include_RFC822_text=False)
+		if not mi:
+			return
+		if self.excludeKeyboundSelectors and is_keybound_selector_name(mi.dkimSelector):
+			return
+		self.qnames.add(normalize_qname(msg_info_qname(mi)))
+
+	def merge(self, other: 'QnameCollector'):
+		self.qnames |= other.qnames
+
+
+async def prefetch_dkim_keys(qnames: set[str], dnsCache: DnsCache, concurrency: int) -> dict[str, bytes | None]:
+	# resolve the DKIM key record of each qname up front, in the same form as a dnsfunc for dkim.verify returns it
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def fetch_qname(qname: str) -> tuple[str, bytes | None]:
+		async with semaphore:
+			records = await dnsCache.resolve_txt_async(qname)
+		return qname, records[0] if records else None
+
+	dkimKeys: dict[str, bytes | None] = {}
+	tasks = [fetch_qname(qname) for qname in qnames]
+	for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+		qname, record = await task
+		dkimKeys[qname] = record
+	return dkimKeys
+
+
+# state of each verification worker process, set by init_verification_worker
+prefetchedDkimKeys: dict[str, bytes | None] = {}
+workerExcludeKeyboundSelectors = False
+
+
+def init_verification_worker(dkimKeys: dict[str, bytes | None], excludeKeyboundSelectors: bool):
+	global prefetchedDkimKeys, workerExcludeKeyboundSelectors
+	prefetchedDkimKeys = dkimKeys
+	workerExcludeKeyboundSelectors = excludeKeyboundSelectors
+
+
+def prefetched_dnsfunc(qname: bytes, timeout: int = 5) -> bytes | None:
+	return prefetchedDkimKeys.get(normalize_qname(qname.decode()))
+
+
+def verify_message_data(messageData: bytes) -> VerificationResult | None:
+	mi = extract_msg_info_from_bytes(messageData)
+	if not mi:
+		return None
+	if workerExcludeKeyboundSelectors and is_keybound_selector_name(mi.dkimSelector):
+		logging.debug(f'skipping keybound selector {mi.dkimSelector}')
+		return None
 	try:
-		verified = dkim.verify(str(mi.messageData).encode(), dnsfunc=dnsResolver.resolve)  # type: ignore
+		verified = dkim.verify(messageData, dnsfunc=prefetched_dnsfunc)  # type: ignore
 		return VerificationResult(mi, verified, [])
 	except (dkim.MessageFormatError, UnicodeEncodeError, UnboundLocalError) as e:
 		return VerificationResult(mi, False, [str(e)])
 
 
-def dkim_key_rotation(mboxFiles: list[str], excludeKeyboundSelectors: bool):
-	loaded_mbox_files = load_mbox_files(mboxFiles)
-	dsp_verification_results: dict[str, list[VerificationResult]] = collections.defaultdict(list)
+def dkim_key_rotation(mboxFiles: list[str], qnames: set[str], excludeKeyboundSelectors: bool, dnsCache: DnsCache, dnsConcurrency: int, processes: int, outputFile: str):
+	# qnames are the normalized qnames of the messages in mboxFiles, see QnameCollector
+	logging.info(f'prefetching DKIM keys for {len(qnames)} qnames')
+	dkimKeys = asyncio.run(prefetch_dkim_keys(qnames, dnsCache, dnsConcurrency))
 
-	logging.info('processing messages')
-	dnsResolver = CachedDnsResolver()
-	for mboxMsg in tqdm(chain(*loaded_mbox_files), total=sum(len(mbox) for mbox in loaded_mbox_files)):
-		mi = extract_mbox_msg_info(mboxMsg, include_RFC822_text=True)
-		if not mi:
-			continue
-		if excludeKeyboundSelectors and is_keybound_selector_name(mi.dkimSelector):
-			print(f'skipping keybound selector {mi.dkimSelector}')
-			continue
-		qname = f"{mi.dkimSelector}._domainkey.{mi.dkimDomain}"
-		verification_result = verify_message(mi, dnsResolver)
-		dsp_verification_results[qname].append(verification_result)
+	# the results are written one by one as they arrive, and are read back with load_verification_results
+	logging.info(f'verifying messages with {processes} processes')
+	with open(outputFile, 'wb') as f, multiprocessing.Pool(processes, initializer=init_verification_worker, initargs=(dkimKeys, excludeKeyboundSelectors)) as pool:
+		for verification_result in tqdm(pool.imap(verify_message_data, iter_mbox_message_data(mboxFiles), chunksize=64)):
+			if verification_result is not None:
+				pickle.dump(verification_result, f)
+
+
+def load_verification_results(filename: str) -> dict[str, list[VerificationResult]]:
+	dsp_verification_results: dict[str, list[VerificationResult]] = collections.defaultdict(list)
+	with open(filename, 'rb') as f:
+		while True:
+			try:
+				data = pickle.load(f)
+			except EOFError:
+				break
+			if isinstance(data, dict):
+				# earlier versions saved all results as a single dict
+				for qname, results in data.items():
+					dsp_verification_results[qname].extend(results)
+			else:
+				dsp_verification_results[msg_info_qname(data.msgInfo)].append(data)
 	return dsp_verification_results
 
 
-def verification_results_to_svg(data: dict[str, list[VerificationResult]], output_file: str):
-	xres = 1200
-	yres = 800
-	table_width = 800
+svg_width = 1200
+svg_height = 800
+svg_table_width = 800
+svg_row_height_px = 10
+svg_empty_rows = 2
+# the number of qnames in each image
+svg_rows_per_page = svg_height // svg_row_height_px - svg_empty_rows
+
+
+def svg_page_filename(output_file: str, page: int) -> str:
+	# output.svg, output-2.svg, output-3.svg, ...
+	if page == 0:
+		return output_file
+	base, ext = os.path.splitext(output_file)
+	return f'{base}-{page + 1}{ext}'
+
+
+def verification_results_to_svg(rows: list[tuple[str, list[VerificationResult]]], output_file: str):
+	# rows are (qname, results sorted by date), the elements are written to the file one by one instead of building a tree
 	start_date = datetime(2010, 1, 1).timestamp()
 	end_datetime = datetime(2025, 1, 1)
 	end_date = end_datetime.timestamp()
-	row_height_px = 10
-	empty_rows = 2
-	rows = yres // row_height_px - empty_rows
 
 	def date_to_x(date: datetime) -> float:
-		return (date.timestamp() - start_date) / (end_date - start_date) * table_width
-
-	def add_year_labels():
+		return (date.timestamp() - start_date) / (end_date - start_date) * svg_table_width
+
+	def line(x1: float, y1: float, x2: float, y2: float, color: str) -> str:
+		return f'<line x1="{x1}" y1="{y1}" x2="{x2}" y2="{y2}" stroke="{color}" />\n'
+
+	def text(x: float, y: float, label: str) -> str:
+		return f'<text x="{x}" y="{y}" fill="black" font-size="10">{xml_escape(label)}</text>\n'
+
+	with open(output_file, 'w') as f:
+		f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{svg_width}" height="{svg_height}">\n')
+		f.write(f'<rect x="0" y="0" width="100%" height="100%" fill="white" />\n')
+		for row, (qname, results) in enumerate(rows):
+			y = (row + svg_empty_rows) * svg_row_height_px
+			mid_y = y + svg_row_height_px / 2
+			for i, r in enumerate(results):
+				date1 = r.msgInfo.date
+				date2 = results[i + 1].msgInfo.date if i + 1 < len(results) else end_datetime
+				color = 'green' if r.verified else 'red'
+				x = date_to_x(date1)
+				width = (date2.timestamp() - date1.timestamp()) / (end_date - start_date) * svg_table_width
+				f.write(line(x, mid_y, x + width, mid_y, color))
+				f.write(line(x, y, x, y + svg_row_height_px, color))
+			f.write(text(svg_table_width + 5, y + 10, qname))
 		for year in range(2010, end_datetime.year + 1):
 			x = date_to_x(datetime(year, 1, 1))
-			label = ET.SubElement(root, "text", x=str(x + 3), y=str(row_height_px), fill="black")
-			label.text = str(year)
-			label.set("font-size", "10")
-			ET.SubElement(root, "line", x1=str(x), y1="0", x2=str(x), y2=str(yres), stroke="black")
-
-	def add_msg_rect(parent: ET.Element, row: int, date: datetime, duration: float, verified: bool):
-		y = (row + empty_rows) * row_height_px
-		color = 'green' if verified else 'red'
-		x = date_to_x(date)
-		width = duration / (end_date - start_date) * table_width
-		mid_y = y + row_height_px / 2
-		ET.SubElement(root, "line", x1=str(x), y1=str(mid_y), x2=str(x + width), y2=str(mid_y), stroke=color)
-		ET.SubElement(parent, "line", x1=str(x), y1=str(y), x2=str(x), y2=str(y + row_height_px), stroke=color)
-
-	root = ET.Element("svg", width=str(xres), height=str(yres), xmlns="http://www.w3.org/2000/svg")
-	ET.SubElement(root, "rect", x="0", y="0", width="100%", height="100%", fill="white")
-
-	bars_group = ET.SubElement(root, "g")
-	for row, (_label, results) in enumerate(data.items()):
-		if row >= rows:
-			break
-		for i, r in enumerate(results):
-			r = results[i]
-			date1 = r.msgInfo.date
-			date2 = results[i + 1].msgInfo.date if i + 1 < len(results) else end_datetime
-			duration = date2.timestamp() - date1.timestamp()
-			add_msg_rect(bars_group, row, date1, duration, r.verified)
-			label = ET.SubElement(root, "text", x=str(table_width + 5), y=str((row + empty_rows) * row_height_px + 10), fill="black")
-			label.text = f'{r.msgInfo.dkimSelector}._domainkey.{r.msgInfo.dkimDomain}'
-			label.set("font-size", "10")
-	add_year_labels()
-	tree = ET.ElementTree(root)
-	ET.indent(root)
-	tree.write(output_file)
+			f.write(text(x + 3, svg_row_height_px, str(year)))
+			f.write(line(x, 0, x, svg_height, 'black'))
+		f.write('</svg>\n')
 
 
 def calculate_significance(results: list[VerificationResult]) -> float:
@@ -328,12 +505,18 @@ def calculate_significance(results: list[VerificationResult]) -> float:
 	return sum(abs(x - mean) for x in arr)
 
 
-def dkim_key_rotation_display_results(results_per_dsp: dict[str, list[VerificationResult]]):
-	# sort by a custom measure of significance
-	results_per_dsp = dict(sorted(results_per_dsp.items(), key=lambda x: calculate_significance(x[1]), reverse=True))
-	for _qname, results in results_per_dsp.items():
+def dkim_key_rotation_display_results(results_per_dsp: dict[str, list[VerificationResult]], output_file: str = 'output.svg', pages: int = 1):
+	# only the most significant qnames by a custom measure of significance are displayed, svg_rows_per_page in each image
+	top_rows = heapq.nlargest(svg_rows_per_page * pages, results_per_dsp.items(), key=lambda x: calculate_significance(x[1]))
+	for _qname, results in top_rows:
 		results.sort(key=lambda x: x.msgInfo.date)
-	verification_results_to_svg(results_per_dsp, "output.svg")
+	for page in range(pages):
+		rows = top_rows[page * svg_rows_per_page:(page + 1) * svg_rows_per_page]
+		if not rows and page > 0:
+			break
+		filename = svg_page_filename(output_file, page)
+		verification_results_to_svg(rows, filename)
+		logging.info(f'wrote {len(rows)} qnames to {filename}')
 
 
 def selector_statistics(tsvFile: str):
@@ -358,55 +541,161 @@ def selector_statistics(tsvFile: str):
 		print(f'{selector}\t{len(domains)} domains ({domainsPercentage:.1f}%), accumulated: {accumulatedDomainsPercentage:.1f}%')
 
 
-async def dkim_key_reuse_statistics():
+max_displayed_dkim_keys = 100
+max_displayed_selectors = 5
+
+
+@dataclass
+class KeyReuse:
+	keyData: str
+	dsps: int  # number of unique domain/selector pairs that use the key
+	selectors: int  # number of unique selectors that use the key
+	topSelectors: list[tuple[str, int]]  # the selectors with the most domains, and the number of domains for each
+
+
+def print_key_reuse(keys: list[KeyReuse], totalKeys: int):
+	for keyReuse in keys:
+		print(f'dkim key: {keyReuse.keyData}')
+		print(f'\t{keyReuse.dsps} domain/selector pairs')
+		print(f'\t{keyReuse.selectors} selectors, breakdown:')
+		for selector, domains in keyReuse.topSelectors:
+			print(f'\t\t{selector}: {domains} domains')
+		if keyReuse.selectors > len(keyReuse.topSelectors):
+			print(f'\t\t...and {keyReuse.selectors - len(keyReuse.topSelectors)} more selectors')
+		print()
+	if totalKeys > len(keys):
+		print(f'...and {totalKeys - len(keys)} more DKIM keys')
+
+
+async def key_reuse_sql(prisma: 'Prisma') -> tuple[list[KeyReuse], int]:
+	# the top keys, and the top selectors of each key, are computed in the database
+	rows = await prisma.query_raw(
+	    """
+		WITH pairs AS (
+			SELECT DISTINCT r."keyData" AS key_data, d.selector, d.domain
+			FROM "DkimRecord" r JOIN "DomainSelectorPair" d ON d.id = r."domainSelectorPairId"
+			WHERE r."keyData" IS NOT NULL AND r."keyData" <> ''
+		), top_keys AS (
+			SELECT key_data, count(*) AS dsps, count(DISTINCT selector) AS selectors
+			FROM pairs GROUP BY key_data ORDER BY dsps DESC, key_data LIMIT $1
+		), selector_counts AS (
+			SELECT p.key_data, p.selector, count(*) AS domains,
+				row_number() OVER (PARTITION BY p.key_data ORDER BY count(*) DESC, p.selector) AS rank
+			FROM pairs p JOIN top_keys k ON k.key_data = p.key_data
+			GROUP BY p.key_data, p.selector
+		)
+		SELECT k.key_data, k.dsps, k.selectors, s.selector, s.domains
+		FROM top_keys k JOIN selector_counts s ON s.key_data = k.key_data
+		WHERE s.rank <= $2
+		ORDER BY k.dsps DESC, k.key_data, s.rank
+		""", max_displayed_dkim_keys, max_displayed_selectors)
+	keys: list[KeyReuse] = []
+	for row in rows:
+		if not keys or keys[-1].keyData != row['key_data']:
+			keys.append(KeyReuse(row['key_data'], int(row['dsps']), int(row['selectors']), []))
+		keys[-1].topSelectors.append((row['selector'], int(row['domains'])))
+	totalKeys = await prisma.query_raw('SELECT count(DISTINCT "keyData") AS count FROM "DkimRecord" WHERE "keyData" IS NOT NULL AND "keyData" <> \'\'')
+	return keys, int(totalKeys[0]['count'])
+
+
+def summarize_key_reuse(keyData: str, selectorsWithDomains: dict[str, set[str]]) -> KeyReuse:
+	dsps = sum(len(domains) for domains in selectorsWithDomains.values())
+	topSelectors = heapq.nsmallest(max_displayed_selectors, ((selector, len(domains)) for selector, domains in selectorsWithDomains.items()), key=lambda x: (-x[1], x[0]))
+	return KeyReuse(keyData, dsps, len(selectorsWithDomains), topSelectors)
+
+
+async def key_reuse_streaming(prisma: 'Prisma') -> tuple[list[KeyReuse], int]:
+	# the records are streamed in keyData order, so that only the domains and selectors of one key are held in memory at a time,
+	# together with a bounded heap of the top keys
+	topKeys: list[tuple[int, int, KeyReuse]] = []
+	totalKeys = 0
+
+	def add_key(keyReuse: KeyReuse):
+		# the keys arrive in keyData order, so on equal dsps counts the earlier key is kept, as in the ORDER BY of key_reuse_sql
+		item = (keyReuse.dsps, -totalKeys, keyReuse)
+		if len(topKeys) < max_displayed_dkim_keys:
+			heapq.heappush(topKeys, item)
+		elif item[:2] > topKeys[0][:2]:
+			heapq.heapreplace(topKeys, item)
+
+	currentKey: str | None = None
+	selectorsWithDomains: dict[str, set[str]] = collections.defaultdict(set)
+	async for record in iter_dkim_records_with_dsps(prisma, order_by_key_data=True):
+		if not record.keyData or not record.domainSelectorPair:
+			continue
+		if record.keyData != currentKey:
+			if currentKey is not None:
+				add_key(summarize_key_reuse(currentKey, selectorsWithDomains))
+			currentKey = record.keyData
+			selectorsWithDomains = collections.defaultdict(set)
+			totalKeys += 1
+		selectorsWithDomains[record.domainSelectorPair.selector].add(record.domainSelectorPair.domain)
+	if currentKey is not None:
+		add_key(summarize_key_reuse(currentKey, selectorsWithDomains))
+	keys = [keyReuse for _dsps, _order, keyReuse in sorted(topKeys, key=lambda x: x[:2], reverse=True)]
+	return keys, totalKeys
+
+
+async def dkim_key_reuse_statistics(streaming: bool = False):
 	from prisma import Prisma
 	prisma = Prisma()
 	await prisma.connect()
-	records = await load_dkim_records_with_dsps(prisma)
-	dkimKeyMap: dict[str, dict[str, set[str]]] = collections.defaultdict(lambda: collections.defaultdict(set))
-	for record in records:
-		if not record.keyData or not record.domainSelectorPair:
-			continue
-		dkimKeyMap[record.keyData][record.domainSelectorPair.selector].add(record.domainSelectorPair.domain)
-	sorted_dkimKeyMap = dict(sorted(dkimKeyMap.items(), key=lambda x: sum(len(domains) for domains in x[1].values()), reverse=True))
-	for dkim_key_index, (dkimKey, selectors_with_domains) in enumerate(sorted_dkimKeyMap.items()):
-		number_of_dsps = sum(len(domains) for domains in selectors_with_domains.values())
-		max_displayed_dkim_keys = 100
-		if dkim_key_index >= max_displayed_dkim_keys:
-			print(f'...and {len(sorted_dkimKeyMap) - max_displayed_dkim_keys} more DKIM keys')
-			break
-		print(f'dkim key: {dkimKey}')
-		print(f'\t{number_of_dsps} domain/selector pairs')
-		selectors_with_domains = dict(sorted(selectors_with_domains.items(), key=lambda x: len(x[1]), reverse=True))
-		print(f'\t{len(selectors_with_domains)} selectors, breakdown:')
-		for selector_index, (selector, domains) in enumerate(selectors_with_domains.items()):
-			max_displayed_selectors = 5
-			if selector_index >= max_displayed_selectors:
-				print(f'\t\t...and {len(selectors_with_domains) - max_displayed_selectors} more selectors')
-				break
-			print(f'\t\t{selector}: {len(domains)} domains')
-		print()
+	if streaming:
+		keys, totalKeys = await key_reuse_streaming(prisma)
+	else:
+		keys, totalKeys = await key_reuse_sql(prisma)
+	print_key_reuse(keys, totalKeys)
+	await prisma.disconnect()
 
 
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.INFO)
 	logging.getLogger("httpx").setLevel(logging.WARNING)
 	argparser = argparse.ArgumentParser(description='Collect various statistics about domains, selectors, and DKIM signatures')
-	argparser.add_argument('--dkimDspStatsMbox', help='Show statistics about DKIM sigatures and domains for an .mbox file')
+	argparser.add_argument('--dkimDspStatsMbox', help='Show statistics about DKIM sigatures and domains for a set of .mbox files', type=str, nargs='+')
 
 	argparser.add_argument('--dkimDnsStatsMbox', help='Show statistics about the DNS lookup status of domains/selectors for a set of .mbox files', type=str, nargs='+')
 	argparser.add_argument(
 	    '--includeOnlyKeyboundSelectors',
 	    help='Use together with --dkimDnsStatsMbox to include only probably "keybound" selectors, such as "202306", and exclude "generic" selectors (such as "s1", "default", etc)',
 	    action='store_true')
+	argparser.add_argument('--dnsConcurrency',
+	                       help='Use together with --dkimDnsStatsMbox or --dkimKeyRotation to set the maximum number of concurrent DNS queries',
+	                       type=int,
+	                       default=50)
+
+	argparser.add_argument('--dnsCacheFile',
+	                       help=f'SQLite file for caching DNS results between runs, such as {default_cache_file}, by default the results are only cached in memory',
+	                       type=str)
+	argparser.add_argument(
+	    '--dnsMinTtl',
+	    help='Keep positive DNS results in --dnsCacheFile for at least this many seconds instead of the TTL of the record, for re-analysis runs on the same corpus',
+	    type=int,
+	    default=0)
 
-	argparser.add_argument('--testKeyboundSelectorClassifier', help='Test the selector classifier with a file with a list of selectors', type=argparse.FileType('r'))
+	argparser.add_argument('--testKeyboundSelectorClassifier',
+	                       help='Test the selector classifier with a file with a list of selectors, and measure its throughput',
+	                       type=argparse.FileType('r'))
+	argparser.add_argument(
+	    '--keyboundSelectorReference',
+	    help='Use together with --testKeyboundSelectorClassifier to compare the results with keybound_selectors.txt and non_keybound_selectors.txt in this directory',
+	    type=str)
 
 	argparser.add_argument('--dkimKeyReuse', help='Show statistics about DKIM key reuse from the database', action='store_true')
+	argparser.add_argument('--dkimKeyReuseStreaming',
+	                       help='Use together with --dkimKeyReuse to compute the statistics in Python from streamed records, instead of with a query in the database',
+	                       action='store_true')
 
 	dkimKeyRotationHelp = 'For a set of .mbox files, try to DKIM verify each email back in time (against current DNS record) and see if there is a pattern that older emails before a certain date cannot be verified, while newer emails can. Data will be saved to verification_results.pickle. Use --dkimKeyRotationAnalyzeResults to analyze the data.'
 	argparser.add_argument('--dkimKeyRotation', help=dkimKeyRotationHelp, type=str, nargs='+')
+	argparser.add_argument('--processes', help='The number of processes that scan .mbox files and verify messages', type=int, default=os.cpu_count())
 	argparser.add_argument('--excludeKeyboundSelectors', help='Use together with --dkimKeyRotation to exclude "keybound" selectors (such as "202306", etc)', action='store_true')
+	argparser.add_argument('--svgOutput', help='Use together with --dkimKeyRotationAnalyzeResults to set the output file', type=str, default='output.svg')
+	argparser.add_argument(
+	    '--svgPages',
+	    help=f'Use together with --dkimKeyRotationAnalyzeResults to write this many images, with {svg_rows_per_page} qnames each, as output.svg, output-2.svg, etc.',
+	    type=int,
+	    default=1)
 	tsvHelp = 'For a .tsv file with two columns(domain, selector), show a list of selectors, with percentage of domains convered for each selector. Also print accumulated percentage of domains covered when using the N most common selectors'
 	argparser.add_argument('--dkimKeyRotationAnalyzeResults',
 	                       help='Analyze the results of the .pickle output file from --dkimKeyRotation and display the results',
@@ -414,35 +703,50 @@ if __name__ == '__main__':
 
 	argparser.add_argument('--tsvFile', help=tsvHelp)
 	args = argparser.parse_args()
+	metrics.enable_export('statistics')
 
 	if (not args.dkimDspStatsMbox and not args.dkimDnsStatsMbox and not args.tsvFile and not args.testKeyboundSelectorClassifier and not args.dkimKeyReuse
 	    and not args.dkimKeyRotation and not args.dkimKeyRotationAnalyzeResults):
 		argparser.print_help(file=sys.stderr)
 		sys.exit(1)
 
+	# the reports for the same set of .mbox files are collected in a single pass over the files
+	mboxCollectorFactories: dict[tuple[str, ...], list[CollectorFactory]] = collections.defaultdict(list)
 	if args.dkimDspStatsMbox:
-		domain_statistics(args.dkimDspStatsMbox)
+		mboxCollectorFactories[tuple(args.dkimDspStatsMbox)].append(DomainStatisticsCollector)
+	if args.dkimDnsStatsMbox:
+		mboxCollectorFactories[tuple(args.dkimDnsStatsMbox)].append(partial(TimeSlotQnameCollector, args.includeOnlyKeyboundSelectors))
+	if args.dkimKeyRotation:
+		mboxCollectorFactories[tuple(args.dkimKeyRotation)].append(partial(QnameCollector, args.excludeKeyboundSelectors))
+	collectors: list[Collector] = []
+	for mboxFiles, collectorFactories in mboxCollectorFactories.items():
+		collectors.extend(scan_mbox_files(list(mboxFiles), collectorFactories, args.processes))
+
+	for collector in collectors:
+		if isinstance(collector, DomainStatisticsCollector):
+			domain_statistics(collector)
 
 	if args.tsvFile:
 		selector_statistics(args.tsvFile)
 
-	if args.dkimDnsStatsMbox:
-		dkim_dns_statistics(args.dkimDnsStatsMbox, args.includeOnlyKeyboundSelectors)
+	for collector in collectors:
+		if isinstance(collector, TimeSlotQnameCollector):
+			with DnsCache(args.dnsCacheFile, min_ttl=args.dnsMinTtl) as dnsCache:
+				dkim_dns_statistics(collector, dnsCache, args.dnsConcurrency)
 
-	if args.dkimKeyRotation:
-		dsp_verification_results = dkim_key_rotation(args.dkimKeyRotation, args.excludeKeyboundSelectors)
-		with open('verification_results.pickle', 'wb') as f:
-			pickle.dump(dsp_verification_results, f)
+	for collector in collectors:
+		if isinstance(collector, QnameCollector):
+			with DnsCache(args.dnsCacheFile, min_ttl=args.dnsMinTtl) as dnsCache:
+				dkim_key_rotation(args.dkimKeyRotation, collector.qnames, args.excludeKeyboundSelectors, dnsCache, args.dnsConcurrency, args.processes,
+				                  'verification_results.pickle')
 
 	if args.dkimKeyRotationAnalyzeResults:
-		with open(args.dkimKeyRotationAnalyzeResults.name, 'rb') as f:
-			dsp_verification_results = pickle.load(f)
-		dkim_key_rotation_display_results(dsp_verification_results)
+		dsp_verification_results = load_verification_results(args.dkimKeyRotationAnalyzeResults.name)
+		dkim_key_rotation_display_results(dsp_verification_results, args.svgOutput, args.svgPages)
 
 	if args.testKeyboundSelectorClassifier:
 		filename: TextIO = args.testKeyboundSelectorClassifier
-		test_keybound_selector_classifier(filename)
+		test_keybound_selector_classifier(filename, args.keyboundSelectorReference)
 
 	if args.dkimKeyReuse:
-		import asyncio
-		asyncio.run(dkim_key_reuse_statistics())
+		asyncio.run(dkim_key_reuse_statistics(args.dkimKeyReuseStreaming))